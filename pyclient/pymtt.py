@@ -27,6 +27,15 @@ def load_source(name, path):
     module_spec.loader.exec_module(module)
     return module
 
+def shard(value):
+    try:
+        k,n = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not of the form K/N" % value)
+    if n < 1 or k < 1 or k > n:
+        raise argparse.ArgumentTypeError("shard %s is not one of 1/N to N/N" % value)
+    return (k, n)
+
 # First check for bozo error - we need to be given
 # at least a cmd line option, so no params at all
 # sounds like a plea for "help"
@@ -82,10 +91,18 @@ execGroup.add_argument("--description", dest="description",
                      help="Provide a brief title/description to be included in the log for this test")
 execGroup.add_argument("-e", "--executor", dest="executor",
                      help="Use the specified execution STRATEGY module", metavar="STRATEGY")
+execGroup.add_argument("--max-workers", dest="max_workers", default=None,
+                     help="Maximum number of sections to execute concurrently with the parallel executor (defaults to the number of cpus), or of combinations with the combinatorial executor (defaults to 1)", metavar="N")
+execGroup.add_argument("--async-execmd", dest="async_execmd", action="store_true", default=False,
+                     help="Run commands through the asyncio based AsyncExecuteCmd utility instead of ExecuteCmd")
 execGroup.add_argument("--base-dir", dest="basedir",
                      help="Specify the DIRECTORY where we can find the TestDef class (checks DIRECTORY, DIRECTORY/Utilities, and DIRECTORY/pylib/Utilities locations) - also serves as default plugin-dir", metavar="DIRECTORY")
 execGroup.add_argument("--plugin-dir", dest="plugindir",
                      help="Specify the DIRECTORY where additional plugins can be found (or comma-delimited list of DIRECTORYs)", metavar="DIRECTORY")
+execGroup.add_argument("--plugin-cache", dest="plugincache", default=None,
+                     help="Specify the DIRECTORY in which to cache the results of scanning the plugin directories (defaults to ~/.cache/mtt)", metavar="DIRECTORY")
+execGroup.add_argument("--no-plugin-cache", dest="noplugincache", action="store_true", default=False,
+                     help="Scan the plugin directories without using or updating the plugin cache")
 execGroup.add_argument("--ignore-loadpath-errors", action="store_true", dest="ignoreloadpatherrs", default=False,
                      help="Ignore errors in plugin paths")
 execGroup.add_argument("--scratch-dir", dest="scratchdir", default=None,
@@ -111,6 +128,16 @@ execGroup.add_argument("--skip-sections", dest="skipsections",
                      help="Skip the specified SECTION (or comma-delimited list of SECTIONs)", metavar="SECTION")
 execGroup.add_argument("-l", "--log", dest="logfile", default=None,
                      help="Log all output to FILE (defaults to stdout)", metavar="FILE")
+execGroup.add_argument("--journal", dest="journal", default=None,
+                     help="Append each section's results to FILE as they are logged, so an interrupted run can be resumed", metavar="FILE")
+execGroup.add_argument("--resume", dest="resume", action="store_true", default=False,
+                     help="Skip the sections that succeeded in the results journal and continue from there")
+execGroup.add_argument("--shard", dest="shard", type=shard, default=None,
+                     help="Only run shard K of N of the combinations generated by the combinatorial executor", metavar="K/N")
+execGroup.add_argument("--merge-journals", dest="merge_journals", default=None,
+                     help="Load the results of the given comma-delimited list of journals, such as those of the shards of a run, and only execute the MTTDefaults and Reporter sections", metavar="FILE")
+execGroup.add_argument("--flush-spool", dest="flush_spool", default=None,
+                     help="Send the results submissions queued in DIRECTORY by the IUDatabase reporter's spool_dir option, up to --max-workers (defaults to 4) at a time, and exit", metavar="DIRECTORY")
 execGroup.add_argument("--group-results", dest="submit_group_results", default=True,
                      help="Report results from each test section as it is completed")
 execGroup.add_argument("--default-make-options", dest="default_make_options", default="-j10",
@@ -137,7 +164,7 @@ execGroup.add_argument("--harass_stop",
                      help="Paths to scripts that are run to stop harassing the system after the test finishes.")
 execGroup.add_argument("--harass_join_timeout",
                      dest="harass_join_timeout", default=None,
-                     help="Number of seconds to wait while ending harass scripts. Default is infinity.")
+                     help="Number of seconds to wait while ending harass scripts before they are killed. Default is infinity.")
 
 debugGroup = parser.add_argument_group('debugGroup', 'Debug Options')
 debugGroup.add_argument("-d", "--debug", dest="debug",
@@ -273,6 +300,15 @@ testDef.loadPlugins(basedir, topdir)
 # outputs before starting to process the test
 testDef.printInfo()
 
+# send any spooled results submissions - nothing
+# else is done, so no test-specification file is needed
+if args.flush_spool:
+    plugin = testDef.selectPlugin("IUDatabase", "stage")
+    if plugin is None:
+        print("ERROR: the IUDatabase reporter is needed to send spooled submissions")
+        sys.exit(1)
+    sys.exit(plugin.flushSpool(args.flush_spool, int(args.max_workers or 4)))
+
 # if they didn't specify any files, then there is nothing
 # for us to do
 if not args.ini_files or not args.ini_files[0]:
@@ -282,6 +318,14 @@ if not args.ini_files or not args.ini_files[0]:
 if args.section and args.skipsections:
     print("ERROR: Cannot both execute specific sections and specify sections to be skipped")
     sys.exit(1)
+if args.resume and not args.journal:
+    print("ERROR: --resume requires the --journal of the run to be resumed")
+    sys.exit(1)
+if args.merge_journals:
+    if args.section or args.skipsections:
+        print("ERROR: Cannot select sections when merging journals - only the MTTDefaults and Reporter sections are executed")
+        sys.exit(1)
+    args.section = "MTTDefaults,Reporter:*"
 
 # open the logging file if given - otherwise, we log
 # to stdout
@@ -297,10 +341,14 @@ testDef.configTest()
 # If there is nothing defined in either use fallback
 fallback = "sequential"
 executor = args.executor or testDef.config.get('MTTDefaults', 'executor', fallback=fallback)
+# the merged results only need reporting
+if args.merge_journals:
+    executor = fallback
 
 # Do not verify that executor exists now
 # When the executor is loaded it ensures it exists
 testDef.config.set('MTTDefaults', 'executor', executor.lower())
 
 status = testDef.executeTest(executor=executor.lower())
+testDef.logger.closeJournal()
 sys.exit(status)
@@ -28,7 +28,11 @@ from MTTDefaultsMTTStage import *
 # @param merge_stdout_stderr   Merge stdout and stderr into one output stream
 # @param stdout_save_lines     Number of lines of stdout to save (-1 for unlimited)
 # @param stderr_save_lines     Number of lines of stderr to save (-1 for unlimited)
-# @param executor              Strategy to use: combinatorial or sequential executor
+# @param stdout_save_head_lines Number of lines from the start of stdout to save in addition to the last stdout_save_lines lines
+# @param stderr_save_head_lines Number of lines from the start of stderr to save in addition to the last stderr_save_lines lines
+# @param output_spill_bytes    Write command output beyond this many bytes to a file under the scratch directory instead of memory (0 to keep all output in memory)
+# @param executor              Strategy to use: combinatorial, sequential or parallel executor
+# @param max_workers           Maximum number of sections to execute concurrently with the parallel executor (defaults to the number of cpus)
 # @param time                  Record how long it takes to run each individual test
 # @param restart_file          Optional restart log file 
 # @}
@@ -46,7 +50,11 @@ class DefaultMTTDefaults(MTTDefaultsMTTStage):
         self.options['merge_stdout_stderr'] = (False, "Merge stdout and stderr into one output stream")
         self.options['stdout_save_lines'] = (-1, "Number of lines of stdout to save (-1 for unlimited)")
         self.options['stderr_save_lines'] = (-1, "Number of lines of stderr to save (-1 for unlimited)")
-        self.options['executor'] = ('sequential', "Strategy to use: combinatorial or sequential executor")
+        self.options['stdout_save_head_lines'] = (0, "Number of lines from the start of stdout to save in addition to the last stdout_save_lines lines")
+        self.options['stderr_save_head_lines'] = (0, "Number of lines from the start of stderr to save in addition to the last stderr_save_lines lines")
+        self.options['output_spill_bytes'] = (0, "Write command output beyond this many bytes to a file under the scratch directory instead of memory (0 to keep all output in memory)")
+        self.options['executor'] = ('sequential', "Strategy to use: combinatorial, sequential or parallel executor")
+        self.options['max_workers'] = (None, "Maximum number of sections to execute concurrently with the parallel executor (defaults to the number of cpus)")
         self.options['time'] = (True, "Record how long it takes to run each individual test")
         self.options['restart_file'] = (None, "Log restart file")
         return
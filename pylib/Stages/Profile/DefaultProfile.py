@@ -66,23 +66,24 @@ class DefaultProfile(ProfileMTTStage):
         # see what they want us to collect
         cmds = {}
         testDef.parseOptions(log, self.options, keyvals, cmds)
-        keys = list(cmds.keys())
+        keys = [key for key in cmds.keys() if key in self.options and cmds[key]]
         # pass in a timeout option as not every system will support
         # every option
         myopts = {'timeout': 2}
-        for key in keys:
-            if key in self.options and cmds[key]:
-                results = testDef.execmd.execute(myopts, self.options[key][2], testDef)
-                if 'timedout' in results:
-                    # we just ignore it
-                    continue
-                if 0 != results['status']:
-                    log['status'] = results['status']
-                    log['stdout'] = results['stdout']
-                    log['stderr'] = results['stderr']
-                    # ignore the execution time, if collected
-                    return
-                myLog[key] = results['stdout']
+        # the commands are independent, so let them run at once
+        # where the command engine can do so
+        allresults = testDef.execmd.execute_many([(myopts, self.options[key][2]) for key in keys], testDef)
+        for key,results in zip(keys, allresults):
+            if 'timedout' in results:
+                # we just ignore it
+                continue
+            if 0 != results['status']:
+                log['status'] = results['status']
+                log['stdout'] = results['stdout']
+                log['stderr'] = results['stderr']
+                # ignore the execution time, if collected
+                return
+            myLog[key] = results['stdout']
         # add our log to the system log
         log['profile'] = myLog
         log['status'] = 0
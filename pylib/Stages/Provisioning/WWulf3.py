@@ -164,11 +164,10 @@ class WWulf3(ProvisionMTTStage):
             log['status'] = results['status']
             log['stderr'] = "Node list was not obtained"
             return
-        # skip first two lines as they are headers
-        del results['stdout'][0:2]
-        # parse each line to collect out the individual nodes
+        # parse each line to collect out the individual nodes,
+        # skipping the first two lines as they are headers
         nodes = []
-        for line in results['stdout']:
+        for line in results['stdout'][2:]:
             # node name is at the front, ended by a space
             nodes.append(line[0:line.find(' ')])
         # now check that each target is in the list of nodes - no
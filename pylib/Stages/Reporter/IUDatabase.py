@@ -14,11 +14,21 @@
 
 import os
 import pwd
+import gzip
+import glob
+import time
+import uuid
+import fcntl
+import random
+import tempfile
 import requests
 import json
 import pprint
 import re
+import threading
+import concurrent.futures
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 from ReporterMTTStage import *
@@ -26,6 +36,37 @@ from ReporterMTTStage import *
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# Submissions that cannot be sent when the reporter runs are spooled:
+# the requests making them up are written to a file in the spool
+# directory, to be sent later on by "pymtt.py --flush-spool". Since
+# each request needs the ids returned by those before it, the reporter
+# is handed a stand-in reply for every spooled request whose values
+# refer to the reply it will get - {"$reply": [request, key, ...]} -
+# and these references are resolved as the requests are sent.
+def _reply(*path):
+    return {'$reply': list(path)}
+
+class _PendingIds(dict):
+    def __init__(self, path):
+        dict.__init__(self)
+        self.path = path
+
+    def __missing__(self, key):
+        return _reply(*(self.path + (key,)))
+
+def _resolve(value, requests):
+    if isinstance(value, dict):
+        if list(value.keys()) == ['$reply']:
+            path = value['$reply']
+            value = requests[path[0]]['reply']
+            for key in path[1:]:
+                value = value[key]
+            return value
+        return dict((k, _resolve(v, requests)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_resolve(v, requests) for v in value]
+    return value
+
 ## @addtogroup Stages
 # @{
 # @addtogroup Reporter
@@ -43,6 +84,13 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 # @param debug_server       Ask the server to return its debug output as well
 # @param email              Email to which errors are to be sent
 # @param dryrun             Print debug without actually submitting to database server
+# @param max_results        Maximum number of test results to submit in a single request
+# @param max_bytes          Maximum size in bytes of the test results submitted in a single request
+# @param compress           Compress submissions with gzip (the server must support it)
+# @param timeout            Seconds to wait for the server to reply
+# @param upload_workers     Number of submissions to send to the server at once
+# @param spool_dir          Directory in which to queue submissions when the server cannot be reached (the password must then be given in pwfile)
+# @param spool_only         Always queue submissions in spool_dir instead of sending them
 # @}
 class IUDatabase(ReporterMTTStage):
 
@@ -63,7 +111,27 @@ class IUDatabase(ReporterMTTStage):
         self.options['email'] = (None, "Email to which errors are to be sent")
         self.options['debug_screen'] = (False, "Print debug output to screen")
         self.options['dryrun'] = (False, "Print debug without actually submitting to database server")
+        self.options['max_results'] = (500, "Maximum number of test results to submit in a single request")
+        self.options['max_bytes'] = (4*1024*1024, "Maximum size in bytes of the test results submitted in a single request")
+        self.options['compress'] = (False, "Compress submissions with gzip (the server must support it)")
+        self.options['timeout'] = (None, "Seconds to wait for the server to reply")
+        self.options['upload_workers'] = (4, "Number of submissions to send to the server at once")
+        self.options['spool_dir'] = (None, "Directory in which to queue submissions when the server cannot be reached (the password must then be given in pwfile)")
+        self.options['spool_only'] = (False, "Always queue submissions in spool_dir instead of sending them")
         self.cmds = {}
+        # the requests of the current submission, kept in case
+        # they have to be spooled
+        self.requests = []
+        self.requestsLock = threading.Lock()
+        self.spooling = False
+        # the ids returned for the builds and installs submitted
+        # so far, keyed by phase and section
+        self.submitted = {}
+        self.submittedLock = threading.Lock()
+        self.auth = None
+        # how often and how patiently to try sending spooled requests
+        self.flushAttempts = 5
+        self.flushMaxDelay = 60
 
     def activate(self):
         # get the automatic procedure from IPlugin
@@ -102,12 +170,20 @@ class IUDatabase(ReporterMTTStage):
             log['status'] = 1
             log['stderr'] = "MTTDatabase Reporter section",log['section'] + ": if password, username, or realm is specified, they all must be specified."
             return
+        if self.cmds['spool_only'] and self.cmds['spool_dir'] is None:
+            log['status'] = 1
+            log['stderr'] = "MTTDatabase Reporter section " + log['section'] + ": spool_only requires a spool_dir"
+            return
+        # spooled submissions are sent later on, so the password
+        # has to be read from a file at that time
+        if 0 < sanity and self.cmds['spool_dir'] is not None and self.cmds['pwfile'] is None:
+            log['status'] = 1
+            log['stderr'] = "MTTDatabase Reporter section " + log['section'] + ": spool_dir requires the password to be given in a pwfile"
+            return
         try:
             if self.cmds['pwfile'] is not None:
                 if os.path.exists(self.cmds['pwfile']):
-                    f = open(self.cmds['pwfile'], 'r')
-                    password = f.readline().strip()
-                    f.close()
+                    password = self._read_pwfile(self.cmds['pwfile'])
                 else:
                     log['status'] = 1;
                     log['stderr'] = "Password file " + self.cmds['pwfile'] + " does not exist"
@@ -123,17 +199,31 @@ class IUDatabase(ReporterMTTStage):
         #
         # Setup the JSON data structure
         #
+        # keep a connection open for each of the upload workers
+        workers = max(1, self.cmds['upload_workers'])
         s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
         url = self.cmds['url'] + "/submit"
         if 0 < sanity and not self.cmds['dryrun']:
             www_auth = HTTPBasicAuth(self.cmds['username'], password)
+            # only the name and where the password is kept get spooled
+            self.auth = [self.cmds['username'],
+                         os.path.abspath(self.cmds['pwfile']) if self.cmds['pwfile'] is not None else None]
         else:
             www_auth = None
+            self.auth = None
+        self.requests = []
+        self.spooling = self.cmds['spool_only']
+        self.submitted = {}
+        if self.cmds['timeout'] is not None:
+            self.cmds['timeout'] = float(self.cmds['timeout'])
 
         # Get a client serial number
         if not self.cmds['dryrun']:
             client_serial = self._get_client_serial(s, self.cmds['url'], www_auth)
-            if client_serial < 0:
+            if isinstance(client_serial, int) and client_serial < 0:
                 print("Error: Unable to get a client serial (rtn=%d)" % (client_serial))
 
         headers = {}
@@ -156,13 +246,15 @@ class IUDatabase(ReporterMTTStage):
             metadata['trial'] = 0
 
         # Strategy:
-        # For each Test Run section
+        # For each Test Run section, up to upload_workers at a time
         #  - Find 'parent' Test Build
         #    - Find 'middleware' MiddlewareBuild (MPI Install)
         #      - Submit MPI Install phase
         #    - Submit Test Build phase
         #  - for each test run result
         #    - Submit Test Run phase
+        # Each Test Build and MPI Install is only submitted once,
+        # the Test Run sections that share it wait for its ids.
         # Backup strategy 1 (no test run for some reason):
         # - Find Testbuild
         #   - Find 'middleware' MiddlewareBuild (MPI Install)
@@ -189,43 +281,73 @@ class IUDatabase(ReporterMTTStage):
         except:
             pass;
 
-        #
-        # Process the test run sections
-        #
-        found_it = False
-        for lg in fullLog:
-            # Find sections prefixed with 'TestRun'
-            if re.match("TestRun", lg['section']):
-                found_it = True
-                rtn = self._submit_test_run(testDef.logger, lg, metadata, s, url, testDef, www_auth)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            #
+            # Process the test run sections
+            #
+            found_it = self._submit_all(pool, self._submit_test_run,
+                                        testDef.logger.getLogsOfStage("TestRun"),
+                                        metadata, s, url, testDef, www_auth)
 
-        #
-        # Well no TestRun section, so try TestBuild
-        #
-        if found_it == False:
-            for lg in fullLog:
-                # Find sections prefixed with 'TestBuild'
-                if re.match("TestBuild", lg['section']):
-                    found_it = True
-                    rtn = self._submit_test_build(testDef.logger, lg, metadata, s, url, testDef, www_auth)
-        #
-        # Well no TestBuild section found, so try MiddlewareBuild
-        #
-        if found_it == False:
-            for lg in fullLog:
-                # Find sections prefixed with 'MiddlewareBuild'
-                if re.match("MiddlewareBuild", lg['section']):
-                    found_it = True
-                    rtn = self._submit_install(testDef.logger, lg, metadata, s, url, testDef, www_auth)
+            #
+            # Well no TestRun section, so try TestBuild
+            #
+            if found_it == False:
+                found_it = self._submit_all(pool, self._submit_test_build,
+                                            testDef.logger.getLogsOfStage("TestBuild"),
+                                            metadata, s, url, testDef, www_auth)
+            #
+            # Well no TestBuild section found, so try MiddlewareBuild
+            #
+            if found_it == False:
+                found_it = self._submit_all(pool, self._submit_install,
+                                            testDef.logger.getLogsOfStage("MiddlewareBuild"),
+                                            metadata, s, url, testDef, www_auth)
+
+        if self.spooling:
+            self._spool()
 
         log['status'] = 0
         return
 
+    def _submit_all(self, pool, submit, logs, metadata, s, url, testDef, httpauth=None):
+        # submit each of the logged sections through the pool of
+        # upload workers, returning whether there were any
+        futures = [pool.submit(submit, testDef.logger, lg, metadata, s, url, testDef, httpauth) for lg in logs]
+        for f in futures:
+            f.result()
+        return 0 < len(futures)
+
+    def _submit_once(self, phase, lg, submit):
+        # submit a build or install the first time it is asked for and
+        # hand everyone else the ids it was given - waiting for them if
+        # the submission is still under way
+        key = (phase, lg['section'])
+        with self.submittedLock:
+            future = self.submitted.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.submitted[key] = future
+        if owner:
+            try:
+                future.set_result(submit())
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
     def _merge_dict(self, x, y):
         z = x.copy()
         z.update(y)
         return z
 
+    def _merge_logged(self, logger, key):
+        # merge the given entry, e.g. 'environ', of every result that has one
+        merged = {}
+        for lgentry in logger.getLogsWithKey(key):
+            merged.update(lgentry[key])
+        return merged
+
     def _submit_test_run(self, logger, lg, metadata, s, url, testDef, httpauth=None):
         try:
             if self.cmds['debug_screen']:
@@ -254,7 +376,7 @@ class IUDatabase(ReporterMTTStage):
         # Prepare to submit
         # JJH Todo fill these fields in
         #
-        metadata['phase'] = 'Test Run'
+        metadata = self._merge_dict(metadata, {'phase': 'Test Run'})
 
         common_data = {}
         #common_data['mpi_install_id'] = None
@@ -287,6 +409,15 @@ class IUDatabase(ReporterMTTStage):
         except:
             pass
 
+        # the same for every test
+        environment = self._merge_logged(logger, 'environ')
+        bios = self._merge_logged(logger, 'bios')
+        firmware = self._merge_logged(logger, 'firmware')
+        provisioning = self._merge_logged(logger, 'provisioning')
+        harasser = self._merge_logged(logger, 'harasser')
+
+        # the test results are collected and then submitted in batches
+        results = []
         for trun in (lg['testresults'] if 'testresults' in lg else [lg]):
             data = {}
 
@@ -339,7 +470,8 @@ class IUDatabase(ReporterMTTStage):
                 data['test_result'] = trun['result']
             except KeyError:
                 # if the test result wasn't provided, then this
-                # is an error and the data must be rejected
+                # is an error and the data must be rejected -
+                # none of the batch has been submitted yet
                 return None
 
             if data['test_result'] == testDef.MTT_TEST_PASSED:
@@ -347,14 +479,7 @@ class IUDatabase(ReporterMTTStage):
             elif data['test_result'] == testDef.MTT_TEST_FAILED:
                 data['result_message'] = "Failed"
                 if 'stderr' in lg:
-                    # the log should be a list, but it is possible
-                    # that it got joined into a single string
-                    # somewhere along the way - so handle both
-                    # cases here
-                    if type(lg['stderr']) is list:
-                        lgerr = '\n'.join(lg['stderr'])
-                    else:
-                        lgerr = lg['stderr']
+                    lgerr = self._join_lines(lg['stderr'])
                     if '[Errno' in lgerr:
                         try:
                             data['exit_value'] = int(lgerr.split("[Errno ")[1].split("]")[0])
@@ -367,10 +492,7 @@ class IUDatabase(ReporterMTTStage):
             elif data['test_result'] == testDef.MTT_TEST_TIMED_OUT:
                 data['result_message'] = "Timed Out"
                 if 'stderr' in lg:
-                    if type(lg['stderr']) is list:
-                        lgerr = '\n'.join(lg['stderr'])
-                    else:
-                        lgerr = lg['stderr']
+                    lgerr = self._join_lines(lg['stderr'])
                     if '[Errno' in lgerr:
                         try:
                             data['exit_value'] = int(lgerr.split("[Errno ")[1].split("]")[0])
@@ -405,18 +527,10 @@ class IUDatabase(ReporterMTTStage):
             # data['description'] = None
             data['description'] = self._extract_param(logger, 'MTTDefaults', 'description')
             # data['environment'] = None
-            environment = {}
-            for lgentry in logger.getLog(None):
-                if 'environ' in lgentry:
-                    environment.update(lgentry['environ'])
             data['environment'] = "\n".join([str(k) + "=" + str(v) for k,v in list(environment.items())])
 
 
             # BIOS table
-            bios = {}
-            for lgentry in logger.getLog(None):
-                if 'bios' in lgentry:
-                    bios.update(lgentry['bios'])
             try:
                 data['bios_nodelist'] = bios['nodelist']
                 data['bios_params'] = bios['params']
@@ -425,10 +539,6 @@ class IUDatabase(ReporterMTTStage):
                 pass
 
             # Firmware table (TODO: may want to grab whole cfg file)
-            firmware = {}
-            for lgentry in logger.getLog(None):
-                if 'firmware' in lgentry:
-                    firmware.update(lgentry['firmware'])
             try:
                 data['flashupdt_cfg'] = firmware['flashupdt_cfg']
                 data['firmware_nodelist'] = firmware['nodelist']
@@ -436,10 +546,6 @@ class IUDatabase(ReporterMTTStage):
                 pass
 
             # Provision table
-            provisioning = {}
-            for lgentry in logger.getLog(None):
-                if 'provisioning' in lgentry:
-                    provisioning.update(lgentry['provisioning'])
             try:
                 data['targets'] = provisioning['target']
                 data['image'] = provisioning['image']
@@ -449,10 +555,6 @@ class IUDatabase(ReporterMTTStage):
                 pass
 
             # Harasser table
-            harasser = {}
-            for lgentry in logger.getLog(None):
-                if 'harasser' in lgentry:
-                    harasser.update(lgentry['harasser'])
             try:
                 data['harasser_seed'] = harasser['seed']
                 data['inject_script'] = harasser['inject_script']
@@ -471,36 +573,33 @@ class IUDatabase(ReporterMTTStage):
                 data['merge_stdout_stderr'] = None
 
             try:
-                data['result_stdout'] = '\n'.join(trun['stdout'] if trun['stdout'] is not None else "")
+                data['result_stdout'] = self._join_lines(trun['stdout'])
             except KeyError:
                 data['result_stdout'] = None
 
             try:
-                if type(trun['stderr']) is list:
-                    result_stderr_str = '\n'.join(trun['stderr'] if trun['stderr'] is not None else "")
-                    data['result_stderr'] = result_stderr_str.replace("\x00", "\uFFFD")
-                else:
-                    result_stderr_str = (trun['stderr'] if trun['stderr'] is not None else "")
-                    data['result_stderr'] = result_stderr_str.replace("\x00", "\uFFFD")
+                result_stderr_str = self._join_lines(trun['stderr'])
+                data['result_stderr'] = result_stderr_str.replace("\x00", "\uFFFD")
             except KeyError:
                 data['result_stderr'] = None
 
-            #
-            # Submit
-            #
-            payload = {}
-            payload['metadata'] = metadata
-            payload['data'] = [data]
-
-            data = self._submit_json_data(payload, s, url, httpauth)
-            if data is None:
-                return None
-            if data['status'] != 0:
-                return None
+            results.append(data)
 
-        return True
+        #
+        # Submit
+        #
+        ids = self._submit_batches(results, metadata, s, url, httpauth)
+        if ids is None:
+            return None
+        return ids
 
     def _submit_test_build(self, logger, lg, metadata, s, url, testDef, httpauth=None):
+        if lg is None:
+            return None
+        return self._submit_once('Test Build', lg,
+                                 lambda: self._send_test_build(logger, lg, metadata, s, url, testDef, httpauth))
+
+    def _send_test_build(self, logger, lg, metadata, s, url, testDef, httpauth=None):
         try:
             if self.cmds['debug_screen']:
                 print("----------------- Test Build (%s) " % (lg['section']))
@@ -510,11 +609,9 @@ class IUDatabase(ReporterMTTStage):
             pass
 
         # Find 'middleware' MiddlewareBuild (MPI Install)
-        fullLog = logger.getLog(None)
-        for lg_b in fullLog:
-            # Find sections prefixed with 'MiddlewareBuild'
-            if re.match("MiddlewareBuild", lg_b['section']):
-                install_info = self._submit_install(logger, lg_b, metadata, s, url, testDef,  httpauth)
+        install_info = None
+        for lg_b in logger.getLogsOfStage("MiddlewareBuild"):
+            install_info = self._submit_install(logger, lg_b, metadata, s, url, testDef,  httpauth)
 
         if install_info is None:
             return None
@@ -530,7 +627,7 @@ class IUDatabase(ReporterMTTStage):
         # JJH Todo fill these fields in
         #
         data = {}
-        metadata['phase'] = 'Test Build'
+        metadata = self._merge_dict(metadata, {'phase': 'Test Build'})
 
         # For now assume that we only had one mpi_install submitted
         data['mpi_install_id'] = install_info['mpi_install_id']
@@ -540,13 +637,11 @@ class IUDatabase(ReporterMTTStage):
 #            data['compiler_version'] = "\n".join(lg['compiler']['version'])
             data['compiler_version'] = lg['compiler']['version']
         except KeyError:
-            full_log = logger.getLog(None)
-            for entry in full_log:
-                if 'compiler' in entry:
-                    data['compiler_name'] = entry['compiler']['compiler']
-#                    data['compiler_version'] = "\n".join(entry['compiler']['version'])
-                    data['compiler_version'] = entry['compiler']['version']
-                    break
+            for entry in logger.getLogsWithKey('compiler'):
+                data['compiler_name'] = entry['compiler']['compiler']
+#                data['compiler_version'] = "\n".join(entry['compiler']['version'])
+                data['compiler_version'] = entry['compiler']['version']
+                break
             else:
                 data['compiler_name'] = None
                 data['compiler_version'] = None
@@ -568,14 +663,7 @@ class IUDatabase(ReporterMTTStage):
             data['result_message'] = "Failed"
             data['test_result'] = testDef.MTT_TEST_FAILED
             if 'stderr' in lg:
-                # the log should be a list, but it is possible
-                # that it got joined into a single string
-                # somewhere along the way - so handle both
-                # cases here
-                if type(lg['stderr']) is list:
-                    lgerr = '\n'.join(lg['stderr'])
-                else:
-                    lgerr = lg['stderr']
+                lgerr = self._join_lines(lg['stderr'])
                 if '[Errno' in lgerr:
                     try:
                         data['exit_value'] = int(lgerr.split("[Errno ")[1].split("]")[0])
@@ -589,14 +677,7 @@ class IUDatabase(ReporterMTTStage):
             data['result_message'] = "Failed"
             data['test_result'] = testDef.MTT_TEST_FAILED
             if 'stderr' in lg:
-                # the log should be a list, but it is possible
-                # that it got joined into a single string
-                # somewhere along the way - so handle both
-                # cases here
-                if type(lg['stderr']) is list:
-                    lgerr = '\n'.join(lg['stderr'])
-                else:
-                    lgerr = lg['stderr']
+                lgerr = self._join_lines(lg['stderr'])
                 if '[Errno' in lgerr:
                     try:
                         data['exit_value'] = int(lgerr.split("[Errno ")[1].split("]")[0])
@@ -614,10 +695,7 @@ class IUDatabase(ReporterMTTStage):
         #data['description'] = None
         data['description'] = self._extract_param(logger, 'MTTDefaults', 'description')
         #data['environment'] = None
-        environment = {}
-        for lgentry in logger.getLog(None):
-            if 'environ' in lgentry:
-                environment.update(lgentry['environ'])
+        environment = self._merge_logged(logger, 'environ')
         data['environment'] = "\n".join([str(k) + "=" + str(v) for k,v in list(environment.items())])
 
         try:
@@ -629,15 +707,12 @@ class IUDatabase(ReporterMTTStage):
             data['merge_stdout_stderr'] = None
 
         try:
-            data['result_stdout'] = '\n'.join(lg['stdout'])
+            data['result_stdout'] = self._join_lines(lg['stdout'])
         except KeyError:
             data['result_stdout'] = None
 
         try:
-            if type(lg['stderr']) is list:
-                data['result_stderr'] = '\n'.join(lg['stderr'])
-            else:
-                data['result_stderr'] = lg['stderr']
+            data['result_stderr'] = self._join_lines(lg['stderr'])
         except KeyError:
             data['result_stderr'] = None
 
@@ -659,6 +734,10 @@ class IUDatabase(ReporterMTTStage):
                                  install_info)
 
     def _submit_install(self, logger, lg, metadata, s, url, testDef, httpauth=None):
+        return self._submit_once('MPI Install', lg,
+                                 lambda: self._send_install(logger, lg, metadata, s, url, testDef, httpauth))
+
+    def _send_install(self, logger, lg, metadata, s, url, testDef, httpauth=None):
 
         try:
             if self.cmds['debug_screen']:
@@ -691,7 +770,7 @@ class IUDatabase(ReporterMTTStage):
         # JJH Todo fill these fields in
         #
         data = {}
-        metadata['phase'] = 'MPI Install'
+        metadata = self._merge_dict(metadata, {'phase': 'MPI Install'})
 
         try:
             data['platform_hardware'] = "\n".join(profile['machineName'])
@@ -718,13 +797,11 @@ class IUDatabase(ReporterMTTStage):
 #            data['compiler_version'] = "\n".join(lg['compiler']['version'])
             data['compiler_version'] = lg['compiler']['version']
         except KeyError:
-            full_log = logger.getLog(None)
-            for entry in full_log:
-                if 'compiler' in entry:
-                    data['compiler_name'] = entry['compiler']['compiler']
-#                    data['compiler_version'] = "\n".join(entry['compiler']['version'])
-                    data['compiler_version'] = entry['compiler']['version']
-                    break
+            for entry in logger.getLogsWithKey('compiler'):
+                data['compiler_name'] = entry['compiler']['compiler']
+#                data['compiler_version'] = "\n".join(entry['compiler']['version'])
+                data['compiler_version'] = entry['compiler']['version']
+                break
             else:
                 data['compiler_name'] = None
                 data['compiler_version'] = None
@@ -733,12 +810,10 @@ class IUDatabase(ReporterMTTStage):
             data['mpi_name'] = lg['mpi_info']['name']
             data['mpi_version'] = lg['mpi_info']['version']
         except KeyError:
-            full_log = logger.getLog(None)
-            for entry in full_log:
-                if 'mpi_info' in entry:
-                    data['mpi_name'] = entry['mpi_info']['name']
-                    data['mpi_version'] = entry['mpi_info']['version']
-                    break
+            for entry in logger.getLogsWithKey('mpi_info'):
+                data['mpi_name'] = entry['mpi_info']['name']
+                data['mpi_version'] = entry['mpi_info']['version']
+                break
             else:
                 data['mpi_name'] = 'Undef'
                 data['mpi_version'] = 'Undef'
@@ -763,14 +838,7 @@ class IUDatabase(ReporterMTTStage):
             data['result_message'] = "Failed"
             data['test_result'] = testDef.MTT_TEST_FAILED
             if 'stderr' in lg:
-                # the log should be a list, but it is possible
-                # that it got joined into a single string
-                # somewhere along the way - so handle both
-                # cases here
-                if type(lg['stderr']) is list:
-                    lgerr = '\n'.join(lg['stderr'])
-                else:
-                    lgerr = lg['stderr']
+                lgerr = self._join_lines(lg['stderr'])
                 if '[Errno' in lgerr:
                     try:
                         data['exit_value'] = int(lgerr.split("[Errno ")[1].split("]")[0])
@@ -784,14 +852,7 @@ class IUDatabase(ReporterMTTStage):
             data['result_message'] = "Failed"
             data['test_result'] = testDef.MTT_TEST_FAILED
             if 'stderr' in lg:
-                # the log should be a list, but it is possible
-                # that it got joined into a single string
-                # somewhere along the way - so handle both
-                # cases here
-                if type(lg['stderr']) is list:
-                    lgerr = '\n'.join(lg['stderr'])
-                else:
-                    lgerr = lg['stderr']
+                lgerr = self._join_lines(lg['stderr'])
                 if '[Errno' in lgerr:
                     try:
                         data['exit_value'] = int(lgerr.split("[Errno ")[1].split("]")[0])
@@ -813,10 +874,7 @@ class IUDatabase(ReporterMTTStage):
         #data['description'] = None
         data['description'] = self._extract_param(logger, 'MTTDefaults', 'description')
         #data['environment'] = None
-        environment = {}
-        for lgentry in logger.getLog(None):
-            if 'environ' in lgentry:
-                environment.update(lgentry['environ'])
+        environment = self._merge_logged(logger, 'environ')
         data['environment'] = "\n".join([str(k) + "=" + str(v) for k,v in list(environment.items())])
 
         try:
@@ -828,15 +886,12 @@ class IUDatabase(ReporterMTTStage):
             data['merge_stdout_stderr'] = None
 
         try:
-            data['result_stdout'] = '\n'.join(lg['stdout'])
+            data['result_stdout'] = self._join_lines(lg['stdout'])
         except KeyError:
             data['result_stdout'] = None
 
         try:
-            if type(lg['stderr']) is list:
-                data['result_stderr'] = '\n'.join(lg['stderr'])
-            else:
-                data['result_stderr'] = lg['stderr']
+            data['result_stderr'] = self._join_lines(lg['stderr'])
         except KeyError:
             data['result_stderr'] = None
 
@@ -856,6 +911,48 @@ class IUDatabase(ReporterMTTStage):
         # Extract ID
         return {'mpi_install_id':data['ids'][0]['mpi_install_id']}
 
+    def _submit_batches(self, results, metadata, s, url, httpauth=None):
+        # submit the results in as few requests as max_results and
+        # max_bytes allow, all as part of the same submission. Returns
+        # the ids the server assigned, in the same order as the
+        # results, or None if a request failed
+        batches = []
+        batch = []
+        size = 0
+        for data in results:
+            length = len(json.dumps(data))
+            if batch and (len(batch) >= self.cmds['max_results'] or size + length > self.cmds['max_bytes']):
+                batches.append(batch)
+                batch = []
+                size = 0
+            batch.append(data)
+            size += length
+        if batch:
+            batches.append(batch)
+
+        ids = []
+        submit_id = None
+        for batch in batches:
+            payload = {}
+            payload['metadata'] = dict(metadata)
+            payload['metadata']['number_of_results'] = len(batch)
+            if submit_id is not None:
+                payload['metadata']['submit_id'] = submit_id
+            payload['data'] = batch
+
+            data = self._submit_json_data(payload, s, url, httpauth)
+            if data is None:
+                return None
+            if data['status'] != 0:
+                return None
+            # the server returns an id for each result, in order
+            if len(data['ids']) != len(batch):
+                print("Error: Submitted %d results but the server returned %d ids" % (len(batch), len(data['ids'])))
+                return None
+            submit_id = data['submit_id']
+            ids.extend(data['ids'])
+        return ids
+
     def _submit_json_data(self, payload, s, url, httpauth=None):
         headers = {}
         headers['content-type'] = 'application/json'
@@ -870,11 +967,43 @@ class IUDatabase(ReporterMTTStage):
         except:
             pass
 
-        r = s.post(url,
-                   data=json.dumps(payload),
-                   headers=headers,
-                   auth=httpauth,
-                   verify=False)
+        body = json.dumps(payload)
+        if self.cmds['spool_dir'] is not None:
+            # record a copy, as parts of the payload get reused
+            request = {'key': uuid.uuid4().hex, 'url': url, 'payload': json.loads(body), 'reply': None}
+            with self.requestsLock:
+                self.requests.append(request)
+                index = len(self.requests) - 1
+            headers['idempotency-key'] = request['key']
+        if self.cmds['compress']:
+            body = gzip.compress(body.encode('utf-8'))
+            headers['content-encoding'] = 'gzip'
+
+        r = None
+        spooled = self.spooling
+        if not spooled:
+            try:
+                r = s.post(url,
+                           data=body,
+                           headers=headers,
+                           auth=httpauth,
+                           verify=False,
+                           timeout=self.cmds['timeout'])
+            except requests.exceptions.RequestException as e:
+                if self.cmds['spool_dir'] is None:
+                    raise
+                print("Unable to reach %s (%s) - spooling the submission" % (url, str(e)))
+            if r is not None and r.status_code >= 500 and self.cmds['spool_dir'] is not None:
+                print("Server error %d from %s - spooling the submission" % (r.status_code, url))
+                r = None
+            if r is None:
+                # once one of the upload workers starts spooling the
+                # others follow, and the requests are spooled at the end
+                with self.requestsLock:
+                    self.spooling = True
+                spooled = True
+        if spooled:
+            return self._pending_reply(index, payload)
 
         try:
             if self.cmds['debug_screen']:
@@ -891,7 +1020,144 @@ class IUDatabase(ReporterMTTStage):
         if r.status_code != 200:
             return None
 
-        return r.json()
+        data = r.json()
+        if self.cmds['spool_dir'] is not None:
+            request['reply'] = data
+        return data
+
+    def _pending_reply(self, index, payload):
+        # stand in for the reply the spooled request will get
+        ids = [_PendingIds((index, 'ids', i)) for i in range(len(payload.get('data', [])))]
+        return {'status': 0,
+                'submit_id': _reply(index, 'submit_id'),
+                'client_serial': _reply(index, 'client_serial'),
+                'ids': ids}
+
+    def _spool(self):
+        # queue the requests of this submission that were not sent,
+        # along with the replies to those that were
+        spooldir = self.cmds['spool_dir']
+        job = {'auth': self.auth,
+               'compress': self.cmds['compress'],
+               'requests': self.requests}
+        name = "%s-%s.json" % (datetime.utcnow().strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+        try:
+            os.makedirs(spooldir, exist_ok=True)
+            # only readable by us, as it holds the results
+            fd, tmp = tempfile.mkstemp(dir=spooldir, prefix=".spool-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(job, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, os.path.join(spooldir, name))
+        except OSError as e:
+            print("Error: Unable to spool the submission to %s: %s" % (spooldir, str(e)))
+            return
+        unsent = len([r for r in self.requests if r['reply'] is None])
+        print("Spooled %d requests to %s" % (unsent, os.path.join(spooldir, name)))
+
+    def flushSpool(self, spooldir, workers=4):
+        """Send the submissions queued in the spool directory, several
+        at a time. Returns 0 if all of them were sent, 1 otherwise
+        """
+        jobs = sorted(glob.glob(os.path.join(spooldir, "*.json")))
+        if not jobs:
+            print("No spooled submissions in " + spooldir)
+            return 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            sent = list(pool.map(self._flush_job, jobs))
+        print("Sent %d of %d spooled submissions" % (sent.count(True), len(jobs)))
+        return 0 if all(sent) else 1
+
+    def _flush_job(self, path):
+        try:
+            f = open(path, "r")
+        except OSError:
+            # already sent by someone else
+            return True
+        with f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # someone else is sending it
+                return True
+            if not os.path.exists(path):
+                return True
+            job = json.load(f)
+            # the replies received by an earlier attempt that got cut short
+            progress = path + ".progress"
+            replies = {}
+            try:
+                with open(progress, "r") as pf:
+                    for line in pf:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            break
+                        replies[entry['index']] = entry['reply']
+            except OSError:
+                pass
+            s = requests.Session()
+            auth = None
+            if job['auth']:
+                username, pwfile = job['auth']
+                try:
+                    auth = HTTPBasicAuth(username, self._read_pwfile(pwfile))
+                except (OSError, TypeError):
+                    print("Unable to read the password for %s from %s - leaving it in the spool" % (path, pwfile))
+                    return False
+            with open(progress, "a") as pf:
+                for i,request in enumerate(job['requests']):
+                    if request['reply'] is None and i in replies:
+                        request['reply'] = replies[i]
+                    if request['reply'] is not None:
+                        continue
+                    payload = _resolve(request['payload'], job['requests'])
+                    reply = self._send_spooled(s, request, payload, auth, job['compress'])
+                    if reply is None:
+                        print("Unable to send %s - leaving it in the spool" % path)
+                        return False
+                    if reply['status'] != 0:
+                        # the server won't take it, so retrying is pointless
+                        print("Server rejected %s: %s" % (path, reply.get('status_message')))
+                        os.replace(path, path[:-len(".json")] + ".failed")
+                        return False
+                    request['reply'] = reply
+                    pf.write(json.dumps({'index': i, 'reply': reply}) + "\n")
+                    pf.flush()
+                    os.fsync(pf.fileno())
+            os.remove(path)
+            os.remove(progress)
+        return True
+
+    def _read_pwfile(self, pwfile):
+        with open(pwfile, 'r') as f:
+            return f.readline().strip()
+
+    def _send_spooled(self, s, request, payload, auth, compress):
+        headers = {}
+        headers['content-type'] = 'application/json'
+        # lets the server recognize a request it already stored
+        headers['idempotency-key'] = request['key']
+        body = json.dumps(payload)
+        if compress:
+            body = gzip.compress(body.encode('utf-8'))
+            headers['content-encoding'] = 'gzip'
+        delay = 1
+        for attempt in range(self.flushAttempts):
+            if attempt:
+                time.sleep(delay * (1 + random.random()))
+                delay = min(delay * 2, self.flushMaxDelay)
+            try:
+                r = s.post(request['url'], data=body, headers=headers, auth=auth,
+                           verify=False, timeout=self.flushMaxDelay)
+            except requests.exceptions.RequestException:
+                continue
+            if r.status_code == 200:
+                return r.json()
+            if r.status_code < 500:
+                return {'status': -1, 'status_message': "HTTP %d %s" % (r.status_code, r.reason)}
+        return None
 
     def _extract_param(self, logger, section, parameter):
         found = logger.getLog(section)
@@ -66,11 +66,11 @@ class JunitXML(ReporterMTTStage):
         time = 0
         for lg in fullLog:
             if 'stdout' in lg and lg['stdout'] is not None:
-                stdout = "\n".join(lg['stdout'])
+                stdout = self._join_lines(lg['stdout'])
             else:
                 stdout = None
             if 'stderr' in lg and lg['stderr'] is not None:
-                stderr = "\n".join(lg['stderr'])
+                stderr = self._join_lines(lg['stderr'])
             else:
                 stderr = None
             if 'time' in lg and lg['time'] is not None:
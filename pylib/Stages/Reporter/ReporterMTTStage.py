@@ -25,3 +25,15 @@ class ReporterMTTStage(IPlugin):
 
     def ordering(self):
         return 600
+
+    def _join_lines(self, lines):
+        # output is normally a list of lines, but it may have been
+        # joined into a single string along the way, or spilled to
+        # disk by ExecuteCmd - in which case it can read itself back
+        if lines is None:
+            return ""
+        if isinstance(lines, str):
+            return lines
+        if hasattr(lines, 'text'):
+            return lines.text()
+        return '\n'.join(lines)
@@ -24,6 +24,8 @@ from TestBuildMTTStage import *
 # @param merge_stdout_stderr       Merge stdout and stderr into one output stream
 # @param stdout_save_lines         Number of lines of stdout to save
 # @param stderr_save_lines         Number of lines of stderr to save
+# @param stdout_save_head_lines    Number of lines from the start of stdout to save in addition to the last stdout_save_lines lines
+# @param stderr_save_head_lines    Number of lines from the start of stderr to save in addition to the last stderr_save_lines lines
 # @param autogen_cmd               Command to be executed to setup the configure script, usually called autogen.sh or autogen.pl
 # @param configure_options         Options to be passed to configure. Note that the prefix will be automatically set and need not be provided here
 # @param make_options              Options to be passed to the make command
@@ -42,6 +44,8 @@ class DefaultTestBuild(TestBuildMTTStage):
         self.options['merge_stdout_stderr'] = (False, "Merge stdout and stderr into one output stream")
         self.options['stdout_save_lines'] = (None, "Number of lines of stdout to save")
         self.options['stderr_save_lines'] = (None, "Number of lines of stderr to save")
+        self.options['stdout_save_head_lines'] = (None, "Number of lines from the start of stdout to save in addition to the last stdout_save_lines lines")
+        self.options['stderr_save_head_lines'] = (None, "Number of lines from the start of stderr to save in addition to the last stderr_save_lines lines")
         self.options['autogen_cmd'] = (None, "Command to be executed to setup the configure script, usually called autogen.sh or autogen.pl")
         self.options['configure_options'] = (None, "Options to be passed to configure. Note that the prefix will be automatically set and need not be provided here")
         self.options['make_options'] = (None, "Options to be passed to the make command")
@@ -145,11 +149,7 @@ class DefaultTestBuild(TestBuildMTTStage):
         except KeyError:
             pass
         # use the Autotools plugin to execute the build
-        plugin = None
-        for pluginInfo in testDef.tools.getPluginsOfCategory("Build"):
-            if "Autotools" == pluginInfo.plugin_object.print_name():
-                plugin = pluginInfo.plugin_object
-                break
+        plugin = testDef.selectPlugin("Autotools", "tool")
         if plugin is None:
             log['status'] = 1
             log['stderr'] = "Autotools plugin not found"
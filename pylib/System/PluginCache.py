@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015-2019 Intel, Inc.  All rights reserved.
+# $COPYRIGHT$
+#
+# Additional copyrights may follow
+#
+# $HEADER$
+#
+
+from builtins import object
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import configparser
+from yapsy import log, NormalizePluginNameForModuleName
+from yapsy.PluginInfo import PluginInfo
+from yapsy.PluginManager import PluginManager
+from yapsy.IPluginLocator import IPluginLocator
+
+
+def _details(entry):
+    details = configparser.ConfigParser()
+    details.read_dict(entry['details'])
+    return details
+
+
+# The PluginInfo of a plugin recorded in the cache. Its module is not
+# imported, nor its plugin object created, until the first time the
+# plugin object is asked for - so plugins a run never uses cost nothing.
+# The name the plugin prints is available as printName without loading it.
+class LazyPluginInfo(PluginInfo):
+    def __init__(self, entry, plugin_object=None):
+        PluginInfo.__init__(self, entry['name'], entry['path'])
+        self.details = _details(entry)
+        self.categories.append(entry['category'])
+        self.className = entry['class']
+        self.printName = entry['print_name']
+        self.plugin_object = plugin_object
+
+    def _getPluginObject(self):
+        if not self.loaded:
+            self.loaded = True
+            self._plugin_object = self._load()
+        return self._plugin_object
+
+    def _setPluginObject(self, plugin_object):
+        self._plugin_object = plugin_object
+        self.loaded = plugin_object is not None
+
+    plugin_object = property(fget=_getPluginObject, fset=_setPluginObject)
+
+    def _load(self):
+        # import the module under a unique name, as yapsy does
+        template = NormalizePluginNameForModuleName("yapsy_loaded_plugin_" + self.name) + "_%d"
+        suffix = 0
+        while template % suffix in sys.modules:
+            suffix += 1
+        path = self.path
+        if "__init__" in os.path.basename(path):
+            path = os.path.dirname(path)
+        try:
+            module = PluginManager._importModule(template % suffix, path)
+            return getattr(module, self.className)()
+        except Exception:
+            self.error = sys.exc_info()
+            log.error("Unable to load plugin: %s" % self.path, exc_info=self.error)
+            return None
+
+    def _getIsActivated(self):
+        # a plugin that was never created was never activated
+        if not self.loaded or self._plugin_object is None:
+            return False
+        return self._plugin_object.is_activated
+
+    is_activated = property(fget=_getIsActivated)
+
+
+# Hands a plugin manager the candidates recorded in the manifest
+# in place of walking the plugin dirs for them
+class CachedPluginLocator(IPluginLocator):
+    def __init__(self, candidates):
+        IPluginLocator.__init__(self)
+        self.candidates = candidates
+
+    def locatePlugins(self):
+        return self.candidates[:], len(self.candidates)
+
+
+# The plugin cache records what a scan of the plugin dirs found - the
+# class files loaded by LoadClasses and, for each plugin, its category
+# and the files it came from - so that later runs can skip walking the
+# plugin dirs and only import the plugins they use. The manifest is
+# only used if none of the directories or files it was built from
+# have changed since.
+class PluginCache(object):
+    version = 1
+
+    def __init__(self, cachedir, plugindirs):
+        self.plugindirs = [os.path.abspath(d) for d in plugindirs]
+        key = hashlib.sha1(os.pathsep.join(self.plugindirs).encode()).hexdigest()[:16]
+        self.cachedir = cachedir
+        self.path = os.path.join(cachedir, "plugins-" + key + ".json")
+        self.manifest = None
+        # the plugins recorded so far and those that failed to load,
+        # keyed by their info file
+        self.plugins = {}
+        self.failed = {}
+        # plugin objects already created while scanning
+        self.objects = {}
+        # whether the manifest needs to be (re)written
+        self.dirty = True
+
+    def print_name(self):
+        return "PluginCache"
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self):
+        """Read the manifest for our plugin dirs, returning it if it
+        is still current and None if the plugins must be rescanned
+        """
+        try:
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != self.version or manifest.get('plugindirs') != self.plugindirs:
+            return None
+        # any file added to or removed from a plugin dir changes the
+        # mtime of its directory, so checking the recorded directories
+        # and files is enough to catch every change
+        for path, mtime in manifest['stamps'].items():
+            if self._mtime(path) != mtime:
+                return None
+        self.manifest = manifest
+        self.plugins = {e['infofile']: e for e in manifest['plugins'] if e['group'] is not None}
+        self.dirty = False
+        return manifest
+
+    def locator(self):
+        """Return a yapsy plugin locator for the plugins that could
+        not be loaded last time, so that a plugin manager can see if
+        they now can be
+        """
+        candidates = []
+        for entry in self.manifest['plugins']:
+            if entry['group'] is None:
+                info = PluginInfo(entry['name'], entry['path'])
+                info.details = _details(entry)
+                candidates.append((entry['infofile'], entry['path'], info))
+        return CachedPluginLocator(candidates)
+
+    def record(self, group, candidates):
+        """Record the plugins a manager of the given group loaded
+        from the candidates it located
+        """
+        for infofile, path, info in candidates:
+            if info.plugin_object is None or not info.categories:
+                if info.error is not None:
+                    self.failed[infofile] = self._entry(None, infofile, info)
+                continue
+            entry = self._entry(group, infofile, info)
+            entry['category'] = info.categories[0]
+            entry['class'] = info.plugin_object.__class__.__name__
+            entry['print_name'] = info.plugin_object.print_name()
+            self.plugins[infofile] = entry
+            self.objects[infofile] = info.plugin_object
+            self.dirty = True
+
+    def populate(self, manager, group):
+        """Fill a plugin manager of the given group with the plugins
+        recorded for it, replacing any it loaded itself
+        """
+        for category in manager.getCategories():
+            for info in manager.getPluginsOfCategory(category):
+                manager.removePluginFromCategory(info, category)
+        for infofile, entry in self.plugins.items():
+            if entry['group'] == group:
+                info = LazyPluginInfo(entry, self.objects.get(infofile))
+                manager.appendPluginToCategory(info, entry['category'])
+
+    def _entry(self, group, infofile, info):
+        return {'group': group,
+                'name': info.name,
+                'infofile': infofile,
+                'path': info.path,
+                'details': {s: dict(info.details.items(s)) for s in info.details.sections()}}
+
+    def save(self, loader):
+        """Write the manifest for what the plugin managers recorded"""
+        plugins = list(self.plugins.values())
+        plugins.extend(e for f, e in self.failed.items() if f not in self.plugins)
+        stamps = {}
+        for d in self.plugindirs:
+            for dirpath, dirnames, filenames in os.walk(d, followlinks=True):
+                stamps[dirpath] = self._mtime(dirpath)
+        for filename in loader.files:
+            stamps[filename] = self._mtime(filename)
+        for entry in plugins:
+            stamps[entry['infofile']] = self._mtime(entry['infofile'])
+            stamps[entry['path'] + ".py"] = self._mtime(entry['path'] + ".py")
+        manifest = {'version': self.version,
+                    'plugindirs': self.plugindirs,
+                    'classes': loader.files,
+                    'plugins': plugins,
+                    'stamps': stamps}
+        # write it atomically as other runs may be reading it
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cachedir, prefix=".plugins-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print("Unable to save the plugin cache " + self.path + ": " + str(e))
+            return
+        self.manifest = manifest
+        self.dirty = False
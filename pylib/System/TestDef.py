@@ -23,11 +23,113 @@ import datetime
 from distutils.spawn import find_executable
 from threading import Semaphore
 from pathlib import Path
+from collections.abc import Sequence
+import glob
 import json
 
 is_py2 = sys.version[0] == '2'
 
 
+# The hidden LOG section of the test configuration. Rather than
+# flattening every logged result into it before each section, results
+# are only flattened the first time one of their keys is looked up,
+# which is when an INI file interpolates ${LOG:...}
+class LogSection(dict):
+    def __init__(self, testDef, *args):
+        dict.__init__(self, *args)
+        self.testDef = testDef
+        # what the test definition itself put in the section
+        self.initial = dict(*args)
+        # results not yet flattened, keyed by the name of the section
+        # that logged them as used in the LOG keys
+        self.pending = {}
+        self.filled = set()
+        self.count = 0
+        # sequences not worth flattening, e.g. command output spilled
+        # to a file, keyed by their LOG key. Their lines are only read
+        # when a key refers to them
+        self.sequences = {}
+
+    def addSequence(self, key, sequence):
+        # forget whatever was looked up from a previous value
+        for k in [k for k in dict.keys(self) if k == key or k.startswith(key + ".")]:
+            dict.__delitem__(self, k)
+        self.sequences[key] = sequence
+
+    def fillSequence(self, key):
+        if key in self.sequences:
+            value = json.dumps(list(self.sequences[key]), default=str)
+        else:
+            base, _, index = key.rpartition(".")
+            sequence = self.sequences.get(base)
+            if sequence is None or not index.isdigit() or int(index) >= len(sequence):
+                return
+            value = str(sequence[int(index)])
+        dict.__setitem__(self, key, value.replace("$","$$"))
+
+    def add(self, result):
+        base = result['section'].replace(":","_")
+        if base in self.filled:
+            # its keys are already in use, so keep them current
+            self.testDef.fill_log_interpolation(base, result)
+        else:
+            self.pending.setdefault(base, []).append((self.count, result))
+        self.count += 1
+
+    def fill(self, key=None):
+        # LOG keys are the section name followed by a dotted path into
+        # its results - flatten whatever results the key could belong
+        # to, or all of them if no key is given
+        if key is None:
+            bases = list(self.pending.keys())
+        else:
+            parts = key.split(".")
+            bases = [".".join(parts[:i]) for i in range(1, len(parts) + 1)]
+        results = []
+        for base in bases:
+            if base in self.pending:
+                results.extend((n, base, result) for n, result in self.pending.pop(base))
+                self.filled.add(base)
+        # in the order they were logged so later results win
+        for n, base, result in sorted(results, key=lambda r: r[0]):
+            self.testDef.fill_log_interpolation(base, result)
+
+    def __missing__(self, key):
+        self.fill(key)
+        if not dict.__contains__(self, key):
+            self.fillSequence(key)
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            self.fill(key)
+        if not dict.__contains__(self, key):
+            self.fillSequence(key)
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self.fill()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.fill()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.fill()
+        return dict.keys(self)
+
+    def values(self):
+        self.fill()
+        return dict.values(self)
+
+    def items(self):
+        self.fill()
+        return dict.items(self)
+
+
 # The Test Definition class is mostly a storage construct
 # to make it easier when passing values across stages and
 # tools.
@@ -69,14 +171,25 @@ class TestDef(object):
         self.module_load = {}
         self.module_swap = {}
         self.execmd = None
+        self.asyncmd = None
         self.harasser = None
         self.config = None
         self.stages = None
         self.tools = None
         self.utilities = None
+        # the plugins of all three managers, indexed by the
+        # name they print
+        self.pluginIndex = {}
         self.defaults = None
         self.log = {}
+        # what the hidden ENV and LOG sections were last filled from
+        self.envFilled = {}
+        self.logFilled = (None, 0, 0)
         self.watchdog = None
+        self.scheduler = None
+        # how many executeTest() calls are under way - an executor
+        # may execute its combinations with calls of its own
+        self.executing = 0
         self.plugin_trans_sem = Semaphore()
         # provide a signature to differentiate this MTT execution
         # from any other that might be executed in parallel with it
@@ -277,17 +390,35 @@ class TestDef(object):
                 # class definition
                 plugindirs.insert(0, y)
 
-        # Load plugins from each of the specified plugin dirs
-        for dirPath in plugindirs:
-            if not Path(dirPath).exists():
-                print("Attempted to load plugins from non-existent path:", dirPath)
-                continue
-            try:
-                self.loader.load(dirPath)
-            except Exception as e:
-                print("Exception caught while loading plugins:")
-                print(e)
-                sys.exit(1)
+        # see if a previous scan of these plugin dirs left us a
+        # manifest of what they contain that is still current
+        try:
+            m = imp.load_source("PluginCache", os.path.join(basedir, "PluginCache.py"));
+        except ImportError:
+            print("ERROR: unable to load PluginCache that must contain the plugin cache object")
+            sys.exit(1)
+        cachedir = self.options.get('plugincache')
+        if not cachedir:
+            cachedir = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                                    os.path.join(os.path.expanduser("~"), ".cache"), "mtt")
+        cache = getattr(m, "PluginCache")(cachedir, [d for d in plugindirs if Path(d).exists()])
+        if not self.options.get('noplugincache'):
+            # leaves cache.manifest as None if we need to rescan
+            cache.load()
+        if cache.manifest is not None:
+            self.loader.loadFiles(cache.manifest['classes'])
+        else:
+            # Load plugins from each of the specified plugin dirs
+            for dirPath in plugindirs:
+                if not Path(dirPath).exists():
+                    print("Attempted to load plugins from non-existent path:", dirPath)
+                    continue
+                try:
+                    self.loader.load(dirPath)
+                except Exception as e:
+                    print("Exception caught while loading plugins:")
+                    print(e)
+                    sys.exit(1)
 
         # Build plugin managers,
         # class yapsy.PluginManager.PluginManager(categories_filter=None,
@@ -302,7 +433,7 @@ class TestDef(object):
         # adding or removing a plugin directory.
         self.stages.setCategoriesFilter(self.loader.stages)
         # Load all plugins we find there
-        self.stages.collectPlugins()
+        self._collectPlugins(self.stages, "stages", cache)
 
         # Build the tools plugin manager - tools differ from sections
         # in that they are plugins we will use to execute the various
@@ -318,7 +449,7 @@ class TestDef(object):
         # system being managed by a different RM.
         self.tools.setCategoriesFilter(self.loader.tools)
         # Load all the tool plugins
-        self.tools.collectPlugins()
+        self._collectPlugins(self.tools, "tools", cache)
         # Tool plugins are required to provide a function we can
         # probe to determine if they are capable of operating - check
         # those now and prune those tools that cannot support this
@@ -329,33 +460,50 @@ class TestDef(object):
         # Get the list of available utilities.
         self.utilities.setCategoriesFilter(self.loader.utilities)
         # Load all the utility plugins
-        self.utilities.collectPlugins()
+        self._collectPlugins(self.utilities, "utilities", cache)
+
+        # record what we found for the next run
+        if cache.dirty and not self.options.get('noplugincache'):
+            cache.save(self.loader)
+
+        # index the plugins by name so that finding the one a
+        # section asks for doesn't require scanning them all
+        self._indexPlugins()
 
         # since we use these all over the place, find the
         # ExecuteCmd and ModuleCmd plugins and record them
-        availUtil = list(self.loader.utilities.keys())
-        for util in availUtil:
-            for pluginInfo in self.utilities.getPluginsOfCategory(util):
-                if "ExecuteCmd" == pluginInfo.plugin_object.print_name():
-                    self.execmd = pluginInfo.plugin_object
-                elif "ModuleCmd" == pluginInfo.plugin_object.print_name():
-                    self.modcmd = pluginInfo.plugin_object
-                    # initialize this module
-                    self.modcmd.setCommand(self.options)
-                elif "Watchdog" == pluginInfo.plugin_object.print_name():
-                    self.watchdog = pluginInfo.plugin_object
-                if self.execmd is not None and self.modcmd is not None and self.watchdog is not None:
-                    break
+        self.execmd = self.selectPlugin("ExecuteCmd", "utility")
+        self.modcmd = self.selectPlugin("ModuleCmd", "utility")
+        if self.modcmd is not None:
+            # initialize this module
+            self.modcmd.setCommand(self.options)
+        self.watchdog = self.selectPlugin("Watchdog", "utility")
+        self.scheduler = self.selectPlugin("TimeoutScheduler", "utility")
         if self.execmd is None:
             print("ExecuteCmd plugin was not found")
             print("This is a basic capability required")
             print("for MTT operations - cannot continue")
             sys.exit(1)
+        # the asyncio based AsyncExecuteCmd can stand in for ExecuteCmd,
+        # which still prepares the commands and assembles the results.
+        # It is only created when asked for
+        if self.options.get('async_execmd'):
+            self.asyncmd = self.selectPlugin("AsyncExecuteCmd", "utility")
+            if self.asyncmd is None:
+                print("AsyncExecuteCmd plugin was not found")
+                print("cannot continue")
+                sys.exit(1)
+            self.asyncmd.setExecuteCmd(self.execmd)
+            self.execmd = self.asyncmd
+        if self.scheduler is None:
+            print("TimeoutScheduler plugin was not found")
+            print("This is required to enforce command timeouts")
+            print("cannot continue")
+            sys.exit(1)
         # Configure harasser plugin
-        for pluginInfo in self.tools.getPluginsOfCategory("Harasser"):
-            if "Harasser" == pluginInfo.plugin_object.print_name():
-                self.harasser = pluginInfo.plugin_object
-                break
+        pluginInfo = self.findPlugin("Harasser", "tools", "Harasser")[1]
+        if pluginInfo is not None:
+            self.harasser = pluginInfo.plugin_object
         if self.harasser is None:
             print("Harasser plugin was not found")
             print("This is required for all TestRun plugins")
@@ -370,6 +518,40 @@ class TestDef(object):
 
         return
 
+    def _collectPlugins(self, manager, group, cache):
+        # walk the plugin dirs and load what we find there - unless the
+        # cache already knows what they hold, in which case we only have
+        # to retry the plugins that could not be loaded last time
+        if cache.manifest is not None:
+            manager.setPluginLocator(cache.locator())
+        manager.locatePlugins()
+        candidates = manager.getPluginCandidates()
+        manager.loadPlugins()
+        cache.record(group, candidates)
+        # hand the manager the recorded plugins, which are only
+        # created when first used
+        cache.populate(manager, group)
+
+    def _indexPlugins(self):
+        self.pluginIndex = {}
+        for group, manager, categories in (("stages", self.stages, self.loader.stages),
+                                           ("tools", self.tools, self.loader.tools),
+                                           ("utilities", self.utilities, self.loader.utilities)):
+            for category in categories:
+                for pluginInfo in manager.getPluginsOfCategory(category):
+                    self.pluginIndex.setdefault(pluginInfo.printName, []).append((group, category, pluginInfo))
+
+    def findPlugin(self, name, group=None, category=None):
+        """Return the (category, pluginInfo) of the first plugin that
+        prints the given name, optionally limited to one group of plugins
+        ("stages", "tools" or "utilities") and one category of that group.
+        Returns (None, None) if there is no such plugin
+        """
+        for g, c, pluginInfo in self.pluginIndex.get(name, ()):
+            if (group is None or group == g) and (category is None or category == c):
+                return c, pluginInfo
+        return None, None
+
     def printInfo(self):
         # Print the available MTT sections out, if requested
         if self.options['listsections']:
@@ -391,7 +573,7 @@ class TestDef(object):
                 print(section + ":")
                 try:
                     for pluginInfo in self.stages.getPluginsOfCategory(section):
-                        print("    " + pluginInfo.plugin_object.print_name())
+                        print("    " + pluginInfo.printName)
                 except KeyError:
                     print("    Invalid stage name " + section)
                 print()
@@ -409,7 +591,7 @@ class TestDef(object):
                 print(section + ":")
                 try:
                     for pluginInfo in self.stages.getPluginsOfCategory(section):
-                        print("    " + pluginInfo.plugin_object.print_name() + ":")
+                        print("    " + pluginInfo.printName + ":")
                         pluginInfo.plugin_object.print_options(self, "        ")
                 except KeyError:
                     print("    Invalid stage name " + section)
@@ -437,7 +619,7 @@ class TestDef(object):
                 print(tool + ":")
                 try:
                     for pluginInfo in self.tools.getPluginsOfCategory(tool):
-                        print("    " + pluginInfo.plugin_object.print_name())
+                        print("    " + pluginInfo.printName)
                 except KeyError:
                     print("    Invalid tool type name",tool)
                 print()
@@ -455,7 +637,7 @@ class TestDef(object):
                 print(tool + ":")
                 try:
                     for pluginInfo in self.tools.getPluginsOfCategory(tool):
-                        print("    " + pluginInfo.plugin_object.print_name() + ":")
+                        print("    " + pluginInfo.printName + ":")
                         pluginInfo.plugin_object.print_options(self, "        ")
                 except KeyError:
                     print("    Invalid tool type name " + tool)
@@ -483,7 +665,7 @@ class TestDef(object):
                 print(util + ":")
                 try:
                     for pluginInfo in self.utilities.getPluginsOfCategory(util):
-                        print("    " + pluginInfo.plugin_object.print_name())
+                        print("    " + pluginInfo.printName)
                 except KeyError:
                     print("    Invalid utility type name")
                 print()
@@ -501,7 +683,7 @@ class TestDef(object):
                 print(util + ":")
                 try:
                     for pluginInfo in self.utilities.getPluginsOfCategory(util):
-                        print("    " + pluginInfo.plugin_object.print_name() + ":")
+                        print("    " + pluginInfo.printName + ":")
                         pluginInfo.plugin_object.print_options(self, "        ")
                 except KeyError:
                     print("    Invalid utility type name " + util)
@@ -541,6 +723,13 @@ class TestDef(object):
             self.fill_log_interpolation("%s.keys" % basestr, list(sublog.keys()))
             for k,v in list(sublog.items()):
                 self.fill_log_interpolation("%s.%s" % (basestr, k), v)
+        elif isinstance(sublog, Sequence) and not isinstance(sublog, (list, tuple, bytes, bytearray)) \
+             and isinstance(self.config._sections.get('LOG'), LogSection):
+            # e.g., command output that was spilled to a file - rather
+            # than reading it all in, leave its lines to be looked up
+            self.config._sections['LOG'].addSequence(self.config.optionxform(basestr), sublog)
+            self.fill_log_interpolation("%s.length" % basestr, str(len(sublog)))
+            self.fill_log_interpolation("%s.size" % basestr, str(len(sublog)))
         elif isinstance(sublog, list):
             if sum([((isinstance(t, list) or isinstance(t, tuple)) and len(t) == 2) for t in sublog]) == len(sublog) and len(sublog) > 0:
                 self.fill_log_interpolation(basestr, {k:v for k,v in sublog})
@@ -595,25 +784,44 @@ class TestDef(object):
         return sections + expsec
 
     def fill_env_hidden_section(self):
-        """fill ENV section with environment variables
+        """fill ENV section with environment variables, only setting
+        those that changed since it was last filled
         """
         try:
             self.config.add_section('ENV')
+            self.envFilled = {}
         except configparser.DuplicateSectionError:
             pass
-        for k,v in list(os.environ.items()):
-            self.config.set('ENV', k, v.replace("$","$$"))
+        env = dict(os.environ)
+        if env == self.envFilled:
+            return
+        for k,v in env.items():
+            if self.envFilled.get(k) != v:
+                self.config.set('ENV', k, v.replace("$","$$"))
+        self.envFilled = env
 
     def fill_log_hidden_section(self):
-        """Add LOG section filled with log results of stages
+        """Add LOG section filled with log results of stages, adding
+        only the results logged since it was last filled
         """
-        try:
-            self.config.add_section('LOG')
-        except configparser.DuplicateSectionError:
-            pass
         thefulllog = self.logger.getLog(None)
-        for e in thefulllog:
-            self.fill_log_interpolation(e['section'].replace(":","_"), e)
+        reordered = self.logger.reordered
+        section = self.config._sections.get('LOG')
+        # start over if the log was replaced, shrunk or reordered
+        if not isinstance(section, LogSection) or thefulllog is not self.logFilled[0] \
+           or len(thefulllog) < self.logFilled[1] or reordered != self.logFilled[2]:
+            if section is None:
+                self.config.add_section('LOG')
+                section = {}
+            elif isinstance(section, LogSection):
+                section = section.initial
+            # keep anything the test definition put in it
+            self.config._sections['LOG'] = LogSection(self, section)
+            self.logFilled = (thefulllog, 0, reordered)
+        section = self.config._sections['LOG']
+        for e in thefulllog[self.logFilled[1]:]:
+            section.add(e)
+        self.logFilled = (thefulllog, len(thefulllog), reordered)
 
     def check_for_nondefined_env_variables(self):
         # Check for ENV input
@@ -762,6 +970,20 @@ class TestDef(object):
                 self.logger.verbose_print(self.config.items(section))
         return
 
+    def configSections(self, sections):
+        # replace the configuration with the given sections, each
+        # a dict of option values that have already been interpolated
+        for section in self.config.sections():
+            self.config.remove_section(section)
+        for section, options in sections.items():
+            self.config.add_section(section)
+            for option, value in options.items():
+                self.config.set(section, option, value.replace("$", "$$"))
+            if self.logger is not None:
+                self.logger.verbose_print("SECTION: " + section)
+                self.logger.verbose_print(self.config.items(section))
+        return
+
     def executeTest(self, executor="sequential"):
         self.logger.print_cmdline_args(self)
 
@@ -778,7 +1000,22 @@ class TestDef(object):
         self.tools.activatePluginByName(executor, "Executor")
         # execute the provided test description
         executor = self.tools.getPluginByName(executor, "Executor")
-        status = executor.plugin_object.execute(self)
+        self.executing += 1
+        try:
+            status = executor.plugin_object.execute(self)
+        finally:
+            self.executing -= 1
+        # only clean up once everything has been executed and reported -
+        # a call from within an executor, e.g. for a combination, leaves
+        # its results to be reported by the outermost one
+        if 0 < self.executing:
+            return status
+        # command output spilled to the scratch dir is no longer needed
+        # once it has been reported, unless a journal still refers to it
+        if self.options.get('journal') is None and self.options.get('scratchdir') is not None:
+            for d in glob.glob(os.path.join(self.options['scratchdir'], "output")) + \
+                     glob.glob(os.path.join(self.options['scratchdir'], "combination-*", "output")):
+                shutil.rmtree(d, ignore_errors=True)
         if status == 0 and self.options['clean_after'] and os.path.isdir(self.options['scratchdir']):
             self.logger.verbose_print("Cleaning up scratchdir after successful run")
             shutil.rmtree(self.options['scratchdir'])
@@ -869,39 +1106,12 @@ class TestDef(object):
 
 
     def selectPlugin(self, name, category):
-        if category == "stage":
-            try:
-                availStages = list(self.loader.stages.keys())
-                for stage in availStages:
-                    for pluginInfo in self.stages.getPluginsOfCategory(stage):
-                        if name == pluginInfo.plugin_object.print_name():
-                            return pluginInfo.plugin_object
-                # didn't find it
-                return None
-            except:
-                return None
-        elif category == "tool":
-            try:
-                availTools = list(self.loader.tools.keys())
-                for tool in availTools:
-                    for pluginInfo in self.tools.getPluginsOfCategory(tool):
-                        if name == pluginInfo.plugin_object.print_name():
-                            return pluginInfo.plugin_object
-                # didn't find it
-                return None
-            except:
-                return None
-        elif category == "utility":
-            try:
-                availUtils = list(self.loader.utilities.keys())
-                for util in availUtils:
-                    for pluginInfo in self.utilities.getPluginsOfCategory(util):
-                        if name == pluginInfo.plugin_object.print_name():
-                            return pluginInfo.plugin_object
-                # didn't find it
-                return None
-            except:
-                return None
-        else:
+        groups = {"stage": "stages", "tool": "tools", "utility": "utilities"}
+        if category not in groups:
             print("Unrecognized category:",category)
             return None
+        pluginInfo = self.findPlugin(name, groups[category])[1]
+        if pluginInfo is None:
+            # didn't find it
+            return None
+        return pluginInfo.plugin_object
@@ -8,6 +8,7 @@ import pytest
 import os
 import sys
 import configparser
+from collections.abc import Sequence
 sys.path.append(os.path.join(os.environ['MTT_HOME'], "pylib/System"))
 import TestDef as TD
 
@@ -177,3 +178,70 @@ def test_expandWildCardsMultipleStarsInARowNoGaps():
    assert 'Reporter:TextFile' in expsections
    print("--->expanded:", expsections)
 
+
+def test_findPlugin():
+   td = setup()
+   stage = object()
+   tool = object()
+   td.pluginIndex = {'Shell': [('stages', 'TestRun', stage), ('tools', 'Build', tool)]}
+   assert td.findPlugin('Shell') == ('TestRun', stage)
+   assert td.findPlugin('Shell', 'tools') == ('Build', tool)
+   assert td.findPlugin('Shell', 'stages', 'TestBuild') == (None, None)
+   assert td.findPlugin('Missing') == (None, None)
+
+def test_fillLogHiddenSection():
+   td = setup()
+   results = []
+   class Log(object):
+      reordered = 0
+      def getLog(self, key):
+         return results
+   td.logger = Log()
+   results.append({'section': 'TestGet:a', 'status': 1})
+   td.fill_log_hidden_section()
+   results.append({'section': 'TestGet:a', 'status': 0, 'options': {'b': 'c'}})
+   results.append({'section': 'TestRun:d', 'status': 0})
+   td.fill_log_hidden_section()
+   td.config.add_section('TestRun:e')
+   td.config.set('TestRun:e', 'x', '${LOG:TestGet_a.status} ${LOG:TestGet_a.options.b}')
+   assert td.config.get('TestRun:e', 'x') == '0 c'
+   # only the results that were looked up have been flattened
+   assert not dict.__contains__(td.config._sections['LOG'], 'TestRun_d.status')
+   results.append({'section': 'TestGet:a', 'status': 2})
+   td.fill_log_hidden_section()
+   assert td.config.get('TestRun:e', 'x') == '2 c'
+   assert td.config.has_option('LOG', 'TestRun_d.status')
+   # results reordered in place, as the parallel executor does
+   results.append({'section': 'TestGet:r', 'status': 0})
+   td.fill_log_hidden_section()
+   results.append({'section': 'TestGet:p', 'status': 3})
+   results[-2:] = [results[-1], results[-2]]
+   td.logger.reordered += 1
+   td.fill_log_hidden_section()
+   td.config.set('TestRun:e', 'y', '${LOG:TestGet_p.status} ${LOG:TestGet_r.status}')
+   assert td.config.get('TestRun:e', 'y') == '3 0'
+   assert td.config.get('TestRun:e', 'x') == '2 c'
+
+def test_fillLogHiddenSectionSequence():
+   td = setup()
+   read = []
+   class Lines(Sequence):
+      # stands in for command output spilled to a file
+      def __len__(self):
+         return 1000
+      def __getitem__(self, i):
+         read.append(i)
+         return "line %d" % i
+   results = [{'section': 'TestRun:a', 'status': 0, 'stdout': Lines()}]
+   class Log(object):
+      reordered = 0
+      def getLog(self, key):
+         return results
+   td.logger = Log()
+   td.fill_log_hidden_section()
+   td.config.add_section('TestRun:b')
+   td.config.set('TestRun:b', 'x', '${LOG:TestRun_a.stdout.length} ${LOG:TestRun_a.stdout.2}')
+   assert td.config.get('TestRun:b', 'x') == '1000 line 2'
+   # only the line that was referred to has been read
+   assert read == [2]
+   assert not td.config.has_option('LOG', 'TestRun_a.stdout.1000')
@@ -25,6 +25,8 @@ from BuildMTTTool import *
 # @param merge_stdout_stderr       Merge stdout and stderr into one output stream
 # @param stdout_save_lines         Number of lines of stdout to save
 # @param stderr_save_lines         Number of lines of stderr to save
+# @param stdout_save_head_lines    Number of lines from the start of stdout to save in addition to the last stdout_save_lines lines
+# @param stderr_save_head_lines    Number of lines from the start of stderr to save in addition to the last stderr_save_lines lines
 # @param modules_unload            Modules to unload
 # @param modules                   Modules to load
 # @param modules_swap              Modules to swap
@@ -45,6 +47,8 @@ class Shell(BuildMTTTool):
         self.options['merge_stdout_stderr'] = (False, "Merge stdout and stderr into one output stream")
         self.options['stdout_save_lines'] = (-1, "Number of lines of stdout to save")
         self.options['stderr_save_lines'] = (-1, "Number of lines of stderr to save")
+        self.options['stdout_save_head_lines'] = (0, "Number of lines from the start of stdout to save in addition to the last stdout_save_lines lines")
+        self.options['stderr_save_head_lines'] = (0, "Number of lines from the start of stderr to save in addition to the last stderr_save_lines lines")
         self.options['modules_unload'] = (None, "Modules to unload")
         self.options['modules'] = (None, "Modules to load")
         self.options['modules_swap'] = (None, "Modules to swap")
@@ -292,13 +296,7 @@ class Shell(BuildMTTTool):
             return
 
         # sense and record the compiler being used
-        plugin = None
-        availUtil = list(testDef.loader.utilities.keys())
-        for util in availUtil:
-            for pluginInfo in testDef.utilities.getPluginsOfCategory(util):
-                if "Compilers" == pluginInfo.plugin_object.print_name():
-                    plugin = pluginInfo.plugin_object
-                    break
+        plugin = testDef.selectPlugin("Compilers", "utility")
         if plugin is None:
             log['compiler'] = {'status' : 1, 'family' : "unknown", 'version' : "unknown"}
         else:
@@ -308,13 +306,7 @@ class Shell(BuildMTTTool):
 
         # Find MPI information for IUDatabase plugin
         if log['section'].startswith("TestBuild:") or log['section'].startswith("MiddlewareBuild:"):
-            plugin = None
-            availUtil = list(testDef.loader.utilities.keys())
-            for util in availUtil:
-                for pluginInfo in testDef.utilities.getPluginsOfCategory(util):
-                    if "MPIVersion" == pluginInfo.plugin_object.print_name():
-                        plugin = pluginInfo.plugin_object
-                        break
+            plugin = testDef.selectPlugin("MPIVersion", "utility")
             if plugin is None:
                 log['mpi_info'] = {'name' : 'unknown', 'version' : 'unknown'}
             else:
@@ -12,12 +12,12 @@
 import os
 import sys
 import configparser
-import importlib
-import logging
-import imp
-import datetime
-import tempfile
-import shutil
+import itertools
+import hashlib
+import json
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
 from yapsy.PluginManager import PluginManager
 
 from ExecutorMTTTool import *
@@ -27,6 +27,7 @@ from ExecutorMTTTool import *
 # @addtogroup Executor
 # @section CombinatorialEx
 # Combinatorial execution executor
+# @param max_workers     Number of combinations to execute concurrently (defaults to 1)
 # @}
 class CombinatorialEx(ExecutorMTTTool):
 
@@ -34,13 +35,7 @@ class CombinatorialEx(ExecutorMTTTool):
         # initialise parent class
         ExecutorMTTTool.__init__(self)
         self.options = {}
-        self.parser = configparser.ConfigParser()
-        self.parser.optionxform = str
-        # Create temp directory to hold .ini files
-        self.tempDir = tempfile.mkdtemp()
-        self.baseIniFile = None
-        self.runLog = {}
-        self.iniLog = {}
+        self.options['max_workers'] = (None, "Number of combinations to execute concurrently (defaults to 1)")
 
     def activate(self):
         # use the automatic procedure from IPlugin
@@ -61,16 +56,18 @@ class CombinatorialEx(ExecutorMTTTool):
         return
 
 
-    # Create .ini files for each combination to be run
-    # BaseIniFile created by TestDef ConfigTest()
-    def createIniLog(self, testDef):
-        self.baseIniFile = testDef.config
-        tempSpecialSection = {}
-        # configParser object to write individual options to files
-        writeOption = configparser.ConfigParser()
-        writeOption.optionxform = str
-        # Sort base .ini sections and write to temp files 
-        for section in self.baseIniFile.sections():
+    # Split the test definition into the MiddlewareGet and TestRun
+    # sections, one of each being used in every combination, the
+    # remaining sections, and the options of those that are given a
+    # comma-separated list of values, one of which is used in each
+    # combination
+    def parseSections(self, testDef):
+        config = testDef.config
+        gets = []
+        runs = []
+        others = []
+        lists = []
+        for section in config.sections():
             if section == "ENV":
                 continue
             if section.startswith("SKIP") or section.startswith("skip"):
@@ -79,117 +76,175 @@ class CombinatorialEx(ExecutorMTTTool):
                 # remove it lest they forget what it did. So let
                 # them just mark the section as "skip" to be ignored
                 continue
-            self.parser.add_section(section)
-            for option in self.baseIniFile.options(section):
-                self.parser.set(section, option, self.baseIniFile.get(section, option))
-            # TODO: FIX Getting temp file in tmp dir that is not being removed
-            fd, fileName = tempfile.mkstemp(suffix=".ini", dir = self.tempDir)
-            with open(fileName, 'w') as configfile:
-                self.parser.write(configfile)
-            # Clear out parser for next section
-            self.parser.remove_section(section)
+            options = [(option, config.get(section, option)) for option in config.options(section)]
             if "MiddlewareGet" in section:
-                self.runLog[section] = fileName
+                gets.append((section, dict(options)))
             elif "TestRun" in section:
-                tempSpecialSection[section] = fileName
+                runs.append((section, dict(options)))
             else:
-                self.iniLog[section] = fileName
-        # Combine TestRun and MiddlewareGet files
-        if len(self.runLog) == 0 or len(tempSpecialSection) == 0:
+                others.append((section, dict((option, value) for option, value in options if ',' not in value)))
+                for option, value in options:
+                    if ',' in value:
+                        lists.append((section, option, [item.strip() for item in value.split(',')]))
+        if len(gets) == 0 or len(runs) == 0:
             print("Error: Missing required 'MiddlewareGet' or 'TestRun' section in config file")
             sys.exit(1)
+        return gets, runs, others, lists
 
-        tempList = {}
-        for section in self.runLog:
-            self.parser.read(self.runLog[section])
-            for id in tempSpecialSection:
-                self.parser.read(tempSpecialSection[id])
-                fd, fileName = tempfile.mkstemp(suffix = ".ini", dir = self.tempDir)
-                with open(fileName, 'w') as configfile:
-                    self.parser.write(configfile)
-                self.parser.remove_section(id)
-                tempList[fd] = fileName
-            self.parser.remove_section(section)
-        self.runLog.clear()
-        self.runLog = tempList
-        # Sort sections for comma separated values to be parsed
-        optionsCSV = {}
-        for section in self.iniLog:
-            writeOption.read(self.iniLog[section])
-            for option in writeOption.options(section):
-                if ',' in writeOption.get(section, option):
+    # The shard, numbered from 1 to N, a combination belongs to. It
+    # only depends on what makes the combination unique, so it is the
+    # same in every run and whatever other combinations there are
+    def shardOf(self, get, run, lists, picks, n):
+        key = [get, run] + [[section, option, value] for (section, option, v), value in zip(lists, picks)]
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return int(digest, 16) % n + 1
+
+    # Generate the sections of each combination to be run, one at a
+    # time, so that the number of combinations doesn't matter. If a
+    # shard (K, N) is given, only generate the combinations of shard K
+    def combinations(self, testDef, shard=None):
+        gets, runs, others, lists = self.parseSections(testDef)
+        values = [v for section, option, v in lists]
+        for get, run in itertools.product(gets, runs):
+            for picks in itertools.product(*values):
+                if shard is not None and self.shardOf(get[0], run[0], lists, picks, shard[1]) != shard[0]:
+                    continue
+                sections = {get[0]: get[1], run[0]: run[1]}
+                for section, options in others:
+                    sections[section] = dict(options)
+                for (section, option, v), value in zip(lists, picks):
+                    sections[section][option] = value
+                yield sections
+
+    def max_workers(self, testDef):
+        # command line takes precedence over the MTTDefaults section
+        try:
+            val = testDef.options['max_workers']
+        except KeyError:
+            val = None
+        if val is None:
+            val = testDef.config.get('MTTDefaults', 'max_workers', fallback=None)
+        try:
+            val = int(val)
+        except (TypeError, ValueError):
+            val = 1
+        return max(val, 1)
+
+    # Entry point of a forked worker, which executes one combination
+    # with its own scratch directory and log and sends the results
+    # back for the parent to log and report
+    def worker(self, testDef, n, sections, conn):
+        testDef.options['scratchdir'] = os.path.join(testDef.options['scratchdir'], "combination-%d" % n)
+        os.makedirs(testDef.options['scratchdir'], exist_ok=True)
+        # the parent journals the results we send back
+        testDef.logger.journal = None
+        testDef.logger.journalPending = []
+        testDef.logger.reset()
+        try:
+            testDef.configSections(sections)
+            status = testDef.executeTest()
+        except BaseException as e:
+            type_, value_, traceback_ = sys.exc_info()
+            ex = traceback.format_exception(type_, value_, traceback_)
+            testDef.logger.verbose_print("\n".join(ex))
+            status = 1
+        try:
+            conn.send((status, testDef.logger.getLog(None)))
+        except Exception as e:
+            # a plugin left something in the log that cannot be
+            # passed back to us
+            conn.send((1, [{'section': "combination-%d" % n, 'status': 1,
+                            'stderr': ["Unable to return combination log: %s" % str(e)]}]))
+        conn.close()
+        sys.stdout.flush()
+        try:
+            testDef.logger.fh.flush()
+        except Exception:
+            pass
+
+    def terminate_workers(self, running):
+        for conn,(proc,n) in list(running.items()):
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+            conn.close()
+        running.clear()
+
+    # Execute up to maxw combinations at a time, each in its own
+    # forked worker. The Reporter sections are left out of the
+    # combinations and executed once all of them are done
+    def execute_concurrent(self, testDef, combinations, maxw):
+        ctx = multiprocessing.get_context('fork')
+        testDef.logger.verbose_print("Executing up to %d combinations concurrently" % maxw)
+        status = 0
+        reporters = None
+        running = {}
+        pending = enumerate(combinations, 1)
+        more = True
+        try:
+            while more or running:
+                while more and len(running) < maxw:
                     try:
-                        if optionsCSV[section] is not None:
-                            pass
-                    except KeyError:
-                        optionsCSV[section] = []
-                    optionsCSV[section].append(option)
-                else:
-                    # write option to base run files
-                    for fd in self.runLog:
-                        # set up parser to write to each file
-                        self.parser.read(self.runLog[fd])
-                        if not self.parser.has_section(section):
-                            self.parser.add_section(section)
-                        self.parser.set(section, option, writeOption.get(section, option))
-                        # Want to overwrite file with new parser contents
-                        with open(self.runLog[fd], 'w') as configfile:
-                            self.parser.write(configfile)
-                        # clear parser for next file
-                        for sect in self.parser.sections():
-                            self.parser.remove_section(sect)       
-            writeOption.remove_section(section)
-        # Process CSV options
-        for section in optionsCSV:
-            self.parser.read(self.iniLog[section])
-            for option in optionsCSV[section]:
-                # Get clean list of CSV's
-                rawList = self.parser.get(section, option)
-                splitList = rawList.split(',')
-                optionList = []
-                for item in splitList:
-                    optionList.append(item.strip())
-                newList = {}
-                for fd in self.runLog:
-                    writeOption.read(self.runLog[fd])
-                    for nextOpt in optionList:
-                        try:
-                            if writeOption.has_section(section):
-                                pass
-                        except KeyError:
-                            writeOption.add_section(section)
-                        writeOption.set(section, option, nextOpt)
-                        fd, fileName = tempfile.mkstemp(suffix=".ini", dir = self.tempDir)
-                        with open(fileName, 'w') as configfile:
-                            writeOption.write(configfile)
-                        newList[fd] = fileName
-                    for sect in writeOption.sections():
-                        writeOption.remove_section(sect)
-                # Update runLog for next pass
-                self.runLog.clear()
-                self.runLog = newList
-            self.parser.remove_section(section)
+                        n,sections = next(pending)
+                    except StopIteration:
+                        more = False
+                        break
+                    if reporters is None:
+                        reporters = dict((s, o) for s, o in sections.items() if s.split(":")[0].strip() == "Reporter")
+                    sections = dict((s, o) for s, o in sections.items() if s not in reporters)
+                    # make sure nothing buffered gets duplicated by the fork
+                    sys.stdout.flush()
+                    try:
+                        testDef.logger.fh.flush()
+                    except Exception:
+                        pass
+                    parent_conn, child_conn = ctx.Pipe(duplex=False)
+                    proc = ctx.Process(target=self.worker, args=(testDef, n, sections, child_conn))
+                    proc.start()
+                    child_conn.close()
+                    running[parent_conn] = (proc, n)
+                if not running:
+                    break
+                for conn in wait(list(running.keys())):
+                    proc,n = running.pop(conn)
+                    try:
+                        combination_status,results = conn.recv()
+                    except EOFError:
+                        # the worker died without reporting back
+                        combination_status = 1
+                        results = [{'section': "combination-%d" % n, 'status': 1,
+                                    'stderr': ["Worker for combination exited unexpectedly"]}]
+                    conn.close()
+                    proc.join()
+                    for result in results:
+                        testDef.logger.logResults(result.get('section', "combination-%d" % n), result, testDef)
+                    if combination_status != 0:
+                        status = 1
+        except BaseException:
+            # don't leave any orphaned workers behind
+            self.terminate_workers(running)
+            raise
+        if reporters:
+            testDef.configSections(reporters)
+            if testDef.executeTest() != 0:
+                status = 1
+        return status
 
     def execute(self, testDef):
         testDef.logger.verbose_print("ExecuteCombinatorial")
         status = 0
-        self.createIniLog(testDef)
         try:
-            if not self.runLog:
-                print("Error, empty run log, combinatorial executor failed")
-                sys.exit(1)
-            for nextFile in self.runLog:
-                if not os.path.isfile(self.runLog[nextFile]):
-                    print("Test .ini file not found!: " + nextFile)
-                    sys.exit(1)
-                testDef.configNewTest(self.runLog[nextFile])
-                sequential_status = testDef.executeTest()
-                if sequential_status != 0: 
-                    status = 1
-            # clean up temporary files
-        finally:
-            shutil.rmtree(self.tempDir)
-  
+            shard = testDef.options['shard']
+        except KeyError:
+            shard = None
+        if shard is not None:
+            testDef.logger.verbose_print("Executing the combinations of shard %d of %d" % shard)
+        maxw = self.max_workers(testDef)
+        if maxw > 1:
+            return self.execute_concurrent(testDef, self.combinations(testDef, shard), maxw)
+        for sections in self.combinations(testDef, shard):
+            testDef.configSections(sections)
+            sequential_status = testDef.executeTest()
+            if sequential_status != 0:
+                status = 1
         return status
-        
-            
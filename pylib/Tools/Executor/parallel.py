@@ -0,0 +1,631 @@
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: f; python-indent: 4 -*-
+#
+# Copyright (c) 2015-2018 Intel, Inc. All rights reserved.
+# $COPYRIGHT$
+#
+# Additional copyrights may follow
+#
+# $HEADER$
+#
+
+
+import os
+import re
+import sys
+import traceback
+import shlex
+import multiprocessing
+from multiprocessing.connection import wait
+from yapsy.PluginManager import PluginManager
+
+from ExecutorMTTTool import *
+
+
+# Theory of Operation
+#
+# The parallel executor walks the test description in the same order
+# as the sequential executor, but instead of executing one section at
+# a time it builds a dependency graph from the "parent", "middleware"
+# and "dependencies" keys of each section, along with the sections
+# whose results it interpolates with ${LOG:...}. Any section whose
+# dependencies have completed is launched in its own forked worker
+# process, up to a configurable number of concurrent workers. Since
+# plugins freely change the current working directory and the
+# environment, each worker is a separate process - the parent collects
+# the resulting log entry and records it with the Logger, so the
+# results and the Reporter stage look exactly as they would had the
+# sections been executed sequentially.
+#
+# Some stages alter the state of the MTT process itself (e.g., the
+# MTTDefaults stage updates the command line options, and "Default"
+# sections update the option defaults of their plugin). Such sections
+# are executed in the parent process and act as synchronization points:
+# all sections ahead of them complete before they are executed, and
+# no section behind them starts until they are done. The Reporter
+# stage is always one of these, so it sees the complete log.
+#
+
+## @addtogroup Tools
+# @{
+# @addtogroup Executor
+# @section ParallelEx
+# Dependency-aware parallel execution executor
+# @param max_workers     Maximum number of sections to execute concurrently (defaults to the number of cpus)
+# @}
+class ParallelEx(ExecutorMTTTool):
+
+    def __init__(self):
+        # initialise parent class
+        ExecutorMTTTool.__init__(self)
+        self.options = {}
+        self.options['max_workers'] = (None, "Maximum number of sections to execute concurrently (defaults to the number of cpus)")
+        # stages that must be executed in the parent process
+        self.serialStages = ["MTTDefaults", "BIOS", "Firmware", "Provisioning", "LauncherDefaults", "Reporter"]
+        # keys that may name the sections a given section depends upon
+        self.dependencyKeys = ['parent', 'middleware', 'dependencies']
+        # references to the results of other sections
+        self.logReference = re.compile(r"\$\{LOG:([^}]+)\}")
+
+    def activate(self):
+        # use the automatic procedure from IPlugin
+        IPlugin.activate(self)
+        return
+
+    def deactivate(self):
+        IPlugin.deactivate(self)
+        return
+
+    def print_name(self):
+        return "Parallel executor"
+
+    def print_options(self, testDef, prefix):
+        lines = testDef.printOptions(self.options)
+        for line in lines:
+            print(prefix + line)
+        return
+
+    def durationTimeoutHandler(self):
+        self.one_last_loop = True
+
+    def max_workers(self, testDef):
+        # command line takes precedence over the MTTDefaults section
+        try:
+            val = testDef.options['max_workers']
+        except KeyError:
+            val = None
+        if val is None:
+            val = testDef.config.get('MTTDefaults', 'max_workers', fallback=None)
+        try:
+            val = int(val)
+        except (TypeError, ValueError):
+            val = 0
+        if val <= 0:
+            val = os.cpu_count() or 1
+        return val
+
+    def find_plugin(self, testDef, stage, module):
+        # check the stage plugins first, then the tools and the
+        # utilities as a stage may consist of executing one of those
+        pluginInfo = testDef.findPlugin(module, "stages", stage)[1] \
+                     or testDef.findPlugin(module, "tools")[1] \
+                     or testDef.findPlugin(module, "utilities")[1]
+        if pluginInfo is None or pluginInfo.plugin_object is None:
+            return None
+        pluginInfo.plugin_object.activate()
+        return pluginInfo.plugin_object
+
+    def ordered_sections(self, testDef):
+        # walk the sections in the same order as the sequential
+        # executor, applying the same loop/reporter filtering
+        ordered = []
+        for step in testDef.loader.stageOrder:
+            for title in testDef.config.sections():
+                if self.only_reporter and step != "Reporter":
+                    continue
+                elif self.looping and not self.only_reporter and step == "Reporter":
+                    continue
+                elif self.looping and self.only_reporter:
+                    self.looping = False
+                    if step != "Reporter":
+                        continue
+                if (":" in title and step not in title.split(":")[0]) or \
+                   (":" not in title and step not in title):
+                    continue
+                # see if this is a step we are to execute
+                if title not in testDef.actives:
+                    continue
+                if "SKIP" in title:
+                    continue
+                ordered.append((step, title))
+        return ordered
+
+    def is_serial(self, step, title):
+        return step in self.serialStages or "Default" in title or "STOP" in title
+
+    def dependencies(self, testDef, title, title_append):
+        deps = []
+        for key in self.dependencyKeys:
+            val = testDef.config.get(title, key, fallback=None)
+            if not val:
+                continue
+            for d in re.split(",| |\t", val):
+                d = d.strip()
+                if d:
+                    deps.append(d + title_append)
+        # a section interpolating ${LOG:<section>.<key>} needs the
+        # results of that section, whether or not it names it as a
+        # parent. LOG keys are the section name with its ":" replaced
+        # by "_", followed by a dotted path into its results
+        bases = {}
+        for s in testDef.config.sections():
+            bases[s.replace(":","_")] = s
+        for k,v in testDef.config.items(title, raw=True):
+            for ref in self.logReference.findall(v):
+                parts = ref.split(".")
+                for i in range(1, len(parts) + 1):
+                    d = bases.get(".".join(parts[:i]))
+                    if d is not None and d != title:
+                        deps.append(d + title_append)
+        return deps
+
+    # Get a section ready for execution, logging it as failed should
+    # that fail (e.g., due to an interpolation error) so the failure
+    # is confined to the section itself
+    def try_prepare_section(self, testDef, step, title):
+        try:
+            return self.prepare_section(testDef, step, title)
+        except Exception as e:
+            title_append = "-loop%d" % (self.loop_count) if self.loopforever else ""
+            disp_title = title + title_append
+            type_, value_, traceback_ = sys.exc_info()
+            ex = traceback.format_exception(type_, value_, traceback_)
+            testDef.logger.verbose_print("\n".join(ex))
+            stageLog = {'section': disp_title,
+                        'parameters': testDef.config.items(title, raw=True),
+                        'status': 1,
+                        'stderr': ["Exception was raised: %s %s" % (type(e), str(e))]}
+            testDef.logger.logResults(disp_title, stageLog, testDef)
+            testDef.logger.stage_end_print(disp_title, stageLog)
+            if testDef.options['stop_on_fail'] is not False:
+                sys.exit(1)
+            self.status = 1
+            return None
+
+    # Get a section ready for execution - returns None if the section
+    # was resolved (i.e., logged as failed) without needing to run
+    def prepare_section(self, testDef, step, title):
+        # create display title for section in case loopforever is on
+        title_append = "-loop%d" % (self.loop_count) if self.loopforever else ""
+        disp_title = title + title_append
+
+        testDef.logger.verbose_print(disp_title)
+        # extract the stage and stage name from the title
+        if ":" in title:
+            stage,name = title.split(':')
+            stage = stage.strip()
+        else:
+            stage = title
+
+        # Print that section is now starting
+        testDef.logger.stage_start_print(disp_title)
+
+        # Refresh test options if not running combinatorial plugin
+        if testDef.options['executor'] != "combinatorial":
+            # Check for updated environment variables
+            testDef.fill_env_hidden_section()
+            # Check for updated log variables
+            testDef.fill_log_hidden_section()
+            # Print section options
+            testDef.logger.verbose_print("OPTIONS FOR SECTION: %s" % disp_title)
+            strs_to_print = testDef.logger.get_tuplelist_contents(testDef.config.items(title))
+            if strs_to_print:
+                for s in strs_to_print:
+                    testDef.logger.verbose_print("  %s" % s)
+            else:
+                testDef.logger.verbose_print("  No options provided for section")
+
+        # setup the log
+        stageLog = {'section':disp_title}
+        stageLog["parameters"] = testDef.config.items(title)
+        keyvals = {'section':disp_title.strip()}
+        for kv in testDef.config.items(title):
+            keyvals[kv[0].strip()] = kv[1].strip()
+        if 'parent' in keyvals:
+            keyvals['parent'] = keyvals['parent'] + title_append
+        # if they included the "ASIS" qualifier, remove it
+        # from the stage name
+        if "ASIS" in stage:
+            # find the first non-space character
+            i = 4
+            while stage[i].isspace():
+                i = i + 1
+            stage = stage[i:]
+            stageLog['section'] = disp_title[i:].strip()
+            keyvals['section'] = disp_title[i:].strip()
+            keyvals['asis'] = True
+
+        # if we are resuming an earlier run in which this section
+        # succeeded, its result has already been logged
+        if testDef.logger.isResumed(stageLog['section']):
+            testDef.logger.verbose_print("Section %s succeeded in the run being resumed - skipping" % stageLog['section'])
+            return False
+
+        # if this stage has a parent, check its status - if it didn't
+        # succeed, then we shall log this stage as also having failed
+        parent_loc = None
+        if 'parent' in keyvals and keyvals['parent'] is not None:
+            bldlog = testDef.logger.getLog(keyvals['parent'])
+            if bldlog is None:
+                stageLog['status'] = 1
+                stageLog['stderr'] = ["Prior dependent step did not record a log"]
+                testDef.logger.logResults(disp_title, stageLog, testDef)
+                return None
+            if 'status' not in bldlog:
+                stageLog['status'] = 1
+                stageLog['stderr'] = ["Prior dependent step failed to provide a status"]
+                testDef.logger.logResults(disp_title, stageLog, testDef)
+                return None
+            if bldlog['status'] != 0:
+                stageLog['status'] = bldlog['status']
+                stageLog['stderr'] = ["Prior dependent step failed - cannot proceed"]
+                testDef.logger.logResults(disp_title, stageLog, testDef)
+                return None
+            if 'location' in bldlog:
+                parent_loc = bldlog['location']
+
+        # extract the name of the plugin to use
+        if 'plugin' in keyvals:
+            module = keyvals['plugin']
+            plugin = self.find_plugin(testDef, stage, module)
+            if plugin is None:
+                stageLog['status'] = 1
+                stageLog['stderr'] = "Specified plugin",module,"does not exist in stage",stage,"or in the available tools and utilities"
+                testDef.logger.logResults(disp_title, stageLog, testDef)
+                return None
+        else:
+            # if they didn't specify a plugin, use the default if one
+            # is available and so designated
+            plugin = None
+            pluginInfo = testDef.findPlugin("Default{0}".format(stage), "stages", stage)[1]
+            if pluginInfo is not None:
+                plugin = pluginInfo.plugin_object
+            if plugin is None:
+                # we really have no way of executing this
+                stageLog['status'] = 1
+                stageLog['stderr'] = "Plugin for stage",stage,"was not specified, and no default is available"
+                testDef.logger.logResults(disp_title, stageLog, testDef)
+                return None
+
+        return {'disp_title': disp_title, 'stageLog': stageLog, 'keyvals': keyvals,
+                'plugin': plugin, 'parent_loc': parent_loc}
+
+    # Execute a prepared section - this is done either in the parent
+    # or in a forked worker. Returns the stage log, or None if the
+    # section was skipped due to its run_if option
+    def run_section(self, testDef, job):
+        stageLog = job['stageLog']
+        keyvals = job['keyvals']
+        plugin = job['plugin']
+
+        # determine if stage should be executed based on "run_if" option
+        if 'run_if' in keyvals:
+            run_if_cmd = keyvals['run_if']
+            del keyvals['run_if']
+            testDef.logger.verbose_print("run_if command: %s" % run_if_cmd)
+            if not run_if_cmd:
+                testDef.logger.verbose_print("run_if option is empty - skipping section")
+                return None
+            cmdargs = shlex.split(run_if_cmd)
+            original_loc = os.getcwd()
+            if job['parent_loc'] is not None:
+                os.chdir(job['parent_loc'])
+            run_if_data = testDef.execmd.execute({}, cmdargs, testDef)
+            os.chdir(original_loc)
+            run_if_result = run_if_data['status']
+            if run_if_data['stdout']:
+                testDef.logger.verbose_print("run_if stdout: %s" % run_if_data['stdout'])
+            if run_if_data['stderr']:
+                testDef.logger.verbose_print("run_if stderr: %s" % run_if_data['stderr'])
+            testDef.logger.verbose_print("run_if result: %s - %s section" % \
+                                        (run_if_result, "running" if run_if_result == 0 else "skipping"))
+            if run_if_result != 0:
+                return None
+
+        # Make sure that the plugin was activated
+        if not plugin.is_activated:
+            plugin.activate()
+
+        # execute the provided test description and capture the result
+        testDef.logger.verbose_print("Executing plugin %s" % plugin.print_name())
+        plugin.execute(stageLog, keyvals, testDef)
+
+        # Make sure stdout and stderr are properly formatted
+        if 'stdout' in stageLog and isinstance(stageLog['stdout'], str):
+            stageLog['stdout'] = stageLog['stdout'].split("\n")
+        if 'stderr' in stageLog and isinstance(stageLog['stderr'], str):
+            stageLog['stderr'] = stageLog['stderr'].split("\n")
+        return stageLog
+
+    # Entry point of a forked worker
+    def worker(self, testDef, job, conn):
+        try:
+            result = self.run_section(testDef, job)
+        except BaseException as e:
+            type_, value_, traceback_ = sys.exc_info()
+            ex = traceback.format_exception(type_, value_, traceback_)
+            testDef.logger.verbose_print("\n".join(ex))
+            result = job['stageLog']
+            result['status'] = 1
+            result['stderr'] = ["Exception was raised: %s %s" % (type(e), str(e))]
+        try:
+            conn.send(result)
+        except Exception as e:
+            # the plugin left something in the log that cannot be
+            # passed back to us
+            stageLog = {'section': job['stageLog']['section'],
+                        'parameters': job['stageLog']['parameters'],
+                        'status': 1,
+                        'stderr': ["Unable to return section log: %s" % str(e)]}
+            conn.send(stageLog)
+        conn.close()
+        sys.stdout.flush()
+        try:
+            testDef.logger.fh.flush()
+        except Exception:
+            pass
+
+    # Record the result of a completed section - returns False if
+    # execution is to stop
+    def complete_section(self, testDef, job, stageLog):
+        disp_title = job['disp_title']
+        if stageLog is None:
+            # skipped due to run_if
+            return True
+        # Log results for section
+        testDef.logger.logResults(disp_title, stageLog, testDef)
+        # Print end of section
+        testDef.logger.stage_end_print(disp_title, stageLog)
+        # Optional save log
+        try:
+            job['plugin'].savelog(testDef)
+        except:
+            pass
+        if testDef.options['stop_on_fail'] is not False and stageLog['status'] != 0:
+            print("Section " + stageLog['section'] + ": Status " + str(stageLog['status']))
+            try:
+                print("Section " + stageLog['section'] + ": Stderr " + str(stageLog['stderr']))
+            except KeyError:
+                pass
+            return False
+        # Set flag if any stage failed so that a return code can be passed back up
+        if stageLog['status'] != 0:
+            self.status = 1
+        return True
+
+    def terminate_workers(self, running):
+        for conn,(proc,job) in list(running.items()):
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+            conn.close()
+        running.clear()
+
+    def deactivate_plugins(self, testDef):
+        for p in testDef.stages.getAllPlugins() \
+               + testDef.tools.getAllPlugins() \
+               + testDef.utilities.getAllPlugins():
+            if not p._getIsActivated():
+                continue
+            p.plugin_object.deactivate()
+
+    # Execute a run of independent sections concurrently, honoring
+    # the dependencies between them
+    def execute_concurrent(self, testDef, sections):
+        title_append = "-loop%d" % (self.loop_count) if self.loopforever else ""
+        ctx = multiprocessing.get_context('fork')
+        # only dependencies on sections ahead of us in this batch
+        # matter - everything else has either already completed or
+        # will never be executed
+        known = set()
+        deps = {}
+        for step,title in sections:
+            deps[title] = set(d for d in self.dependencies(testDef, title, title_append) if d in known)
+            known.add(title + title_append)
+        pending = list(enumerate(sections))
+        finished = set()
+        running = {}
+        maxw = self.max_workers(testDef)
+        testDef.logger.verbose_print("Executing up to %d sections concurrently" % maxw)
+        logstart = len(testDef.logger.getLog(None))
+        rank = {}
+        try:
+            self.schedule(testDef, ctx, pending, running, finished, deps, rank, maxw, title_append)
+        except BaseException:
+            # don't leave any orphaned workers behind
+            self.terminate_workers(running)
+            raise
+        # present the results in the order the sequential executor
+        # would have generated them
+        fullLog = testDef.logger.getLog(None)
+        fullLog[logstart:] = sorted(fullLog[logstart:], key=lambda r: rank.get(id(r), len(sections)))
+        testDef.logger.reindex()
+
+    def schedule(self, testDef, ctx, pending, running, finished, deps, rank, maxw, title_append):
+        while pending or running:
+            # launch everything that is ready
+            for entry in list(pending):
+                pos,(step,title) = entry
+                if len(running) >= maxw:
+                    break
+                if not deps[title].issubset(finished):
+                    continue
+                pending.remove(entry)
+                job = self.try_prepare_section(testDef, step, title)
+                if job is False:
+                    # it succeeded in the run being resumed
+                    finished.add(title + title_append)
+                    continue
+                if job is None:
+                    # the section was logged as failed without running
+                    lg = testDef.logger.getLog(None)
+                    rank[id(lg[-1])] = pos
+                    finished.add(title + title_append)
+                    continue
+                job['title'] = title
+                job['rank'] = pos
+                # make sure nothing buffered gets duplicated by the fork
+                sys.stdout.flush()
+                try:
+                    testDef.logger.fh.flush()
+                except Exception:
+                    pass
+                parent_conn, child_conn = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=self.worker, args=(testDef, job, child_conn))
+                proc.start()
+                child_conn.close()
+                running[parent_conn] = (proc, job)
+            if not running:
+                if pending:
+                    # cannot happen as we only depend on earlier sections
+                    break
+                continue
+            # wait for at least one worker to finish - release the
+            # semaphore so async threads can interrupt us here
+            testDef.plugin_trans_sem.release()
+            ready = wait(list(running.keys()))
+            testDef.plugin_trans_sem.acquire()
+            for conn in ready:
+                proc,job = running.pop(conn)
+                try:
+                    stageLog = conn.recv()
+                except EOFError:
+                    # the worker died without reporting back
+                    stageLog = job['stageLog']
+                    stageLog['status'] = 1
+                    stageLog['stderr'] = ["Worker for section exited unexpectedly"]
+                conn.close()
+                proc.join()
+                finished.add(job['title'] + title_append)
+                if stageLog is not None:
+                    rank[id(stageLog)] = job['rank']
+                if not self.complete_section(testDef, job, stageLog):
+                    sys.exit(1)
+
+    def execute_sections(self, testDef):
+        ordered = self.ordered_sections(testDef)
+        idx = 0
+        while idx < len(ordered):
+            # gather the next batch of sections that can run concurrently
+            batch = []
+            while idx < len(ordered) and not self.is_serial(*ordered[idx]):
+                batch.append(ordered[idx])
+                idx = idx + 1
+            try:
+                if batch:
+                    self.execute_concurrent(testDef, batch)
+                if idx >= len(ordered):
+                    break
+                step,title = ordered[idx]
+                idx = idx + 1
+                # if they provided the STOP section, that means we
+                # are to immediately stop processing the test definition
+                # file and return
+                if "STOP" in title:
+                    testDef.logger.verbose_print(title)
+                    return
+                job = self.try_prepare_section(testDef, step, title)
+                if not job:
+                    continue
+                stageLog = self.run_section(testDef, job)
+                if not self.complete_section(testDef, job, stageLog):
+                    sys.exit(1)
+
+            except KeyboardInterrupt as e:
+                self.looping = False
+                self.deactivate_plugins(testDef)
+                testDef.logger.verbose_print("=======================================")
+                testDef.logger.verbose_print("KeyboardInterrupt exception was raised: %s %s" \
+                            % (type(e), str(e)))
+                testDef.logger.verbose_print("=======================================")
+                self.status = 1
+                self.only_reporter = True
+                # fall back to executing just the reporters
+                ordered = [o for o in ordered[idx:] if o[0] == "Reporter"]
+                idx = 0
+
+            except SystemExit:
+                raise
+
+            except BaseException as e:
+                self.looping = False
+                self.deactivate_plugins(testDef)
+                testDef.logger.verbose_print("=======================================")
+                testDef.logger.verbose_print("Exception was raised: %s %s" \
+                            % (type(e), str(e)))
+                testDef.logger.verbose_print("=======================================")
+                type_, value_, traceback_ = sys.exc_info()
+                ex = traceback.format_exception(type_, value_, traceback_)
+                testDef.logger.verbose_print("\n".join(ex))
+                testDef.logger.verbose_print("=======================================")
+                self.status = 1
+                self.only_reporter = True
+                ordered = [o for o in ordered[idx:] if o[0] == "Reporter"]
+                idx = 0
+        self.only_reporter = False
+
+    def execute(self, testDef):
+        testDef.logger.verbose_print("ExecuteParallel")
+        self.status = 0
+        self.only_reporter = False
+        self.looping = False
+        self.one_last_loop = False
+        self.loopforever = False
+        self.loop_count = 0
+
+        testDef.watchdog.__init__(testDef=testDef)
+        testDef.watchdog.activate()
+
+        # Holding a semaphore while in transition between plugins
+        # so async threads don't interrupt in the wrong context
+        testDef.plugin_trans_sem.acquire()
+
+        # If --duration switch is used, activate watchdog timer
+        if testDef.options['duration']:
+            testDef.watchdog.start(timeout=testDef.options['duration'])
+
+        # If --loopforever switch is used, loop forever
+        if testDef.options['loopforever']:
+            self.looping = True
+            self.loopforever = True
+
+        # If --loop switch is used, loop until loop timeout is done
+        elif testDef.options['loop']:
+            testDef.watchdog.start(handler=self.durationTimeoutHandler,
+                                   timeout=testDef.options['loop'])
+            self.looping = True
+
+        # Start harasser
+        if testDef.options["harass_trigger_scripts"] is not None:
+            stageLog = {'section':"DefaultHarasser"}
+            testDef.harasser.execute(stageLog,{"trigger_scripts": testDef.options["harass_trigger_scripts"],
+                                  "stop_scripts": testDef.options["harass_stop_scripts"],
+                                  "join_timeout": testDef.options["harass_join_timeout"]}, testDef)
+            if stageLog['status'] != 0:
+                self.status = 1
+                self.only_reporter = True
+            testDef.logger.logResults("DefaultHarasser", stageLog, testDef)
+
+        # Keep on looping as long as it's needed
+        while self.looping or self.loop_count == 0 or (self.one_last_loop and self.looping):
+            self.loop_count += 1
+            if self.one_last_loop:
+                self.only_reporter = True
+                self.looping = False
+            # Execute all sections in INI file
+            self.execute_sections(testDef)
+
+        self.deactivate_plugins(testDef)
+
+        testDef.plugin_trans_sem.release()
+
+        return self.status
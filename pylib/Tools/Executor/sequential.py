@@ -155,6 +155,12 @@ class SequentialEx(ExecutorMTTTool):
                         stageLog['section'] = disp_title[i:].strip()
                         keyvals['section'] = disp_title[i:].strip()
                         keyvals['asis'] = True
+                    # if we are resuming an earlier run in which this section
+                    # succeeded, its result has already been logged
+                    if testDef.logger.isResumed(stageLog['section']):
+                        testDef.logger.verbose_print("Section %s succeeded in the run being resumed - skipping" % stageLog['section'])
+                        testDef.plugin_trans_sem.acquire()
+                        continue
                     # if this stage has a parent, get the log for that stage
                     # and check its status - if it didn't succeed, then we shall
                     # log this stage as also having failed and skip it
@@ -192,84 +198,29 @@ class SequentialEx(ExecutorMTTTool):
                     plugin = None
                     try:
                         module = keyvals['plugin']
-                        # see if this plugin exists
-                        try:
-                            for pluginInfo in testDef.stages.getPluginsOfCategory(stage):
-                                if module == pluginInfo.plugin_object.print_name():
-                                    plugin = pluginInfo.plugin_object
-                                    break
-                            if plugin is None:
-                                # this plugin doesn't exist, or it may not be a stage as
-                                # sometimes a stage consists of executing a tool or utility.
-                                # so let's check the tools too, noting that those
-                                # are not stage-specific.
-                                availTools = list(testDef.loader.tools.keys())
-                                for tool in availTools:
-                                    for pluginInfo in testDef.tools.getPluginsOfCategory(tool):
-                                        if module == pluginInfo.plugin_object.print_name():
-                                            plugin = pluginInfo.plugin_object
-                                            break
-                                    if plugin is not None:
-                                        break
-                                if plugin is None:
-                                    # Check the utilities
-                                    availUtils = list(testDef.loader.utilities.keys())
-                                    for util in availUtils:
-                                        for pluginInfo in testDef.utilities.getPluginsOfCategory(util):
-                                            if module == pluginInfo.plugin_object.print_name():
-                                                plugin = pluginInfo.plugin_object
-                                                break
-                                        if plugin is not None:
-                                            break
-                                if plugin is None:
-                                    stageLog['status'] = 1
-                                    stageLog['stderr'] = "Specified plugin",module,"does not exist in stage",stage,"or in the available tools and utilities"
-                                    testDef.logger.logResults(disp_title, stageLog, testDef)
-                                    testDef.plugin_trans_sem.acquire()
-                                    continue
-                                else:
-                                    # activate the specified plugin
-                                    testDef.tools.activatePluginByName(module, tool)
-                            else:
-                                # activate the specified plugin
-                                testDef.stages.activatePluginByName(module, stage)
-                        except KeyError:
-                            # If this stage has no plugins then check the tools and the utilities
-                            availTools = list(testDef.loader.tools.keys())
-                            for tool in availTools:
-                                for pluginInfo in testDef.tools.getPluginsOfCategory(tool):
-                                    if module == pluginInfo.plugin_object.print_name():
-                                        plugin = pluginInfo.plugin_object
-                                        break
-                                if plugin is not None:
-                                    break
-                            if plugin is None:
-                                # Check the utilities
-                                availUtils = list(testDef.loader.utilities.keys())
-                                for util in availUtils:
-                                    for pluginInfo in testDef.utilities.getPluginsOfCategory(util):
-                                        if module == pluginInfo.plugin_object.print_name():
-                                            plugin = pluginInfo.plugin_object
-                                            break
-                                    if plugin is not None:
-                                        break
-                            if plugin is None:
-                                stageLog['status'] = 1
-                                stageLog['stderr'] = "Specified plugin",module,"does not exist in stage",stage,"or in the available tools and utilities"
-                                testDef.logger.logResults(disp_title, stageLog, testDef)
-                                testDef.plugin_trans_sem.acquire()
-                                continue
-                            else:
-                                # activate the specified plugin
-                                testDef.tools.activatePluginByName(module, tool)
+                        # see if this plugin exists - it may not be a stage
+                        # as sometimes a stage consists of executing a tool or
+                        # utility, so check those too, noting that they are
+                        # not stage-specific
+                        pluginInfo = testDef.findPlugin(module, "stages", stage)[1] \
+                                     or testDef.findPlugin(module, "tools")[1] \
+                                     or testDef.findPlugin(module, "utilities")[1]
+                        if pluginInfo is not None:
+                            plugin = pluginInfo.plugin_object
+                        if plugin is None:
+                            stageLog['status'] = 1
+                            stageLog['stderr'] = "Specified plugin",module,"does not exist in stage",stage,"or in the available tools and utilities"
+                            testDef.logger.logResults(disp_title, stageLog, testDef)
+                            testDef.plugin_trans_sem.acquire()
+                            continue
+                        # activate the specified plugin
+                        plugin.activate()
                     except KeyError:
                         # if they didn't specify a plugin, use the default if one
                         # is available and so designated
-                        default = "Default{0}".format(stage)
-                        for pluginInfo in testDef.stages.getPluginsOfCategory(stage):
-                            if default == pluginInfo.plugin_object.print_name():
-                                plugin = pluginInfo.plugin_object
-                                break
+                        pluginInfo = testDef.findPlugin("Default{0}".format(stage), "stages", stage)[1]
+                        if pluginInfo is not None:
+                            plugin = pluginInfo.plugin_object
                         if plugin is None:
                             # we really have no way of executing this
                             stageLog['status'] = 1
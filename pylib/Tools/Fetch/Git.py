@@ -366,7 +366,7 @@ class Git(FetchMTTTool):
                             log['stdout'] = results['stdout']
                             os.chdir(cwd)
                             continue
-                        if isinstance(results['stdout'], list):
+                        if not isinstance(results['stdout'], str):
                             if results['stdout']:
                                 t = [line for line in results['stdout'] if line.startswith('*')][0]
                             else:
@@ -427,7 +427,7 @@ class Git(FetchMTTTool):
                             os.chdir(cwd)
                             continue
                         head_commit_hash, requested_commit_hash = None, None
-                        if isinstance(results['stdout'], list):
+                        if not isinstance(results['stdout'], str):
                             if results['stdout']:
                                 head_commit_hash = results['stdout'][0]
                         else:
@@ -443,7 +443,7 @@ class Git(FetchMTTTool):
                                 log['stdout'] = results['stdout']
                                 os.chdir(cwd)
                                 continue
-                            if isinstance(results['stdout'], list):
+                            if not isinstance(results['stdout'], str):
                                 if results['stdout']:
                                     requested_commit_hash = results['stdout'][0]
                             else:
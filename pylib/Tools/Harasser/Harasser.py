@@ -23,7 +23,7 @@ import sys
 # Run harasser scripts while test-content is running
 # @param trigger_scripts      Scripts to run to launch harassers
 # @param stop_scripts         Scripts to run to stop and clean-up harassers
-# @param join_timeout         Seconds to wait for process to finish
+# @param join_timeout         Seconds to wait for process to finish before it is killed
 # @}
 class Harasser(HarasserMTTTool):
     def __init__(self):
@@ -35,7 +35,7 @@ class Harasser(HarasserMTTTool):
         self.options = {}
         self.options['trigger_scripts'] = (None, "Scripts to run to launch harassers")
         self.options['stop_scripts'] = (None, "Scripts to run to stop and clean-up harassers")
-        self.options['join_timeout'] = (None, "Seconds to wait for processes to finish")
+        self.options['join_timeout'] = (None, "Seconds to wait for processes to finish before they are killed")
         return
 
     def config(self, cfg):
@@ -158,7 +158,10 @@ class Harasser(HarasserMTTTool):
                 if self.options['join_timeout'][0] is None:
                     process.join()
                 else:
-                    process.join(int(self.options['join_timeout'][0]))
+                    # kill the harasser if it outlives the join timeout
+                    timeout = testDef.scheduler.kill_after(int(self.options['join_timeout'][0]), process.pid)
+                    process.join()
+                    testDef.scheduler.cancel(timeout)
             elif results['status'] == 1:
                 process.terminate()
 
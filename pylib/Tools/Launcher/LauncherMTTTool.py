@@ -14,8 +14,11 @@
 from yapsy.IPlugin import IPlugin
 
 import os
+import stat
 import shlex
 import re
+import queue
+import threading
 
 ## @addtogroup Tools
 # @{
@@ -27,7 +30,10 @@ class LauncherMTTTool(IPlugin):
         # parameter: additionalCheck is a dict, see the SLURM plugin for usage
         self.additionalCheck = additionalCheck
         self.tests = []
-        self.skip_tests = []
+        self.skip_tests = set()
+        # cache of directory scans, keyed by absolute path and
+        # kept across sections and --loop iterations
+        self.dirCache = {}
         self.oldbinpath = None
         self.oldldlibpath = None
         self.skipStatus = 77
@@ -220,68 +226,96 @@ class LauncherMTTTool(IPlugin):
 
     def resetTests(self):
         self.tests = []
-        self.skip_tests = []
+        self.skip_tests = set()
         self.expected_returncodes = {}
 
+    def scanDir(self, dirName):
+        """Return the executables and subdirectories directly within
+        dirName. The directory is only listed again when its mtime
+        changes, but whether each file is executable is checked every
+        time, as a chmod does not change the mtime of its directory
+        """
+        try:
+            mtime = os.stat(dirName).st_mtime_ns
+        except OSError:
+            return [], []
+        cached = self.dirCache.get(dirName)
+        if cached is None or cached[0] != mtime:
+            files = []
+            subdirs = []
+            try:
+                names = os.listdir(dirName)
+            except OSError:
+                return [], []
+            for name in names:
+                path = os.path.join(dirName, name)
+                try:
+                    st = os.lstat(path)
+                    if stat.S_ISLNK(st.st_mode):
+                        # like os.walk, don't descend into symlinked
+                        # dirs, but do follow links to files
+                        st = os.stat(path)
+                        if stat.S_ISDIR(st.st_mode):
+                            continue
+                    elif stat.S_ISDIR(st.st_mode):
+                        subdirs.append(path)
+                        continue
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files.append(path)
+            cached = (mtime, files, subdirs)
+            self.dirCache[dirName] = cached
+        execs = [f for f in cached[1] if os.access(f, os.X_OK)]
+        return execs, cached[2]
+
+    def walkTests(self, top):
+        """Yield (dirName, executables) for top and every directory
+        beneath it, in the same order as os.walk
+        """
+        pending = [os.path.abspath(top)]
+        while pending:
+            dirName = pending.pop()
+            execs, subdirs = self.scanDir(dirName)
+            yield dirName, execs
+            pending.extend(reversed(subdirs))
+
+    def testDirs(self, cmds):
+        # accept values delimited by , or space or tab
+        # and remove any quotes
+        try:
+            if cmds['test_dir'] is not None:
+                dirs = [dr.strip().replace('\"','') for dr in re.split(",| |\t", cmds['test_dir'])]
+                return [dr for dr in dirs if dr]
+        except KeyError:
+            pass
+        return ["."]
+
     def collectTests(self, log, cmds):
         self.resetTests()
         # did they give us a list of specific directories where the desired
-        # tests to be executed reside?
+        # tests to be executed reside? If not, get the list of executables
+        # from this directory and any subdirectories beneath it
+        dirs = self.testDirs(cmds)
         if cmds['test_list'] is None:
-            try:
-                if cmds['test_dir'] is not None:
-                    # pick up the executables from the specified directories
-                    # accept values delimited by , or space or tab
-                    dirs = re.split(",| |\t", cmds['test_dir'])
-                    for dr in dirs:
-                        dr = dr.strip()
-                        # remove any commas and quotes
-                        dr = dr.replace('\"','')
-                        for dirName, subdirList, fileList in os.walk(dr):
-                            for fname in fileList:
-                                # see if this is an executable
-                                filename = os.path.abspath(os.path.join(dirName,fname))
-                                if os.path.isfile(filename) and os.access(filename, os.X_OK):
-                                    # add this file to our list of tests to execute
-                                    self.tests.append(filename)
-                else:
-                    # get the list of executables from this directory and any
-                    # subdirectories beneath it
-                    for dirName, subdirList, fileList in os.walk("."):
-                        for fname in fileList:
-                            # see if this is an executable
-                            filename = os.path.abspath(os.path.join(dirName,fname))
-                            if os.path.isfile(filename) and os.access(filename, os.X_OK):
-                                # add this file to our list of tests to execute
-                                self.tests.append(filename)
-            except KeyError:
-                # get the list of executables from this directory and any
-                # subdirectories beneath it
-                for dirName, subdirList, fileList in os.walk("."):
-                    for fname in fileList:
-                        # see if this is an executable
-                        filename = os.path.abspath(os.path.join(dirName,fname))
-                        if os.path.isfile(filename) and os.access(filename, os.X_OK):
-                            # add this file to our list of tests to execute
-                            self.tests.append(filename)
+            for dr in dirs:
+                for dirName, execs in self.walkTests(dr):
+                    self.tests.extend(execs)
         # If list of individual tests is provided, use list rather than grabbing all tests
         else:
-            if cmds['test_dir'] is not None:
-                dirs = re.split(",| |\t", cmds['test_dir'])
-            else:
-                dirs = ['.']
+            individual_tests = []
+            for fname_cmd in re.split(",| |\t", cmds['test_list']):
+                fname = fname_cmd.strip().split(" ")[0]
+                fname_args = " ".join(fname_cmd.strip().split(" ")[1:])
+                individual_tests.append((fname, fname_args))
             for dr in dirs:
-                dr = dr.strip()
-                dr = dr.replace('\"','')
-                individual_tests = re.split(",| |\t", cmds['test_list'])
-                for dirName, subdirList, fileList in os.walk(dr):
-                    for fname_cmd in individual_tests:
-                        fname = fname_cmd.strip().split(" ")[0]
-                        fname_args = " ".join(fname_cmd.strip().split(" ")[1:])
-                        if fname not in fileList:
-                            continue
-                        filename = os.path.abspath(os.path.join(dirName,fname))
-                        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+                for dirName, execs in self.walkTests(dr):
+                    if not execs:
+                        continue
+                    names = set([os.path.basename(e) for e in execs])
+                    for fname,fname_args in individual_tests:
+                        if fname in names:
+                            filename = os.path.join(dirName, fname)
                             self.tests.append((filename+" "+fname_args).strip())
         # check that we found something
         if not self.tests:
@@ -295,6 +329,12 @@ class LauncherMTTTool(IPlugin):
         if cmds['max_num_tests'] is not None:
             self.maxTests = int(cmds['max_num_tests'])
 
+        # index the tests by name so the fail and skip lists given
+        # by test name can be matched to them
+        testIndex = {}
+        for t in self.tests:
+            testIndex.setdefault(t.split("/")[-1], []).append(t)
+
         # construct a dict of usecases for tests expected to fail
         fail_usecases = {}
         # create a list of the tests that are expected to fail - i.e.,
@@ -319,16 +359,14 @@ class LauncherMTTTool(IPlugin):
                     fail_usecases[t] = None
             # the list of tests expected to fail is given by test name, but
             # the list of tests we are to execute has been setup in absolute
-            # path form. Thus, scan the two lists and replace the fail_tests
-            # entries with their absolute path equivalents. Note that we don't
-            # bother removing those we don't match as those won't be executed
-            # anyway and thus are irrelevant
-            fail_usecases_keys = list(fail_usecases.keys())
-            for t in fail_usecases_keys:
-                for t2 in self.tests:
-                    if t2.split("/")[-1] == t:
-                        rc = fail_usecases[t]
-                        del fail_usecases[t]
+            # path form. Thus, replace the fail_tests entries with their
+            # absolute path equivalents. Note that we don't bother removing
+            # those we don't match as those won't be executed anyway and
+            # thus are irrelevant
+            for t in list(fail_usecases.keys()):
+                if t in testIndex:
+                    rc = fail_usecases.pop(t)
+                    for t2 in testIndex[t]:
                         fail_usecases[t2] = rc
 
         # record the expected return code for each test - we store this in a
@@ -348,19 +386,18 @@ class LauncherMTTTool(IPlugin):
         if skip_tests is not None:
             # be flexible and accept values delimited by , or space or tab
             # and strip any lingering whitespace
-            self.skip_tests = [t.strip() for t in re.split(",| |\t", skip_tests)]
+            skip_tests = [t.strip() for t in re.split(",| |\t", skip_tests)]
         else:
-            self.skip_tests = []
+            skip_tests = []
         # the list of tests to skip is given by test name, but
         # the list of tests we are to execute has been setup in absolute
-        # path form. Thus, scan the two lists and replace the skip_tests
-        # entries with their absolute path equivalents. Note that we don't
-        # bother removing those we don't match as those won't be executed
-        # anyway and thus are irrelevant
-        for i,t in enumerate(self.skip_tests):
-            for t2 in self.tests:
-                if t2.split("/")[-1] == t:
-                    self.skip_tests[i] = t2
+        # path form. Thus, replace the skip_tests entries with their
+        # absolute path equivalents
+        for t in skip_tests:
+            if t in testIndex:
+                self.skip_tests.update(testIndex[t])
+            else:
+                self.skip_tests.add(t)
         # all done
         return 0
 
@@ -377,19 +414,117 @@ class LauncherMTTTool(IPlugin):
                 return 1
         return 0
 
-    def runTests(self, log, cmdargs, cmds, testDef):
-        log['testresults'] = []
-        for test in self.tests:
-            testLog = {'test':test}
-            cmdargs.append(test)
-            testLog['cmd'] = " ".join(cmdargs)
+    def testSlots(self, test, cmds):
+        # number of slots occupied by a test while it executes - this
+        # is given by the number of procs it was asked to run
+        for key in ['np', 'ppn']:
+            try:
+                if cmds[key] is not None:
+                    return max(int(cmds[key]), 1)
+            except (KeyError, ValueError):
+                pass
+        return 1
 
-            # check if we should skip this test
-            if test in self.skip_tests:
-                # track number of tests we skipped. We record its
-                # status as the one we were told to use for
-                # a "skipped" test since we obviously didn't
-                # really execute it
+    def concurrency(self, cmds, testDef):
+        # get the max number of tests to run at the same time and the
+        # number of slots they can be packed into
+        try:
+            maxConcurrent = int(cmds['max_concurrent_tests'])
+        except (KeyError, TypeError, ValueError):
+            maxConcurrent = None
+        try:
+            slots = int(cmds['slots'])
+            if slots <= 0:
+                slots = None
+        except (KeyError, TypeError, ValueError):
+            slots = None
+        if maxConcurrent is None or maxConcurrent <= 0:
+            # if they only gave us the slots, then fill them up
+            maxConcurrent = slots if slots is not None else 1
+        if 1 < maxConcurrent:
+            # the harasser tracks its scripts across one test at a time
+            try:
+                if testDef.harasser.options['trigger_scripts'][0]:
+                    testDef.logger.verbose_print("Harasser scripts are active - executing tests one at a time")
+                    maxConcurrent = 1
+            except (AttributeError, KeyError):
+                pass
+        return maxConcurrent, slots
+
+    def skipTest(self, test, cmdargs, testDef):
+        testLog = {'test':test}
+        testLog['cmd'] = " ".join(cmdargs + [test])
+        # track number of tests we skipped. We record its
+        # status as the one we were told to use for
+        # a "skipped" test since we obviously didn't
+        # really execute it
+        self.numSkip += 1
+        testLog['stdout'] = ""
+        testLog['stderr'] = ""
+        testLog['time'] = 0
+        testLog['status'] = self.skipStatus
+        # clearly mark this as a skipped test
+        testLog['result'] = testDef.MTT_TEST_SKIPPED
+        return testLog
+
+    def executeSingleTest(self, test, cmdargs, cmds, testDef):
+        # execute one test - returns the test log and the results of
+        # the execution, with results being None if the test could
+        # not be executed because the harassers failed to start
+        testargs = cmdargs + [test]
+        testLog = {'test':test}
+        testLog['cmd'] = " ".join(testargs)
+
+        harass_exec_ids = testDef.harasser.start(testDef)
+
+        harass_check = testDef.harasser.check(harass_exec_ids, testDef)
+        if harass_check is not None:
+            testLog['stderr'] = 'Not all harasser scripts started. These failed to start: ' \
+                            + ','.join([h_info[1]['start_script'] for h_info in harass_check[0]])
+            testLog['time'] = sum([r_info[3] for r_info in harass_check[1]])
+            testLog['status'] = 1
+            testLog['result'] = testDef.MTT_TEST_FAILED
+            testDef.harasser.stop(harass_exec_ids, testDef)
+            return testLog, None
+
+        results = testDef.execmd.execute(cmds, testargs, testDef)
+
+        testDef.harasser.stop(harass_exec_ids, testDef)
+        return testLog, results
+
+    def recordTest(self, testLog, results, test, cmds, testDef):
+        # classify the outcome of an executed test and update our
+        # counters accordingly
+        if results is None:
+            # the test could not be executed, e.g. the harassers
+            # failed to start, and testLog already says so
+            if 0 == self.finalStatus:
+                self.finalStatus = 1
+                self.finalError = testLog['stderr']
+            self.numFail += 1
+            self.numTests += 1
+            return
+
+        testLog['status'] = results['status']
+        testLog['stdout'] = results['stdout']
+        testLog['stderr'] = results['stderr']
+        try:
+            testLog['time'] = results['time']
+        except:
+            pass
+
+        try:
+            if results['timedout']:
+                # the test timed out, so flag it as having exited that way
+                testLog['result'] = testDef.MTT_TEST_TIMED_OUT
+                if 0 == self.finalStatus:
+                    self.finalStatus = results['status']
+                    self.finalError = results['stderr']
+                self.numTimed += 1
+        except:
+            # check the return status - if the test checked its conditions
+            # and decided to be skipped, then log it as such
+            if results['status'] == self.skipStatus:
                 self.numSkip += 1
                 testLog['stdout'] = ""
                 testLog['stderr'] = ""
@@ -397,110 +532,132 @@ class LauncherMTTTool(IPlugin):
                 testLog['status'] = self.skipStatus
                 # clearly mark this as a skipped test
                 testLog['result'] = testDef.MTT_TEST_SKIPPED
-                log['testresults'].append(testLog)
-                cmdargs = cmdargs[:-1]
-                continue
-
-            harass_exec_ids = testDef.harasser.start(testDef)
-
-            harass_check = testDef.harasser.check(harass_exec_ids, testDef)
-            if harass_check is not None:
-                testLog['stderr'] = 'Not all harasser scripts started. These failed to start: ' \
-                                + ','.join([h_info[1]['start_script'] for h_info in harass_check[0]])
-                testLog['time'] = sum([r_info[3] for r_info in harass_check[1]])
-                testLog['status'] = 1
+            elif None == self.expected_returncodes[test]:
+                if 0 != results['status']:
+                    testLog['result'] = testDef.MTT_TEST_PASSED
+                    self.numPass += 1
+                else:
+                    testLog['result'] = testDef.MTT_TEST_FAILED
+                    if 0 == self.finalStatus:
+                        self.finalStatus = 1
+                        self.finalError = results['stderr']
+                    self.numFail += 1
+            elif results['status'] != self.expected_returncodes[test]:
+                # if the test was expected to fail, then
+                # we should see it return the expected code or else we declare it
+                # as having failed
                 testLog['result'] = testDef.MTT_TEST_FAILED
                 if 0 == self.finalStatus:
-                    self.finalStatus = 1
-                    self.finalError = testLog['stderr']
+                    self.finalStatus = results['status']
+                    self.finalError = results['stderr']
                 self.numFail += 1
-                self.numTests += 1
-                testDef.harasser.stop(harass_exec_ids, testDef)
-                log['testresults'].append(testLog)
-                cmdargs = cmdargs[:-1]
-                if self.numTests == self.maxTests:
-                    break
-                continue
-
-            results = testDef.execmd.execute(cmds, cmdargs, testDef)
-
-            testDef.harasser.stop(harass_exec_ids, testDef)
-
-            testLog['status'] = results['status']
-            testLog['stdout'] = results['stdout']
-            testLog['stderr'] = results['stderr']
-            try:
-                testLog['time'] = results['time']
-            except:
-                pass
-
-            try:
-                if results['timedout']:
-                    # the test timed out, so flag it as having exited that way
-                    testLog['result'] = testDef.MTT_TEST_TIMED_OUT
+            elif (self.additionalCheck is not None and
+                    results['status'] == self.expected_returncodes[test] and
+                    any(self.additionalCheck['errstr'] in line for line in results['stderr'])):
+                    # this code lets you check for a false positive, the additionalCheck dict contains
+                    # an error string to look for if the status is 0, a return code to set status to and
+                    # a results code to set the test to.
+                    # If the dict is not defined, this check will be skipped.  See the SLURM plugin for
+                    # how this is being used
+                    testLog['result'] = self.additionalCheck['result']
+                    results['status'] = self.additionalCheck['rtncode']
                     if 0 == self.finalStatus:
                         self.finalStatus = results['status']
                         self.finalError = results['stderr']
                     self.numTimed += 1
-            except:
-                # check the return status - if the test checked its conditions
-                # and decided to be skipped, then log it as such
-                if results['status'] == self.skipStatus:
-                    self.numSkip += 1
-                    testLog['stdout'] = ""
-                    testLog['stderr'] = ""
-                    testLog['time'] = 0
-                    testLog['status'] = self.skipStatus
-                    # clearly mark this as a skipped test
-                    testLog['result'] = testDef.MTT_TEST_SKIPPED
-                elif None == self.expected_returncodes[test]:
-                    if 0 != results['status']:
-                        testLog['result'] = testDef.MTT_TEST_PASSED
-                        self.numPass += 1
-                    else:
-                        testLog['result'] = testDef.MTT_TEST_FAILED
-                        if 0 == self.finalStatus:
-                            self.finalStatus = 1
-                            self.finalError = results['stderr']
-                        self.numFail += 1
-                elif results['status'] != self.expected_returncodes[test]:
-                    # if the test was expected to fail, then
-                    # we should see it return the expected code or else we declare it
-                    # as having failed
-                    testLog['result'] = testDef.MTT_TEST_FAILED
-                    if 0 == self.finalStatus:
-                        self.finalStatus = results['status']
-                        self.finalError = results['stderr']
-                    self.numFail += 1
-                elif (self.additionalCheck is not None and
-                        results['status'] == self.expected_returncodes[test] and
-                        any(self.additionalCheck['errstr'] in line for line in results['stderr'])):
-                        # this code lets you check for a false positive, the additionalCheck dict contains
-                        # an error string to look for if the status is 0, a return code to set status to and
-                        # a results code to set the test to.
-                        # If the dict is not defined, this check will be skipped.  See the SLURM plugin for
-                        # how this is being used
-                        testLog['result'] = self.additionalCheck['result']
-                        results['status'] = self.additionalCheck['rtncode']
-                        if 0 == self.finalStatus:
-                            self.finalStatus = results['status']
-                            self.finalError = results['stderr']
-                        self.numTimed += 1
-                else:
-                    testLog['result'] = testDef.MTT_TEST_PASSED
-                    self.numPass += 1
+            else:
+                testLog['result'] = testDef.MTT_TEST_PASSED
+                self.numPass += 1
+        try:
+            testLog['np'] = cmds['np']
+        except KeyError:
             try:
-                testLog['np'] = cmds['np']
-            except KeyError:
-                try:
-                    testLog['np'] = cmds['ppn']
-                except:
-                    testLog['np'] = -1
-            log['testresults'].append(testLog)
-            cmdargs = cmdargs[:-1]
-            self.numTests = self.numTests + 1
-            if self.numTests == self.maxTests:
+                testLog['np'] = cmds['ppn']
+            except:
+                testLog['np'] = -1
+        self.numTests = self.numTests + 1
+        return
+
+    def concurrentTest(self, done, idx, test, cmdargs, cmds, testDef):
+        # thread body for executing a test alongside others - report
+        # back to the scheduler no matter what happens
+        try:
+            testLog, results = self.executeSingleTest(test, cmdargs, cmds, testDef)
+        except Exception as e:
+            # it failed without being executed, so there is nothing
+            # to classify - record it as failed the way we do when
+            # the harassers fail to start
+            testLog = {'test':test, 'cmd':" ".join(cmdargs + [test])}
+            testLog['status'] = 1
+            testLog['stdout'] = []
+            testLog['stderr'] = [str(e)]
+            testLog['result'] = testDef.MTT_TEST_FAILED
+            results = None
+        done.put((idx, testLog, results))
+
+    def runConcurrentTests(self, log, cmdargs, cmds, testDef, maxConcurrent, slots):
+        # lay out the tests in their original order so the results
+        # can be reported that way regardless of completion order
+        testresults = [None] * len(self.tests)
+        pending = []
+        count = self.numTests
+        for idx,test in enumerate(self.tests):
+            if test in self.skip_tests:
+                testresults[idx] = self.skipTest(test, cmdargs, testDef)
+                continue
+            pending.append((idx, test))
+            count = count + 1
+            if count == self.maxTests:
                 break
+
+        testDef.logger.verbose_print("Executing up to %d tests concurrently%s" % \
+                                     (maxConcurrent, "" if slots is None else " in %d slots" % slots))
+        done = queue.Queue()
+        running = {}
+        used = 0
+        while pending or running:
+            # pack as many of the pending tests as will fit into the
+            # available slots, taking them in order
+            for entry in list(pending):
+                if len(running) >= maxConcurrent:
+                    break
+                idx,test = entry
+                width = self.testSlots(test, cmds)
+                # a test that is too big for the slots is allowed
+                # to execute by itself
+                if slots is not None and running and used + width > slots:
+                    continue
+                pending.remove(entry)
+                used = used + width
+                running[idx] = width
+                t = threading.Thread(target=self.concurrentTest,
+                                     args=(done, idx, test, cmdargs, cmds, testDef))
+                t.start()
+            # wait for a test to complete
+            idx, testLog, results = done.get()
+            used = used - running.pop(idx)
+            self.recordTest(testLog, results, self.tests[idx], cmds, testDef)
+            testresults[idx] = testLog
+        log['testresults'] = [t for t in testresults if t is not None]
+        return
+
+    def runTests(self, log, cmdargs, cmds, testDef):
+        log['testresults'] = []
+        maxConcurrent, slots = self.concurrency(cmds, testDef)
+        if 1 < maxConcurrent:
+            self.runConcurrentTests(log, cmdargs, cmds, testDef, maxConcurrent, slots)
+        else:
+            for test in self.tests:
+                # check if we should skip this test
+                if test in self.skip_tests:
+                    log['testresults'].append(self.skipTest(test, cmdargs, testDef))
+                    continue
+
+                testLog, results = self.executeSingleTest(test, cmdargs, cmds, testDef)
+                self.recordTest(testLog, results, test, cmds, testDef)
+                log['testresults'].append(testLog)
+                if self.numTests == self.maxTests:
+                    break
         # record the results
         log['status'] = self.finalStatus
         log['stderr'] = self.finalError
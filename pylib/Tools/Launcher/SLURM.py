@@ -30,11 +30,15 @@ import subprocess
 # @param merge_stdout_stderr       Merge stdout and stderr into one output stream
 # @param stdout_save_lines         Number of lines of stdout to save
 # @param stderr_save_lines         Number of lines of stderr to save
+# @param stdout_save_head_lines    Number of lines from the start of stdout to save in addition to the last stdout_save_lines lines
+# @param stderr_save_head_lines    Number of lines from the start of stderr to save in addition to the last stderr_save_lines lines
 # @param test_dir                  Names of directories to be scanned for tests
 # @param fail_tests                Names of tests that are expected to fail. Can use space or comma between entries. Include the expected return code using the following format: test_name:#
 # @param fail_timeout              Maximum execution time for tests expected to fail
 # @param skip_tests                Names of tests to be skipped
 # @param max_num_tests             Maximum number of tests to run
+# @param max_concurrent_tests      Maximum number of tests to execute at the same time (defaults to 1, or to the number of slots if given)
+# @param slots                     Number of slots (e.g., cores) to pack concurrently executing tests into - each test occupies np (or ppn) slots
 # @param job_name                  User-defined name for job
 # @param modules_unload            Modules to unload
 # @param modules                   Modules to load
@@ -70,11 +74,15 @@ class SLURM(LauncherMTTTool):
         self.options['merge_stdout_stderr'] = (False, "Merge stdout and stderr into one output stream")
         self.options['stdout_save_lines'] = (-1, "Number of lines of stdout to save")
         self.options['stderr_save_lines'] = (-1, "Number of lines of stderr to save")
+        self.options['stdout_save_head_lines'] = (0, "Number of lines from the start of stdout to save in addition to the last stdout_save_lines lines")
+        self.options['stderr_save_head_lines'] = (0, "Number of lines from the start of stderr to save in addition to the last stderr_save_lines lines")
         self.options['test_dir'] = (None, "Names of directories to be scanned for tests")
         self.options['fail_tests'] = (None, "Names of tests that are expected to fail. Can use space or comma between entries. Include the expected return code using the following format: test_name:#")
         self.options['fail_timeout'] = (None, "Maximum execution time for tests expected to fail")
         self.options['skip_tests'] = (None, "Names of tests to be skipped")
         self.options['max_num_tests'] = (None, "Maximum number of tests to run")
+        self.options['max_concurrent_tests'] = (None, "Maximum number of tests to execute at the same time (defaults to 1, or to the number of slots if given)")
+        self.options['slots'] = (None, "Number of slots (e.g., cores) to pack concurrently executing tests into - each test occupies np (or ppn) slots")
         self.options['job_name'] = (None, "User-defined name for job")
         self.options['modules_unload'] = (None, "Modules to unload")
         self.options['modules'] = (None, "Modules to load")
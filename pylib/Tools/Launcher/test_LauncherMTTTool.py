@@ -0,0 +1,55 @@
+# run this via pytest
+# export MTT_HOME=/path/to/mtt
+# pytest ./test_LauncherMTTTool.py
+#   add the -s argument to display print lines
+#   add the -v argument to be verbose
+# ie  pytest -sv ./test_LauncherMTTTool.py
+import pytest
+import os
+import sys
+sys.path.append(os.path.join(os.environ['MTT_HOME'], "pylib/System"))
+sys.path.append(os.path.join(os.environ['MTT_HOME'], "pylib/Tools/Launcher"))
+import TestDef as TD
+from LauncherMTTTool import LauncherMTTTool
+
+class Harasser(object):
+   def start(self, testDef):
+      return []
+   def check(self, ids, testDef):
+      return None
+   def stop(self, ids, testDef):
+      pass
+
+class ExecuteCmd(object):
+   def execute(self, options, cmdargs, testDef):
+      if cmdargs[-1] == 'broken':
+         raise OSError("cannot execute broken")
+      return {'status': 0, 'stdout': [], 'stderr': []}
+
+class Logger(object):
+   def verbose_print(self, msg):
+      pass
+
+def setup():
+   td = TD.TestDef()
+   td.harasser = Harasser()
+   td.execmd = ExecuteCmd()
+   td.logger = Logger()
+   launcher = LauncherMTTTool()
+   launcher.tests = ['good', 'broken']
+   # 'broken' is expected to fail, so any non-zero status passes it
+   launcher.expected_returncodes = {'good': 0, 'broken': None}
+   return td, launcher
+
+def test_concurrentTestRaised():
+   td, launcher = setup()
+   log = {}
+   launcher.runConcurrentTests(log, ['mpirun'], {}, td, 2, None)
+   results = dict((t['test'], t) for t in log['testresults'])
+   assert results['good']['result'] == td.MTT_TEST_PASSED
+   # a test that could not be executed fails whatever it was expected to do
+   assert results['broken']['result'] == td.MTT_TEST_FAILED
+   assert results['broken']['stderr'] == ["cannot execute broken"]
+   assert launcher.numPass == 1
+   assert launcher.numFail == 1
+   assert launcher.finalStatus == 1
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015-2019 Intel, Inc.  All rights reserved.
+# $COPYRIGHT$
+#
+# Additional copyrights may follow
+#
+# $HEADER$
+#
+
+
+import os
+import signal
+import asyncio
+import functools
+import threading
+import weakref
+from BaseMTTUtility import *
+
+
+# the event loop thread does not survive a fork, so a forked child
+# starts its own loop - reset right after the fork where Python can
+# tell us about it, and otherwise when first used in the child
+_engines = weakref.WeakSet()
+
+def _reset_after_fork():
+    for engine in list(_engines):
+        engine._reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+# asyncio.get_running_loop() is new in Python 3.7 - before that,
+# get_event_loop() called from a coroutine returns the running loop
+_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+
+## @addtogroup Utilities
+# @{
+# @section AsyncExecuteCmd
+# Execute commands and capture their stdout and stderr using a single
+# asyncio event loop, so many commands can run at once without a
+# thread per command. Selected in place of ExecuteCmd with --async-execmd
+# @}
+class AsyncExecuteCmd(BaseMTTUtility):
+    def __init__(self):
+        BaseMTTUtility.__init__(self)
+        self.options = {}
+        # the ExecuteCmd plugin that prepares commands and
+        # assembles their results for us
+        self.execmd = None
+        self._reset()
+        _engines.add(self)
+        return
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def print_name(self):
+        return "AsyncExecuteCmd"
+
+    def print_options(self, testDef, prefix):
+        lines = testDef.printOptions(self.options)
+        for line in lines:
+            print(prefix + line)
+        return
+
+    def setExecuteCmd(self, execmd):
+        self.execmd = execmd
+
+    def _get_loop(self):
+        if self.pid != os.getpid():
+            self._reset()
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever, name="AsyncExecuteCmd")
+                thread.daemon = True
+                thread.start()
+            return self.loop
+
+    def _call(self, coro):
+        # run a coroutine on our event loop and wait for the result.
+        # Must not be called from the event loop thread itself
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+    async def _pump(self, stream, name, capture):
+        while True:
+            chunk = await stream.read(capture.chunksize)
+            capture.feed(name, chunk)
+            if not chunk:
+                return
+
+    async def _kill_after(self, proc, seconds, grace=1):
+        await asyncio.sleep(seconds)
+        # be polite and provide a SIGTERM to let them
+        # exit cleanly, then hammer it with a cannonball
+        try:
+            proc.send_signal(signal.SIGTERM)
+            await asyncio.sleep(grace)
+            if proc.returncode is None:
+                proc.kill()
+        except ProcessLookupError:
+            # already gone - just a race condition
+            pass
+
+    async def _run(self, job):
+        capture = job['capture']
+        proc = await asyncio.create_subprocess_exec(*job['mycmdargs'],
+                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                        env=job['env'])
+        killer = None
+        if job['timeout'] is not None:
+            killer = asyncio.ensure_future(self._kill_after(proc, job['timeout']))
+        try:
+            await asyncio.gather(self._pump(proc.stdout, 'stdout', capture),
+                                 self._pump(proc.stderr, 'stderr', capture))
+            return await proc.wait()
+        except BaseException:
+            # don't leave the child behind if we were cancelled
+            if proc.returncode is None:
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+            raise
+        finally:
+            if killer is not None:
+                killer.cancel()
+
+    async def execute_async(self, options, cmdargs, testDef, quiet=False, callback=None):
+        """Awaitable version of execute(). The callback, if given, is
+        called with the stream name and each line as it is read
+        """
+        result, job = self.execmd._begin(options, cmdargs, testDef, quiet, callback)
+        if job is None:
+            return result
+        try:
+            returncode = await self._run(job)
+            finish = functools.partial(self.execmd._finish, job, testDef, returncode)
+        except OSError as e:
+            finish = functools.partial(self.execmd._finish, job, testDef, error=e)
+        # assembling the results can block, e.g. querying squeue for
+        # the jobs of srun commands, so keep it off the event loop
+        return await _running_loop().run_in_executor(None, finish)
+
+    async def _execute_all(self, commands, testDef, quiet, callback):
+        return await asyncio.gather(*[self.execute_async(options, cmdargs, testDef, quiet, callback)
+                                      for options, cmdargs in commands])
+
+    def execute_many(self, commands, testDef, quiet=False, callback=None):
+        """Run a list of (options, cmdargs) commands concurrently and
+        return their results in the same order
+        """
+        return self._call(self._execute_all(commands, testDef, quiet, callback))
+
+    def execute(self, options, cmdargs, testDef, quiet=False, callback=None):
+        return self._call(self.execute_async(options, cmdargs, testDef, quiet, callback))
+
+    def check_for_slurm_jobids(self, unique_identifier, prev_stdout, prev_stderr):
+        return self.execmd.check_for_slurm_jobids(unique_identifier, prev_stdout, prev_stderr)
@@ -10,6 +10,8 @@
 
 
 import os
+import shutil
+import tempfile
 from BaseMTTUtility import *
 
 ## @addtogroup Utilities
@@ -173,7 +175,12 @@ class Compilers(BaseMTTUtility):
         return
 
     def check_compile(self, testDef, macro, c_code, compiler):
-        # write out a little test program
+        # write out a little test program - do this in a private
+        # directory so that sections executing concurrently in the
+        # same location don't trample on each other
+        cwd = os.getcwd()
+        tmpdir = tempfile.mkdtemp(prefix="mttcc")
+        os.chdir(tmpdir)
         fh = open("spastic.c", 'w')
         for ln in c_code:
             print(ln, file=fh)
@@ -181,12 +188,12 @@ class Compilers(BaseMTTUtility):
 
         # Attempt to compile it
         mycmdargs = [compiler, "-c", "spastic.c"]
-        results = testDef.execmd.execute(None, mycmdargs, testDef, quiet=True)
-
-        # cleanup the test
-        os.remove("spastic.c")
-        if os.path.exists("spastic.o"):
-            os.remove("spastic.o")
+        try:
+            results = testDef.execmd.execute(None, mycmdargs, testDef, quiet=True)
+        finally:
+            # cleanup the test
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
         if 0 == results['status']:
             return True
@@ -11,79 +11,307 @@
 
 from builtins import str
 import sys
-import select
+import selectors
 import subprocess
-import time
 import datetime
-import signal
-import os, threading, errno
+import os
 from contextlib import contextmanager
 from BaseMTTUtility import *
 import random
+import mmap
+import tempfile
+from array import array
+from collections import deque
+from collections.abc import Sequence
 
 
-class TimeoutThread(object):
-    def __init__(self, seconds):
-        self.seconds = seconds
-        self.cond = threading.Condition()
-        self.cancelled = False
-        self.thread = threading.Thread(target=self._wait)
-
-    def run(self):
-        # start the timer
-        self.thread.start()
-
-    def _wait(self):
-        with self.cond:
-            self.cond.wait(self.seconds)
-
-            if not self.cancelled:
-                self.timed_out()
-
-    def cancel(self):
-        # cancel the timeout, if it hasn't already fired
-        with self.cond:
-            self.cancelled = True
-            self.cond.notify()
-        self.thread.join()
-
-    def timed_out(self):
-        # raise exception to signal timeout
-        raise NotImplementedError
-
-class KillProcessThread(TimeoutThread):
-    def __init__(self, seconds, pid):
-        super(KillProcessThread, self).__init__(seconds)
-        self.pid = pid
-
-    def timed_out(self):
-        # be polite and provide a SIGTERM to let them
-        # exit cleanly
-        try:
-            os.kill(self.pid, signal.SIGTERM)
-        except OSError as e:
-            # if it is already gone, then ignore the
-            # error - just a race condition
-            if e.errno not in (errno.EPERM, errno. ESRCH):
-                raise e
-        # wait a little bit
-        time.sleep(1)
-        # hammer it with a cannonball
-        try:
-            os.kill(self.pid, signal.SIGKILL)
-        except OSError as e:
-            # If the process is already gone, ignore the error.
-            if e.errno not in (errno.EPERM, errno. ESRCH):
-                raise e
-
 @contextmanager
-def processTimeout(seconds, pid):
-    timeout = KillProcessThread(seconds, pid)
-    timeout.run()
+def processTimeout(scheduler, seconds, pid):
+    # no timeout was requested
+    if seconds is None:
+        yield
+        return
+    timeout = scheduler.kill_after(seconds, pid)
     try:
         yield
     finally:
-        timeout.cancel()
+        scheduler.cancel(timeout)
+
+class SpilledLines(Sequence):
+    """Read-only list of output lines that were spilled to a file.
+
+    The file is memory-mapped while it is read, so the lines are only
+    decoded as they are accessed, and unmapped again so that holding
+    many of these does not hold as many open files. Lines can still
+    be appended. text() returns the whole output as a single string,
+    the same as '\\n'.join(lines). Pickling keeps just the file name,
+    so checkpointed logs stay small.
+    """
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+        self._offsets = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'count': self.count}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['count'])
+
+    @contextmanager
+    def _mmap(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b''
+                return
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield m
+        finally:
+            m.close()
+
+    def _index(self):
+        # offsets of the start of each line, plus the end of the last one
+        if self._offsets is None:
+            with self._mmap() as m:
+                offsets = array('q', [0])
+                pos = m.find(b'\n')
+                while pos >= 0:
+                    offsets.append(pos + 1)
+                    pos = m.find(b'\n', pos + 1)
+            self._offsets = offsets
+        return self._offsets
+
+    def _line(self, i):
+        offsets = self._index()
+        with open(self.path, 'rb') as f:
+            f.seek(offsets[i])
+            return f.read(offsets[i+1] - offsets[i] - 1).decode('utf-8', errors='replace')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            offsets = self._index()
+            with self._mmap() as m:
+                return [m[offsets[n]:offsets[n+1]-1].decode('utf-8', errors='replace')
+                        for n in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("line index out of range")
+        return self._line(i)
+
+    def __iter__(self):
+        with self._mmap() as m:
+            start = 0
+            for _ in range(self.count):
+                end = m.find(b'\n', start)
+                yield m[start:end].decode('utf-8', errors='replace')
+                start = end + 1
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return "<%d lines of output in %s>" % (self.count, self.path)
+
+    def extend(self, lines):
+        lines = list(lines)
+        if not lines:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        self.count += len(lines)
+        self._offsets = None
+
+    def append(self, line):
+        self.extend([line])
+
+    def text(self):
+        if not self.count:
+            return ""
+        with self._mmap() as m:
+            return m[:len(m)-1].decode('utf-8', errors='replace')
+
+
+class RetainedLines(object):
+    """Lines of output kept from a command.
+
+    With a limit only the last tail lines, plus optionally the first
+    head lines, are held while the command runs, so memory use does
+    not grow with the amount of output. Without a limit, output past
+    spillbytes is written to a file in spilldir instead of memory.
+    """
+    def __init__(self, tail=0, head=0, name='output', spilldir=None, spillbytes=0):
+        self.head = []
+        self.headmax = head if tail > 0 else 0
+        self.tail = deque(maxlen=tail) if tail > 0 else []
+        self.count = 0
+        self.name = name
+        self.spilldir = spilldir
+        self.spillbytes = spillbytes if tail <= 0 and spilldir is not None else 0
+        self.nbytes = 0
+        self.spillpath = None
+        self.spillfile = None
+
+    def _spill(self):
+        os.makedirs(self.spilldir, exist_ok=True)
+        fd, self.spillpath = tempfile.mkstemp(prefix=self.name + '-', suffix='.txt', dir=self.spilldir)
+        self.spillfile = os.fdopen(fd, 'wb')
+        lines = self.tail
+        self.tail = []
+        self._write(lines)
+
+    def _write(self, lines):
+        if self.spillfile is None:
+            self.spillfile = open(self.spillpath, 'ab')
+        if lines:
+            self.spillfile.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def extend(self, lines):
+        self.count += len(lines)
+        if self.spillpath is not None:
+            self._write(lines)
+            return
+        if len(self.head) < self.headmax:
+            n = self.headmax - len(self.head)
+            self.head.extend(lines[:n])
+            lines = lines[n:]
+        self.tail.extend(lines)
+        if self.spillbytes:
+            self.nbytes += sum(map(len, lines)) + len(lines)
+            if self.nbytes > self.spillbytes:
+                self._spill()
+
+    def append(self, line):
+        self.extend([line])
+
+    def dropped(self):
+        if self.spillpath is not None:
+            return 0
+        return self.count - len(self.head) - len(self.tail)
+
+    def lines(self):
+        if self.spillpath is not None:
+            if self.spillfile is not None:
+                self.spillfile.close()
+                self.spillfile = None
+            return SpilledLines(self.spillpath, self.count)
+        if self.dropped() > 0 and self.head:
+            return self.head + ["**** %d LINES OMITTED ****" % self.dropped()] + list(self.tail)
+        return self.head + list(self.tail)
+
+    def __iter__(self):
+        return iter(self.lines())
+
+    def __len__(self):
+        if self.spillpath is not None:
+            return self.count
+        return len(self.head) + len(self.tail)
+
+
+# output lines that check_for_slurm_jobids looks for
+SLURM_JOBID_PREFIXES = ('Submitted batch job ', 'salloc: Granted job allocation ')
+
+class OutputCapture(object):
+    """Collect the stdout and stderr of a child process.
+
+    The pipes are drained with non-blocking reads of large chunks, and
+    only complete lines are decoded, so a child writing a long line
+    without a newline to one pipe does not stall the other one.
+    """
+    def __init__(self, testDef=None, merge=False, chunksize=65536,
+                 stdoutlines=0, stderrlines=0, stdouthead=0, stderrhead=0,
+                 spilldir=None, spillbytes=0, elk=True, callback=None):
+        self.testDef = testDef
+        self.merge = merge
+        self.chunksize = chunksize
+        self.callback = callback
+        self.partial = {}
+        self.stdout = RetainedLines(stdoutlines, stdouthead, 'stdout', spilldir, spillbytes)
+        self.stderr = RetainedLines(stderrlines, stderrhead, 'stderr', spilldir, spillbytes)
+        # the ELK log interleaves both streams, so it can only be
+        # bounded when both of them are
+        if not elk:
+            self.elkoutput = None
+        elif stdoutlines > 0 and stderrlines > 0:
+            self.elkoutput = deque(maxlen=stdoutlines + stderrlines)
+        else:
+            self.elkoutput = []
+        # slurm job id lines are kept even if they fall out of the buffers
+        self.jobid_lines = {'stdout': [], 'stderr': []}
+
+    def _print_lines(self, name, lines):
+        logger = self.testDef.logger if self.testDef is not None else None
+        if logger is None or not logger.printout:
+            return
+        if logger.timestampeverything:
+            for line in lines:
+                logger.verbose_print(name + ': ' + line)
+        else:
+            logger.verbose_print('\n'.join([name + ': ' + line for line in lines]))
+
+    def add_lines(self, name, lines):
+        self._print_lines(name, lines)
+        if self.callback is not None:
+            for line in lines:
+                self.callback(name, line)
+        if name == 'stderr' or self.merge:
+            dest = 'stderr'
+            self.stderr.extend(lines)
+        else:
+            dest = 'stdout'
+            self.stdout.extend(lines)
+        if self.elkoutput is not None:
+            self.elkoutput.extend([(dest, line) for line in lines])
+        self.jobid_lines[dest].extend([line for line in lines if line.startswith(SLURM_JOBID_PREFIXES)])
+
+    def feed(self, name, chunk):
+        """Add a chunk of raw output from the named stream. An empty
+        chunk marks the end of the stream
+        """
+        partial = self.partial.setdefault(name, bytearray())
+        if not chunk:
+            # EOF - flush any unterminated last line
+            if partial:
+                self.add_lines(name, [partial.decode('utf-8', errors='replace').rstrip()])
+                del partial[:]
+            return
+        nl = chunk.rfind(b'\n')
+        if nl < 0:
+            partial.extend(chunk)
+            return
+        data = bytes(partial) + chunk[:nl]
+        self.partial[name] = bytearray(chunk[nl+1:])
+        lines = data.decode('utf-8', errors='replace').split('\n')
+        self.add_lines(name, [line.rstrip() for line in lines])
+
+    def run(self, p):
+        sel = selectors.DefaultSelector()
+        for name, pipe in (('stdout', p.stdout), ('stderr', p.stderr)):
+            if pipe is None:
+                continue
+            fd = pipe.fileno()
+            os.set_blocking(fd, False)
+            sel.register(fd, selectors.EVENT_READ, name)
+        try:
+            # loop until the pipes close
+            while sel.get_map():
+                for key, _ in sel.select():
+                    try:
+                        chunk = os.read(key.fd, self.chunksize)
+                    except BlockingIOError:
+                        continue
+                    if not chunk:
+                        sel.unregister(key.fd)
+                    self.feed(key.data, chunk)
+        finally:
+            sel.close()
 
 
 ## @addtogroup Utilities
@@ -123,7 +351,7 @@ class ExecuteCmd(BaseMTTUtility):
         val = None
         if options and name in options:
             val = options[name]
-        if val is None or val < 0:
+        if val is None or int(val) < 0:
             return 0
         return int(val)
 
@@ -146,24 +374,12 @@ class ExecuteCmd(BaseMTTUtility):
                     slurm_jobids.append(int(jobid))
 
         try:
-            stdout = []
             p = subprocess.Popen(['squeue', '-o', '%i', '-h', '-t', 'all', '-n', unique_identifier],
                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            with processTimeout(100000000, p.pid):
-                while True:
-                    reads = [p.stdout.fileno()]
-                    ret = select.select(reads, [], [])
-                    stdout_done = True
-                    for fd in ret[0]:
-                        if fd == p.stdout.fileno():
-                            read = p.stdout.readline()
-                            if read:
-                                read = read.decode('utf-8').rstrip()
-                                stdout.append(read)
-                                stdout_done = False
-                    if stdout_done:
-                        break
-            for l in stdout:
+            capture = OutputCapture()
+            capture.run(p)
+            p.wait()
+            for l in capture.stdout:
                 if l.isdigit:
                     slurm_jobids.append(int(l))
         except:
@@ -172,10 +388,13 @@ class ExecuteCmd(BaseMTTUtility):
         return list(set(slurm_jobids))
 
 
-    def execute(self, options, cmdargs, testDef, quiet=False):
+    def _begin(self, options, cmdargs, testDef, quiet, callback):
+        '''Prepare to run a command. Returns a (result, job) tuple, where
+        result is set if the command is not to be run at all
+        '''
         # if this is a dryrun, just declare success
         if 'dryrun' in testDef.options and testDef.options['dryrun']:
-            return (0, [], [], 0)
+            return (0, [], [], 0), None
 
         #  check the options for a directive to merge
         # stdout into stderr
@@ -184,21 +403,24 @@ class ExecuteCmd(BaseMTTUtility):
         # check for line limits
         stdoutlines = self._positive_int_option(options, 'stdout_save_lines')
         stderrlines = self._positive_int_option(options, 'stderr_save_lines')
+        stdouthead = self._positive_int_option(options, 'stdout_save_head_lines')
+        stderrhead = self._positive_int_option(options, 'stderr_save_head_lines')
 
         # check for timing request
         t1 = self._bool_option(options, 'cmdtime')
         t2 = self._bool_option(options, 'time')
         time_exec = t1 or t2
 
-        elapsed_secs = -1
-        elapsed_datetime = None
-
         # unique identifier for capturing slurm jobids.
         # This identifier is used in check_for_slurm_jobids() function
         # along with squeue to capture any slurm job ids that contain the identifier
+        # The job name is only given to this child as other commands
+        # may be launched concurrently with it
+        env = None
         if cmdargs[0] == 'srun':
             unique_identifier = str(random.randint(0,999999999999))
-            os.environ['SLURM_JOB_NAME'] = unique_identifier
+            env = dict(os.environ)
+            env['SLURM_JOB_NAME'] = unique_identifier
         else:
             unique_identifier = None
 
@@ -236,127 +458,101 @@ class ExecuteCmd(BaseMTTUtility):
                                                  datetime.datetime.now(),
                                                  0, None,
                                                  testDef)
-            return (1, [], ["MTT ExecuteCmd error: no cmdargs"], 0)
-
-        # define storage to catch the output
-        stdout = []
-        stderr = []
-        elkoutput = []
+            return (1, [], ["MTT ExecuteCmd error: no cmdargs"], 0), None
+
+        # define storage to catch the output, only retaining
+        # as many lines as we were asked to save. Unlimited output
+        # beyond output_spill_bytes is written under the scratch dir
+        spillbytes = self._positive_int_option(testDef.options, 'output_spill_bytes')
+        spilldir = None
+        if spillbytes and testDef.options.get('scratchdir'):
+            spilldir = os.path.join(testDef.options['scratchdir'], 'output')
+        elk = not quiet and testDef.elkLogger is not None and testDef.options['elk_id'] is not None
+        capture = OutputCapture(testDef, merge,
+                                stdoutlines=stdoutlines, stderrlines=stderrlines,
+                                stdouthead=stdouthead, stderrhead=stderrhead,
+                                spilldir=spilldir, spillbytes=spillbytes, elk=elk,
+                                callback=callback)
+
+        if options is not None and 'timeout' in options and options['timeout'] is not None:
+            timeout = int(options['timeout'])
+        else:
+            timeout = None
+
+        job = {'cmdargs': cmdargs,
+               'mycmdargs': mycmdargs,
+               'env': env,
+               'timeout': timeout,
+               'capture': capture,
+               'unique_identifier': unique_identifier,
+               'time_exec': time_exec,
+               'elk': elk,
+               'starttime': datetime.datetime.now()}
+        return None, job
+
+    def _run(self, job, testDef):
+        '''Run the command, feeding its output to the job's capture,
+        and return its exit status
+        '''
+        # open a subprocess with stdout and stderr
+        # as distinct pipes so we can capture their
+        # output as the process runs
+        p = subprocess.Popen(job['mycmdargs'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=job['env'])
+        # wait for the process within the timeout - its output closing
+        # does not mean it has exited, and leaving the timeout cancels
+        # the SIGKILL that follows the SIGTERM
+        with processTimeout(testDef.scheduler, job['timeout'], p.pid):
+            try:
+                job['capture'].run(p)
+            finally:
+                p.wait()
+        return p.returncode
 
-        # start the process so that we can catch an exception
-        # if it times out, assuming timeout was set
+    def _finish(self, job, testDef, returncode=None, error=None):
+        '''Assemble the results of a command run by _run, or of one
+        that could not be started because of the given error
+        '''
+        capture = job['capture']
+        time_exec = job['time_exec']
+        starttime = job['starttime']
+        endtime = datetime.datetime.now()
+        elapsed_datetime = endtime - starttime
         results = {}
-        p = None
-
-        starttime = datetime.datetime.now()
 
         # it is possible that the command doesn't exist or
-        # isn't in our path, so protect us
-        try:
-            # open a subprocess with stdout and stderr
-            # as distinct pipes so we can capture their
-            # output as the process runs
-            p = subprocess.Popen(mycmdargs,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if options is not None and 'timeout' in options and options['timeout'] is not None:
-                t = int(options['timeout'])
-            else:
-                t = 100000000
-            with processTimeout(t, p.pid):
-                # loop until the pipes close
-                while True:
-                    ret = select.select([p.stdout.fileno(), p.stderr.fileno()], [], [])
-
-                    stdout_done = True
-                    stderr_done = True
-
-                    for fd in ret[0]:
-                        # if the data
-                        if fd == p.stdout.fileno():
-                            read = p.stdout.readline()
-                            if read:
-                                read = read.decode('utf-8').rstrip()
-                                testDef.logger.verbose_print('stdout: ' + read)
-                                if merge:
-                                    stderr.append(read)
-                                    elkoutput.append(("stderr", read))
-                                else:
-                                    stdout.append(read)
-                                    elkoutput.append(("stdout", read))
-                                stdout_done = False
-                        elif fd == p.stderr.fileno():
-                            read = p.stderr.readline()
-                            if read:
-                                read = read.decode('utf-8').rstrip()
-                                testDef.logger.verbose_print('stderr: ' + read)
-                                elkoutput.append(("stderr", read))
-                                stderr.append(read)
-                                stderr_done = False
-
-                    if stdout_done and stderr_done:
-                        break
-            p.wait()
-
-            endtime = datetime.datetime.now()
-
-            if p.returncode == -15 or p.returncode == -9:
-                # check if slurm was run, and record job ids
-                slurm_jobids = self.check_for_slurm_jobids(unique_identifier, stdout, stderr)
+        # isn't in our path
+        if error is not None:
+            results['status'] = 1
+            results['stdout'] = []
+            results['stderr'] = [str(error)]
+            results['slurm_job_ids'] = []
+        else:
+            # check if slurm was run, and record job ids
+            slurm_jobids = self.check_for_slurm_jobids(job['unique_identifier'], capture.jobid_lines['stdout'], capture.jobid_lines['stderr'])
+            if returncode == -15 or returncode == -9:
                 # print execmd timed out info, including any slurm job ids
                 testDef.logger.verbose_print("ExecuteCmd Timed Out%s%s" % (" : elapsed=%s"%elapsed_datetime if time_exec else "", \
                                                                            " : slurm_jobids=%s" % ','.join([str(j) for j in slurm_jobids]) if slurm_jobids else ""), \
                                              timestamp=endtime if time_exec else None)
-                stderr.append("**** TIMED OUT ****")
+                capture.stderr.append("**** TIMED OUT ****")
                 results['timedout'] = True
-                results['status'] = p.returncode
-                results['stdout'] = stdout[-1 * stdoutlines:]
-                results['stderr'] = stderr[-1 * stderrlines:]
-                results['slurm_job_ids'] = slurm_jobids
-                if time_exec:
-                    endtime = datetime.datetime.now()
-                    elapsed_datetime = endtime - starttime
-                    results['elapsed_secs'] = elapsed_datetime.total_seconds()
-
-                if not quiet and testDef.elkLogger is not None and testDef.options['elk_id'] is not None:
-                    testDef.elkLogger.log_execmd_elk(cmdargs,
-                                                     results['status'] if 'status' in results else None,
-                                                     elkoutput,
-                                                     results['timedout'] if 'timedout' in results else None,
-                                                     starttime,
-                                                     endtime,
-                                                     (endtime - starttime).total_seconds(),
-                                                     results['slurm_job_ids'] if 'slurm_job_ids' in results else None,
-                                                     testDef)
-                return results
-
+            else:
+                # print execmd info, including any slurm job ids
+                testDef.logger.verbose_print("ExecuteCmd done%s%s" % (" : elapsed=%s" % elapsed_datetime if time_exec else "", \
+                                                                      " : slurm_jobids=%s" % ','.join([str(j) for j in slurm_jobids]) if slurm_jobids else ""), \
+                                             timestamp=endtime if time_exec else None)
             if time_exec:
-                elapsed_datetime = endtime - starttime
                 results['elapsed_secs'] = elapsed_datetime.total_seconds()
-
-            # check if slurm was run, and record job ids
-            slurm_jobids = self.check_for_slurm_jobids(unique_identifier, stdout, stderr)
-            # print execmd info, including any slurm job ids
-            testDef.logger.verbose_print("ExecuteCmd done%s%s" % (" : elapsed=%s" % elapsed_datetime if time_exec else "", \
-                                                                  " : slurm_jobids=%s" % ','.join([str(j) for j in slurm_jobids]) if slurm_jobids else ""), \
-                                         timestamp=endtime if time_exec else None)
-
-            results['status'] = p.returncode
-            results['stdout'] = stdout[-1 * stdoutlines:]
-            results['stderr'] = stderr[-1 * stderrlines:]
+            results['status'] = returncode
+            results['stdout'] = capture.stdout.lines()
+            results['stderr'] = capture.stderr.lines()
             results['slurm_job_ids'] = slurm_jobids
-        except OSError as e:
-            if p:
-                p.wait()
-            endtime = datetime.datetime.now()
-            results['status'] = 1
-            results['stdout'] = []
-            results['stderr'] = [str(e)]
-            results['slurm_job_ids'] = []
 
-        if not quiet and testDef.elkLogger is not None and testDef.options['elk_id'] is not None:
-            testDef.elkLogger.log_execmd_elk(cmdargs,
+        if job['elk']:
+            testDef.elkLogger.log_execmd_elk(job['cmdargs'],
                                              results['status'] if 'status' in results else None,
-                                             elkoutput,
+                                             list(capture.elkoutput),
                                              results['timedout'] if 'timedout' in results else None,
                                              starttime,
                                              endtime,
@@ -365,3 +561,21 @@ class ExecuteCmd(BaseMTTUtility):
                                              testDef)
 
         return results
+
+    def execute(self, options, cmdargs, testDef, quiet=False, callback=None):
+        result, job = self._begin(options, cmdargs, testDef, quiet, callback)
+        if job is None:
+            return result
+        try:
+            returncode = self._run(job, testDef)
+        except OSError as e:
+            return self._finish(job, testDef, error=e)
+        return self._finish(job, testDef, returncode)
+
+    def execute_many(self, commands, testDef, quiet=False, callback=None):
+        '''Run a list of (options, cmdargs) commands and return their
+        results in the same order. They are run one at a time here -
+        AsyncExecuteCmd runs them concurrently
+        '''
+        return [self.execute(options, cmdargs, testDef, quiet, callback)
+                for options, cmdargs in commands]
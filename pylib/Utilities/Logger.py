@@ -18,6 +18,8 @@ import datetime
 from BaseMTTUtility import *
 import json
 import pickle
+import struct
+import time
 
 ## @addtogroup Utilities
 # @{
@@ -25,21 +27,72 @@ import pickle
 # Log results and provide debug output when directed
 # @}
 class Logger(BaseMTTUtility):
+    # stages that are run again when resuming, as later sections
+    # depend on what they set up, along with the harasser
+    resumeRerun = ("MTTDefaults", "LauncherDefaults", "Reporter", "DefaultHarasser")
+    # the journal is flushed with every result, but only synced to
+    # disk once this many results or seconds have gone by
+    journalSyncCount = 16
+    journalSyncSecs = 10
+    # key marking the journaled results of sections that changed the
+    # environment, which are run again when resuming so that the
+    # sections after them see the same environment
+    environChanged = "environ_changed"
+
     def __init__(self):
         BaseMTTUtility.__init__(self)
         self.fh = sys.stdout
         self.results = []
+        self._index()
+        # the number of times the results were reordered
+        self.reordered = 0
         self.options = {}
         self.printout = False
         self.timestamp = False
         self.cmdtimestamp = False
         self.timestampeverything = False
         self.stage_start = {}
+        self.journal = None
+        self.journalPending = []
+        self.journalUnsynced = 0
+        self.journalSynced = time.time()
+        self.journalEnviron = None
+        self.resumed = set()
+        self.checkpointed = {}
 
     def reset(self):
         self.results = []
+        self._index()
         self.stage_start = {}
 
+    def _index(self):
+        # index the results by section, by the stage they belong to
+        # and by the keys they contain, so they can be found without
+        # scanning the entire log
+        self.sections = {}
+        self.stages = {}
+        self.keyed = {}
+        for result in self.results:
+            self._indexResult(result)
+
+    def _indexResult(self, result):
+        try:
+            section = result['section']
+            # the first result logged for a section is the one returned
+            self.sections.setdefault(section, result)
+            self.stages.setdefault(section.split(":")[0].strip(), []).append(result)
+        except (KeyError, AttributeError):
+            pass
+        for key in result:
+            self.keyed.setdefault(key, []).append(result)
+
+    def reindex(self):
+        """Rebuild the indexes after the order of the results changed"""
+        self._index()
+        # anything that kept track of how far into the results it got
+        # has to start over
+        self.reordered += 1
+
     def print_name(self):
         return "Logger"
 
@@ -65,6 +118,18 @@ class Logger(BaseMTTUtility):
                 self.printout = True
         except KeyError:
             pass
+        # load the results of the journals being merged
+        try:
+            if testDef.options['merge_journals'] is not None:
+                self.mergeJournals(testDef.options['merge_journals'].split(","))
+        except KeyError:
+            pass
+        # open the results journal, if requested
+        try:
+            if testDef.options['journal'] is not None:
+                self.openJournal(testDef.options['journal'], testDef.options['resume'])
+        except KeyError:
+            pass
         try:
             if testDef.options['extraverbose']:
                 self.printout = True
@@ -143,6 +208,8 @@ class Logger(BaseMTTUtility):
         log['elapsed'] = (stage_end-self.stage_start[stagename]).total_seconds()
         log['starttime'] = self.stage_start[stagename]
         log['endtime'] = stage_end
+        # the result is now complete
+        self.flushJournal()
 
     def verbose_print(self, string, timestamp=None):
         if self.printout:
@@ -161,13 +228,129 @@ class Logger(BaseMTTUtility):
             return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     def close(self):
+        self.closeJournal()
         if self.fh is not sys.stdout:
             self.fh.close()
         return
 
+    def _writeRecords(self, f, results):
+        # each record is a pickled result preceded by its length, so
+        # a record cut short by the run being killed can be detected
+        for result in results:
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            f.write(struct.pack(">I", len(data)))
+            f.write(data)
+
+    def _readRecords(self, f):
+        results = []
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            size = struct.unpack(">I", header)[0]
+            data = f.read(size)
+            if len(data) < size:
+                break
+            try:
+                results.append(pickle.loads(data))
+            except Exception:
+                break
+        return results
+
+    def openJournal(self, path, resume=False):
+        """Append every logged result to the given journal. When
+        resuming, first replay the results of the sections that
+        succeeded in the journal, so they are not run again
+        """
+        if resume:
+            try:
+                with open(path, "rb") as f:
+                    records = self._readRecords(f)
+            except IOError:
+                records = []
+            # the last result logged for a section is the one that counts
+            latest = {}
+            for n,result in enumerate(records):
+                if 'section' in result:
+                    latest[result['section']] = (n, result)
+            for n,result in sorted(latest.values(), key=lambda r: r[0]):
+                if result.get('status') != 0 or result.get(self.environChanged) or \
+                   result['section'].split(":")[0].strip() in self.resumeRerun:
+                    continue
+                self.results.append(result)
+                self.resumed.add(result['section'])
+            self._index()
+            self.verbose_print("RESUMING %d SUCCESSFUL SECTIONS FROM %s" % (len(self.resumed), path))
+        # start the journal over with just what was replayed, which
+        # also drops any partial record left by an earlier run
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            self._writeRecords(f, self.results)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self.journal = open(path, "ab")
+        self.journalSynced = time.time()
+        self.journalEnviron = dict(os.environ)
+
+    def mergeJournals(self, paths):
+        """Add the results recorded in the given journals to the log,
+        less those of the Reporter sections that reported them
+        """
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    records = self._readRecords(f)
+            except IOError as e:
+                print("Unable to read journal " + path + ": " + str(e))
+                sys.exit(1)
+            for result in records:
+                if result.get('section', "").split(":")[0].strip() != "Reporter":
+                    result.pop(self.environChanged, None)
+                    self.results.append(result)
+            self.verbose_print("MERGED %d RESULTS FROM %s" % (len(records), path))
+        self._index()
+
+    def isResumed(self, section):
+        """Return True if the section succeeded in the run being resumed"""
+        return section in self.resumed
+
+    def flushJournal(self, sync=False):
+        if self.journal is None:
+            return
+        if self.journalPending:
+            self._writeRecords(self.journal, [dict(result, **{self.environChanged: True}) if changed else result
+                                              for result,changed in self.journalPending])
+            # flush so nothing is lost if the run is killed, and so
+            # nothing buffered gets duplicated by a fork
+            self.journal.flush()
+            self.journalUnsynced += len(self.journalPending)
+            self.journalPending = []
+        if self.journalUnsynced and (sync or self.journalUnsynced >= self.journalSyncCount or
+                                     time.time() - self.journalSynced >= self.journalSyncSecs):
+            os.fsync(self.journal.fileno())
+            self.journalUnsynced = 0
+            self.journalSynced = time.time()
+
+    def closeJournal(self):
+        if self.journal is None:
+            return
+        self.flushJournal(sync=True)
+        self.journal.close()
+        self.journal = None
+
     def logResults(self, title, result, testDef):
         self.verbose_print("LOGGING results for " + title)
         self.results.append(result)
+        self._indexResult(result)
+        # journal it once the section is done adding to it, which is
+        # when it ends or the next result is logged
+        if self.journal is not None:
+            self.flushJournal()
+            # note if the section changed the environment
+            environ = dict(os.environ)
+            self.journalPending.append((result, environ != self.journalEnviron))
+            self.journalEnviron = environ
         # Log to elog file for injesting into ELK
         if testDef.elkLogger is not None and testDef.options['elk_id'] is not None:
             testDef.elkLogger.log_to_elk(result, 'section', testDef)
@@ -199,28 +382,48 @@ class Logger(BaseMTTUtility):
             return self.results
         # we have been passed the name of a section, so
         # see if we have its log in the results
-        for result in self.results:
-            try:
-                if key == result['section']:
-                    return result
-            except KeyError:
-                pass
-        # if we get here, then the key wasn't found
-        return None
+        return self.sections.get(key)
+
+    def getLogsOfStage(self, stage):
+        """Return the results of every section of the given stage,
+        e.g. TestRun, in the order they were logged
+        """
+        return self.stages.get(stage, [])
+
+    def getLogsWithKey(self, key):
+        """Return the results that contain the given key, e.g.
+        provisioning, in the order they were logged
+        """
+        return self.keyed.get(key, [])
 
 
     def checkpointLog(self, cpfile):
+        # the first checkpoint writes the whole log, later ones only
+        # append the results logged since - unless the log was reset
+        # or reordered in the meantime, when it is written over
         self.verbose_print("CHECKPOINTING LOG TO " + cpfile)
-        with open(cpfile + '.pkl', "wb") as f:
-            pickle.dump(self.results, f)
+        done = self.checkpointed.get(cpfile)
+        if done is not None and (done[0] is not self.results or done[1] > len(self.results) or
+                                 done[2] != self.reordered):
+            done = None
+        with open(cpfile + '.pkl', "ab" if done is not None else "wb") as f:
+            self._writeRecords(f, self.results[done[1] if done is not None else 0:])
+        self.checkpointed[cpfile] = (self.results, len(self.results), self.reordered)
         self.verbose_print("CHECKPOINTED LOG TO " + cpfile)
 
     def restartLog(self, cpfile):
         try:
             self.verbose_print("READING LOG FROM " + cpfile)
             fh = open(cpfile + '.pkl', 'rb')
-            self.results = pickle.load(fh)
+            try:
+                # checkpoints written by older versions hold the
+                # pickled list of results
+                self.results = pickle.load(fh)
+            except Exception:
+                fh.seek(0)
+                self.results = self._readRecords(fh)
             fh.close()
+            self._index()
             self.outputLog()
         except IOError:
             print("Failed to open checkpoint file for reading", file=self.fh)
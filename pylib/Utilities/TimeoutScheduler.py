@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015-2018 Intel, Inc. All rights reserved.
+# $COPYRIGHT$
+#
+# Additional copyrights may follow
+#
+# $HEADER$
+#
+
+
+import os
+import time
+import heapq
+import errno
+import signal
+import itertools
+import threading
+import traceback
+import weakref
+from BaseMTTUtility import *
+
+
+# A forked child (parallel sections, harassers) must not act on its
+# parent's timeouts, and cannot use its thread. Schedulers are reset in
+# the child right after the fork where Python can tell us about it, and
+# otherwise when first used in a process other than their own
+_schedulers = weakref.WeakSet()
+
+def _reset_after_fork():
+    for scheduler in list(_schedulers):
+        scheduler._reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class Timeout(object):
+    """A pending call scheduled with the TimeoutScheduler"""
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+        self.fired = False
+        self.finished = threading.Event()
+        # further timeout scheduled by the callback, such as
+        # the SIGKILL that follows a SIGTERM
+        self.followup = None
+
+    def active(self):
+        return not self.cancelled and not self.fired
+
+
+def _signal_process(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError as e:
+        # if it is already gone, then ignore the
+        # error - just a race condition
+        if e.errno not in (errno.EPERM, errno.ESRCH):
+            raise e
+
+
+## @addtogroup Utilities
+# @{
+# @section TimeoutScheduler
+# Run timed calls, such as killing commands that exceed their timeout,
+# from a single shared thread
+# @}
+class TimeoutScheduler(BaseMTTUtility):
+    def __init__(self):
+        BaseMTTUtility.__init__(self)
+        self.options = {}
+        self._reset()
+        _schedulers.add(self)
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()
+        self.ncancelled = 0
+        self.thread = None
+
+    def print_name(self):
+        return "TimeoutScheduler"
+
+    def print_options(self, testDef, prefix):
+        lines = testDef.printOptions(self.options)
+        for line in lines:
+            print(prefix + line)
+        return
+
+    def schedule(self, seconds, callback):
+        """Call callback on the scheduler thread after the given number
+        of seconds, unless the returned Timeout is cancelled first
+        """
+        if self.pid != os.getpid():
+            self._reset()
+        timeout = Timeout(time.monotonic() + seconds, callback)
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="TimeoutScheduler")
+                self.thread.daemon = True
+                self.thread.start()
+            heapq.heappush(self.heap, (timeout.deadline, next(self.counter), timeout))
+            # only wake the thread if this is now the first deadline
+            if self.heap[0][2] is timeout:
+                self.cond.notify()
+        return timeout
+
+    def cancel(self, timeout):
+        """Cancel a timeout. If it has already fired, wait for it to
+        complete and then cancel anything it scheduled in turn, such as
+        the SIGKILL that follows a SIGTERM
+        """
+        if self.pid != os.getpid():
+            # a timeout of the parent process we were forked from
+            return
+        with self.cond:
+            if not timeout.fired:
+                if not timeout.cancelled:
+                    timeout.cancelled = True
+                    self.ncancelled += 1
+                    self._compact()
+                return
+        timeout.finished.wait()
+        if timeout.followup is not None:
+            self.cancel(timeout.followup)
+
+    def kill_after(self, seconds, pid, grace=1):
+        """Send SIGTERM to pid after the given number of seconds,
+        followed by SIGKILL if it is still around grace seconds later
+        """
+        def term():
+            # be polite and provide a SIGTERM to let them
+            # exit cleanly, then hammer it with a cannonball
+            _signal_process(pid, signal.SIGTERM)
+            timeout.followup = self.schedule(grace, lambda: _signal_process(pid, signal.SIGKILL))
+        timeout = self.schedule(seconds, term)
+        return timeout
+
+    def _compact(self):
+        # cancelled timeouts are left in the heap until they come due;
+        # drop them once they make up most of it
+        if self.ncancelled > 64 and self.ncancelled > len(self.heap) // 2:
+            self.heap = [e for e in self.heap if not e[2].cancelled]
+            heapq.heapify(self.heap)
+            self.ncancelled = 0
+
+    def _run(self):
+        with self.cond:
+            while True:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                    self.ncancelled -= 1
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                delay = self.heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                timeout = heapq.heappop(self.heap)[2]
+                timeout.fired = True
+                self.cond.release()
+                try:
+                    timeout.callback()
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    timeout.finished.set()
+                    self.cond.acquire()
@@ -14,7 +14,7 @@ from builtins import str
 
 import shutil
 import os
-from threading import Timer
+import threading
 from BaseMTTUtility import *
 import signal
 import datetime
@@ -22,7 +22,8 @@ import datetime
 ## @addtogroup Utilities
 # @{
 # @section Watchdog
-# Generate and exception after a given amount of time
+# Generate and exception after a given amount of time, using the
+# shared TimeoutScheduler
 # @param  timeout  Time in seconds before generating exception
 # @}
 class Watchdog(BaseMTTUtility):
@@ -48,6 +49,17 @@ class Watchdog(BaseMTTUtility):
             print(prefix + line)
         return
 
+    # Schedule the handler with the shared timeout scheduler
+    def _schedule(self, timeout, handler):
+        # the handler may block waiting for the plugin transition
+        # semaphore, so give it its own thread rather than holding
+        # up the command timeouts on the scheduler thread
+        def fire():
+            thread = threading.Thread(target=handler)
+            thread.daemon = True
+            thread.start()
+        return self.testDef.scheduler.schedule(int(timeout.total_seconds()), fire)
+
     # Start the watchdog timer
     def start(self, handler=None, timerId=None, timeout=None):
         if handler is None:
@@ -57,26 +69,23 @@ class Watchdog(BaseMTTUtility):
                 handler = self.defaultHandler
         if timerId is None:
             if timeout is None:
-                timeout = defaultTimeout
+                timeout = self.defaultTimeout
             else:
                 timeout = self.convert_to_timeout(timeout)
-            self.timer.append(Timer(int(timeout.total_seconds()),
-                              handler))
+            self.timer.append(self._schedule(timeout, handler))
             self.handler.append(handler)
-            self.timer[-1].start()
             return len(self.timer) - 1
         else:
             if timerId >= 0 and timerId < len(self.timer) and \
-                  (self.timer[timerId] is None or not self.timer[timerId].is_alive()):
-                self.timer[timerId] = Timer(int(self.timeout.total_seconds()), handler)
+                  (self.timer[timerId] is None or not self.timer[timerId].active()):
+                self.timer[timerId] = self._schedule(self.timeout, handler)
                 self.handler[timerId] = handler
-                self.timer[-1].start()
             return timerId
 
     # Stop the watchdog timer
     def stop(self, timerId):
         if timerId >= 0 and timerId < len(self.timer) and self.timer[timerId]:
-            self.timer[timerId].cancel()
+            self.testDef.scheduler.cancel(self.timer[timerId])
             self.timer[timerId] = None
 
     # Reset the watchdog timer
@@ -6,10 +6,13 @@ from __future__ import unicode_literals
 import os
 import pprint
 import psycopg2
+import psycopg2.pool
 import string
 import re
 import json
-from threading import Lock
+import collections
+import contextlib
+from threading import Lock, local
 import sys
 import datetime
 
@@ -258,17 +261,91 @@ for t in FIELD_INFO_TABLES:
         continue
     assert t in TABLE_ORDER, "%s in FIELD_INFO_TABLES not in TABLE_ORDER" % (t)
 
+# The operators a search value can use, given as {"operator": value}
+SEARCH_OPERATORS = ["from", "to", "prefix", "in"]
+
+# Number of rows to look up or insert per statement when ingesting in bulk
+BULK_ROWS = 1000
+
+# Number of dimension ids to remember per process
+ID_CACHE_SIZE = 50000
+
+##########################################################
+# The id of a dimension row that has yet to be looked up
+class _DimensionId():
+    def __init__(self):
+        self.id = None
+
+    def __repr__(self):
+        return "<dimension %x>" % id(self)
+
+def _dimension_value(value):
+    if isinstance(value, _DimensionId):
+        return value.id
+    return value
+
+# The dimension rows referenced by a batch of results. Rather than
+# looking each one up as it is found, they are collected here and
+# resolved with a few queries per table once the whole batch is known.
+class _Dimensions():
+    def __init__(self):
+        # (table, table_id, fields) -> {key: (values, _DimensionId)}
+        self.requests = {}
+        # the ids looked up, to be cached once they are committed
+        self.found = []
+
+    def select_insert(self, table, table_id, stmt_fields, stmt_values):
+        rows = self.requests.setdefault((table, table_id, tuple(stmt_fields)), {})
+        key = json.dumps(stmt_values, default=repr)
+        if key not in rows:
+            rows[key] = (stmt_values, _DimensionId())
+        return rows[key][1]
+
+    def resolve(self, db):
+        # some rows refer to others (e.g., performance to
+        # latency_bandwidth) so resolve them in rounds
+        pending = dict(self.requests)
+        while 0 < len(pending):
+            ready = [request for request, rows in pending.items()
+                     if not any(isinstance(v, _DimensionId) and v.id is None
+                                for values, dim in rows.values() for v in values)]
+            if 0 == len(ready):
+                raise ValueError("Circular references between dimension rows")
+            for request in ready:
+                table, table_id, stmt_fields = request
+                rows = list(pending.pop(request).values())
+                ids = db._select_insert_many(table, table_id, list(stmt_fields),
+                                             [[_dimension_value(v) for v in values] for values, dim in rows])
+                for (values, dim), found_id in zip(rows, ids):
+                    dim.id = found_id
+                    self.found.append(((table, table_id, stmt_fields, [_dimension_value(v) for v in values]), found_id))
+
 class DatabaseV3():
     _name = '[DB PG V3]'
 
     _force_trial = False
+
+    #
+    # Shared by every connection of the process: the columns and unique
+    # keys of the tables, and the ids of the dimension rows last used
+    # keyed by (table, table_id, fields, values)
+    #
+    _schemas = {}
+    _ids = collections.OrderedDict()
+    _cache_lock = Lock()
+
+    #
+    # The pool of connections shared by the server's threads, and the
+    # connection each thread has checked out for the request it is handling
+    #
+    _pool = None
+    _pool_lock = Lock()
+    _local = local()
     
     def __init__(self, logger, auth):
         self._auth = auth
         self._logger = logger
 
-        self._connection = None
-
     ##########################################################
     def is_available(self):
         if None == self._auth.get("type") or None == self._auth["type"]:
@@ -287,7 +364,7 @@ class DatabaseV3():
 
     ##########################################################
     def is_connected(self):
-        if self._connection is not None:
+        if self._pool is not None:
             return True
         else:
             return False
@@ -298,24 +375,83 @@ class DatabaseV3():
                     " password="+ str(self._auth["password"]) +
                     " host="+     str(self._auth["server"]) +
                     " port="+     str(self._auth["port"]) )
-        self._connection = psycopg2.connect( conn_str )
+        # every resource shares the same pool
+        with self._pool_lock:
+            if DatabaseV3._pool is None:
+                DatabaseV3._pool = psycopg2.pool.ThreadedConnectionPool(self._auth.get("pool_min", 1),
+                                                                        self._auth.get("pool_max", 20),
+                                                                        conn_str)
+
+    @property
+    def _connection(self):
+        # the connection checked out by this thread, checking
+        # one out of the pool if it does not have one yet
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self._pool is None:
+                self.connect()
+            connection = self._pool.getconn()
+            self._local.connection = connection
+        return connection
+
+    @classmethod
+    def release(cls, commit=True):
+        """
+        End the transaction of this thread's connection, committing or
+        rolling it back, and return the connection to the pool.
+        """
+        connection = getattr(cls._local, "connection", None)
+        found = getattr(cls._local, "found", [])
+        cls._local.found = []
+        if connection is None:
+            return
+        cls._local.connection = None
+        broken = connection.closed != 0
+        try:
+            if broken:
+                pass
+            elif commit:
+                connection.commit()
+                # only now can other connections see the rows
+                cls._cache_ids(found)
+            else:
+                connection.rollback()
+        except psycopg2.Error:
+            broken = True
+            raise
+        finally:
+            # a broken connection is replaced by a new one when needed
+            cls._pool.putconn(connection, close=broken)
+
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        """
+        Scope a transaction, e.g. that of a request: it is committed if
+        the block completes and rolled back if it raises.
+        """
+        try:
+            yield
+        except BaseException:
+            cls.release(commit=False)
+            raise
+        cls.release(commit=True)
 
     def get_cursor(self):
         # Don't forget to: _cursor.close()
-#       if (self._connection.closed == 1)
-#           self.connect()
         try:
             cursor = self._connection.cursor()
         except Exception as ex:
+            # the connection was lost, and whatever this transaction did
+            # with it, so fail the whole request for the client to retry
+            # rather than carry on with the rest of it on a new one
             self._logger.debug("get cursor: got exception %s" % str(ex))
-            self.connect()
-            cursor = self._connection.cursor()
+            self.release(commit=False)
+            raise
         return cursor
 
     def disconnect(self):
-        self._connection.commit()
-        self._connection.close()
-        self._connection = None
+        self.release(commit=True)
 
     ##########################################################
     def _fields(self, table_name):
@@ -363,52 +499,46 @@ class DatabaseV3():
                 return True
         return False
 
-    def _summary_compare(self, row1, row2):
-        """row1 is from combiner and row2 is from result
-        """
-        for k,v in row2.items():
-            if v != row1[k]:
-                return False
-        return True
-
-    def _summary_find_in_combiner(self, combiner, row):
-        for i,r in enumerate(combiner):
-            if self._summary_compare(r,row):
-                return i
-        return -1
-
     def _summary(self, phase, columns, search, options=[]):
         self._logger.debug("%s _summary()" % (self._name))
 
-        data = self._detail(phase, list(set(columns + ["test_result"])), search, options=options)
-
-        combiner = []
-        for row in data:
-            combiner_ind = self._summary_find_in_combiner(combiner, row)
-            if combiner_ind == -1:
-                newrow = row.copy()
-                newrow["test_result_failed"]   = 0
-                newrow["test_result_passed"]   = 0
-                newrow["test_result_skipped"]  = 0
-                newrow["test_result_timed_out"] = 0
-                newrow["test_result_unknown"]  = 0
-                combiner.append(newrow)
-            if combiner[combiner_ind]["test_result"] == 0:
-                combiner[combiner_ind]["test_result_failed"] += 1 
-            elif combiner[combiner_ind]["test_result"] == 1:
-                combiner[combiner_ind]["test_result_passed"] += 1
-            elif combiner[combiner_ind]["test_result"] == 2:
-                combiner[combiner_ind]["test_result_skipped"] += 1
-            elif combiner[combiner_ind]["test_result"] == 3:
-                combiner[combiner_ind]["test_result_timed_out"] += 1
-            else:
-                combiner[combiner_ind]["test_result_unknown"] += 1
+        query = self._detail_query(phase, columns, search)
+        if query is None:
+            return None
+
+        #
+        # Let the database count the results of each group, rather
+        # than sending us every row to count
+        #
+        test_result = "%s.%s" % (query["phase_name"], FIELD_NAMES_MAPPING["test_result"])
+        counts = [("test_result_failed",    "%s = 0" % (test_result)),
+                  ("test_result_passed",    "%s = 1" % (test_result)),
+                  ("test_result_skipped",   "%s = 2" % (test_result)),
+                  ("test_result_timed_out", "%s = 3" % (test_result)),
+                  ("test_result_unknown",   "%s IS NULL OR %s NOT IN (0, 1, 2, 3)" % (test_result, test_result))]
+
+        group_by = query["names"]
+        select_stmt =  "SELECT %s " % (", ".join(group_by + ["COUNT(*) FILTER (WHERE %s)" % (c) for n,c in counts]))
+        select_stmt += query["from"]
+        if query["where"]:
+            select_stmt += "WHERE %s " % (query["where"])
+        if group_by:
+            select_stmt += "GROUP BY %s " % (", ".join(group_by))
+
+        self._logger.debug("DEBUG (select_stmt): %s" % (select_stmt))
+
+        cursor = self.get_cursor()
+        cursor.execute( select_stmt, query["params"] )
+        row = cursor.fetchone()
 
-        if "test_result" not in columns:
-            for row in combiner:
-                del row["test_result"]
+        result = []
+        while row is not None:
+            row = [str(v) if isinstance(v, datetime.date) or isinstance(v, datetime.timedelta) else v for v in row]
+            result.append({field:val for field,val in zip(query["columns"] + [n for n,c in counts], row)})
+            row = cursor.fetchone()
+        cursor.close()
 
-        return combiner
+        return result
         
     def _select_item_in(self, selection, lst):
         for item in selection:
@@ -416,9 +546,71 @@ class DatabaseV3():
                 return item
         return None
 
-    def _detail(self, phase, columns, search, options=[]):
-        self._logger.debug("%s _detail()" % (self._name))
-
+    def _search_predicate(self, column, value):
+        """Return the predicate searching the column for the value, with
+        the parameters to bind to it. The value can be:
+          - a value, matched exactly
+          - a list of values, any of which matches
+          - a dict of SEARCH_OPERATORS: "from" and/or "to" for an inclusive
+            range (e.g. of start_timestamp), "prefix" for the strings that
+            start with it and "in" for a list of values
+        Raises ValueError if it is none of those.
+        """
+        if isinstance(value, list):
+            value = {"in": value}
+        if not isinstance(value, dict):
+            return ("%s = %%s" % (column), [value])
+
+        predicates = []
+        params = []
+        for op in value.keys():
+            if op not in SEARCH_OPERATORS:
+                raise ValueError("Unknown search operator '%s' for %s" % (op, column))
+        if "from" in value and "to" in value:
+            predicates.append("%s BETWEEN %%s AND %%s" % (column))
+            params.extend([value["from"], value["to"]])
+        elif "from" in value:
+            predicates.append("%s >= %%s" % (column))
+            params.append(value["from"])
+        elif "to" in value:
+            predicates.append("%s <= %%s" % (column))
+            params.append(value["to"])
+        if "prefix" in value:
+            if not isinstance(value["prefix"], str):
+                raise ValueError("The search prefix for %s must be a string" % (column))
+            predicates.append("%s LIKE %%s" % (column))
+            params.append(value["prefix"].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if "in" in value:
+            if not isinstance(value["in"], list):
+                raise ValueError("The search values 'in' for %s must be a list" % (column))
+            if 0 == len(value["in"]):
+                predicates.append("FALSE")
+            else:
+                predicates.append("%s IN %%s" % (column))
+                params.append(tuple(value["in"]))
+        if 0 == len(predicates):
+            raise ValueError("No search operator for %s" % (column))
+        return (" AND ".join(predicates), params)
+
+    def _join_path(self, phase_name, table):
+        """The tables to join, in order, to get from the phase table to
+        the given one
+        """
+        parents = TABLE_TREE[table]["parents"]
+        if phase_name in parents:
+            return [table]
+        for parent in parents:
+            if self._is_a_parent([phase_name], parent):
+                return self._join_path(phase_name, parent) + [table]
+        return [table]
+
+    def _detail_query(self, phase, columns, search):
+        """Work out the parts of a query of a phase shared by _detail and
+        _summary: the qualified names of the columns of those asked for
+        that the phase has, and the FROM and WHERE clauses for the search
+        along with the parameters to bind to the latter.
+        Raises ValueError for an invalid search.
+        """
         if "install" in phase:
             phase_name = "mpi_install"
         elif "test_build" in phase:
@@ -426,17 +618,17 @@ class DatabaseV3():
         elif "test_run" in phase:
             phase_name = "test_run"
         else:
-            self._logger.debug("%s _summary() -- Invalid phase input" % (self._name))
+            self._logger.debug("%s _detail_query() -- Invalid phase input" % (self._name))
             return None
 
-        legal_columns = set([f for f in columns if f in COMMON_FIELDS \
+        legal_columns = [f for f in set(columns) if f in COMMON_FIELDS \
                              or FIELDS_TABLE[FIELD_NAMES_MAPPING[f]] == phase_name \
-                             or self._is_a_parent([phase_name], FIELDS_TABLE[FIELD_NAMES_MAPPING[f]])])
+                             or self._is_a_parent([phase_name], FIELDS_TABLE[FIELD_NAMES_MAPPING[f]])]
 
         legal_search = {k:v for k,v in search.items() if k in COMMON_FIELDS \
                              or FIELDS_TABLE[FIELD_NAMES_MAPPING[k]] == phase_name \
                              or self._is_a_parent([phase_name], FIELDS_TABLE[FIELD_NAMES_MAPPING[k]])}
-        legal_search_columnnames = {"%s.%s" % (phase_name if k in COMMON_FIELDS else FIELDS_TABLE[FIELD_NAMES_MAPPING[k]],FIELD_NAMES_MAPPING[k]):v for k,v in legal_search.items()}
+        legal_search_columnnames = {self._column_name(phase_name, k):v for k,v in legal_search.items()}
         legal_search_keys = set(legal_search.keys())
 
         tables = set([FIELDS_TABLE[FIELD_NAMES_MAPPING[f]] for f in list(legal_columns) if f not in COMMON_FIELDS] + \
@@ -444,28 +636,60 @@ class DatabaseV3():
 
         self._logger.debug("DEBUG (tables): %s" % (str(tables)))
 
-        table_order = [t for t in TABLE_ORDER if t in tables or (t not in ["mpi_install", "test_build", "test_run"] and self._is_a_parent_of_any([t], tables))]
+        # only join the tables needed to reach those we use
+        joins = set()
+        for t in tables:
+            if t != phase_name:
+                joins.update(self._join_path(phase_name, t))
+        table_order = [t for t in TABLE_ORDER if t in joins]
 
         self._logger.debug("DEBUG (table_order): %s" % (str(table_order)))
 
-        select_stmt =  "SELECT %s " % (", ".join([FIELD_NAMES_MAPPING[f] for f in legal_columns]))
-        select_stmt += "FROM %s " % (phase_name)
-        select_stmt += "%s " % (" ".join(["INNER JOIN %s ON %s.%s = %s.%s " % (t,t,TABLE_TREE[t]["key"], self._select_item_in(TABLE_TREE[t]["parents"], [phase_name] + table_order[:i]), TABLE_TREE[t]["foreign_key"]) for i,t in enumerate(table_order)]))
+        from_clause =  "FROM %s " % (phase_name)
+        from_clause += "%s " % (" ".join(["INNER JOIN %s ON %s.%s = %s.%s " % (t,t,TABLE_TREE[t]["key"], self._select_item_in(TABLE_TREE[t]["parents"], [phase_name] + table_order[:i]), TABLE_TREE[t]["foreign_key"]) for i,t in enumerate(table_order)]))
+
+        predicates = []
+        params = []
+        for k,v in legal_search_columnnames.items():
+            predicate, predicate_params = self._search_predicate(k, v)
+            predicates.append(predicate)
+            params.extend(predicate_params)
+        where_clause = " AND ".join(predicates)
+
+        return {"phase_name": phase_name,
+                "columns": legal_columns,
+                "names": [self._column_name(phase_name, f) for f in legal_columns],
+                "from": from_clause,
+                "where": where_clause,
+                "params": params}
+
+    def _column_name(self, phase_name, field):
+        # the name of the field's column, qualified by its table
+        table = phase_name if field in COMMON_FIELDS else FIELDS_TABLE[FIELD_NAMES_MAPPING[field]]
+        return "%s.%s" % (table, FIELD_NAMES_MAPPING[field])
+
+    def _detail(self, phase, columns, search, options=[]):
+        self._logger.debug("%s _detail()" % (self._name))
+
+        query = self._detail_query(phase, columns, search)
+        if query is None:
+            return None
 
-        where_clause = " AND ".join(["%s = '%s'" % (k,v) for k,v in legal_search_columnnames.items()])
-        if where_clause:
-            select_stmt += "WHERE %s " % (where_clause)
+        select_stmt =  "SELECT %s " % (", ".join(query["names"]))
+        select_stmt += query["from"]
+        if query["where"]:
+            select_stmt += "WHERE %s " % (query["where"])
 
         self._logger.debug("DEBUG (select_stmt): %s" % (select_stmt))
 
         cursor = self.get_cursor()
-        cursor.execute( select_stmt )
+        cursor.execute( select_stmt, query["params"] )
         row = cursor.fetchone()
 
         result = []
         while row is not None:
             row = [str(v) if isinstance(v, datetime.date) or isinstance(v, datetime.timedelta) else v for v in row]
-            result.append({field:val for field,val in zip(legal_columns,row)})
+            result.append({field:val for field,val in zip(query["columns"],row)})
             row = cursor.fetchone()
         cursor.close()
 
@@ -565,86 +789,249 @@ class DatabaseV3():
         return value
 
     ##########################################################
-    def _select_insert(self, table, table_id, stmt_fields, stmt_values):
-        found_id = -1
+    def _id_key(self, table, table_id, stmt_fields, stmt_values):
+        key = (table, table_id, tuple(stmt_fields), tuple(stmt_values))
+        try:
+            hash(key)
+        except TypeError:
+            # e.g., a list value - not worth caching
+            return None
+        return key
 
-        cursor = self.get_cursor()
+    def _cached_id(self, key):
+        if key is None:
+            return None
+        with self._cache_lock:
+            found_id = self._ids.get(key)
+            if found_id is not None:
+                self._ids.move_to_end(key)
+            return found_id
+
+    @classmethod
+    def _cache_ids(cls, found):
+        # remember ids that have been committed to the database
+        with cls._cache_lock:
+            for key, found_id in found:
+                if key is not None:
+                    cls._ids[key] = found_id
+                    cls._ids.move_to_end(key)
+            while len(cls._ids) > ID_CACHE_SIZE:
+                cls._ids.popitem(last=False)
+
+    def _found_ids(self, found):
+        # ids to cache once this thread's transaction is committed
+        if getattr(self._local, "found", None) is None:
+            self._local.found = []
+        self._local.found.extend(found)
+
+    @contextlib.contextmanager
+    def _savepoint(self, cursor):
+        # a failed INSERT is undone without aborting the rest of the
+        # request's transaction
+        cursor.execute("SAVEPOINT select_insert")
+        try:
+            yield
+        except psycopg2.Error:
+            cursor.execute("ROLLBACK TO SAVEPOINT select_insert")
+            raise
+        cursor.execute("RELEASE SAVEPOINT select_insert")
 
-        cursor.execute("SELECT * FROM %s LIMIT 0" % table)
-        all_fields_for_table = [d[0] for d in cursor.description]
+    def _select_insert(self, table, table_id, stmt_fields, stmt_values):
+        key = self._id_key(table, table_id, stmt_fields, stmt_values)
+        found_id = self._cached_id(key)
+        if found_id is not None:
+            self._logger.debug("%s _select_insert(%s, %s) = [Cached] %s" % (self._name, table, table_id, str(found_id)) )
+            return found_id
+
+        schema = self._schema(table)
 
         #
         # Build the SELECT and INSERT statements
-        #
-        select_stmt = "\nSELECT %s FROM %s \n"  % (table_id, table)
-        insert_stmt = "\nINSERT INTO %s \n (%s" % (table, table_id)
-        insert_stmt_values = []
-
         #
         # we filter because the client may have sent us stuff our database has
         # no clue about
         #
-        count = 0
-        for field in stmt_fields:
-            if field in all_fields_for_table:
-                insert_stmt = insert_stmt + ", " + field
-                insert_stmt_values.append(stmt_values[count])
-                if count == 0:
-                    select_stmt = select_stmt + " WHERE "
-                else:
-                    select_stmt = select_stmt + " AND "
-                select_stmt = select_stmt + field + " = %s"
+        fields = []
+        values = []
+        for field, value in zip(stmt_fields, stmt_values):
+            if field in schema['columns']:
+                fields.append(field)
+                values.append(self._clean_value(value))
             else:
                 self._logger.debug("WARNING: _select_insert field %s not in table %s" % (field, table))
-            count += 1
+        values = tuple(values)
 
+        select_stmt = "\nSELECT %s FROM %s \n"  % (table_id, table)
+        if 0 < len(fields):
+            select_stmt = select_stmt + " WHERE " + " AND ".join([field + " = %s" for field in fields])
         select_stmt = select_stmt + "\n ORDER BY " + table_id + " ASC LIMIT 1"
 
-        insert_stmt = insert_stmt + ") \nVALUES ("
-        insert_stmt = insert_stmt + " %s"
-        for field in stmt_fields:
-            if field in all_fields_for_table:
-                insert_stmt = insert_stmt + ", %s"
-        insert_stmt = insert_stmt + ")"
+        insert_stmt = ("\nINSERT INTO %s \n (%s) \nVALUES (nextval('%s_%s_seq')" %
+                       (table, ", ".join([table_id] + fields), table, table_id))
+        insert_stmt = insert_stmt + "".join([", %s"] * len(fields)) + ")"
+        # If a unique key guards against duplicates let it settle races
+        # with other connections inserting the same row
+        guarded = any(unique <= set(fields) for unique in schema['unique'])
+        if guarded:
+            insert_stmt = insert_stmt + "\nON CONFLICT DO NOTHING"
+        insert_stmt = insert_stmt + "\nRETURNING " + table_id
 
         #
         # Try the select to see if we need to insert
         #
-        #self._logger.debug(select_stmt)
-        #self._logger.debug(insert_stmt)
-        #self._logger.debug(str(insert_stmt_values))
-
         cursor = self.get_cursor()
-
-        values = tuple(s.replace("\x00", "\uFFFD") if isinstance(s, str) else s
-               for s in insert_stmt_values)
         cursor.execute( select_stmt, values )
         rows = cursor.fetchone()
         if rows is not None:
             found_id = rows[0]
             self._logger.debug("%s _select_insert(%s, %s) = [Found] %s" % (self._name, table, table_id, str(found_id)) )
-            cursor.close()
-            return found_id
+        else:
+            #
+            # Insert this value
+            #
+            self._logger.debug(insert_stmt)
+            self._logger.debug( ", ".join(str(x) for x in values) )
+            failed = None
+            try:
+                with self._savepoint(cursor):
+                    cursor.execute( insert_stmt, values )
+                    rows = cursor.fetchone()
+            except psycopg2.IntegrityError as ex:
+                rows = None
+                failed = ex
+            if rows is None:
+                # someone else inserted it in the meantime
+                cursor.execute( select_stmt, values )
+                rows = cursor.fetchone()
+                if rows is None and failed is not None:
+                    raise failed
+            found_id = rows[0]
+            self._logger.debug("%s _select_insert(%s, %s) = [Insert] %s" % (self._name, table, table_id, str(found_id)) )
 
-        #
-        # Insert this value
-        #
-        self._logger.debug(insert_stmt)
-        self._logger.debug( ", ".join(str(x) for x in values) )
-        found_id = self._get_nextval( "%s_%s_seq" % (table, table_id))
+        cursor.close()
 
-        insert_stmt_values.insert(0, found_id)
-        values = tuple(s.replace("\x00", "\uFFFD") if isinstance(s, str) else s
-               for s in insert_stmt_values)
-        cursor.execute( insert_stmt, values )
-        # Make sure to commit after every INSERT
-        self._connection.commit()
+        self._found_ids([(key, found_id)])
+        return found_id
 
-        self._logger.debug("%s _select_insert(%s, %s) = [Insert] %s" % (self._name, table, table_id, str(found_id)) )
+    ##########################################################
+    def _schema(self, table):
+        # the columns of the table with their types, and the sets of
+        # columns that must be unique. Only looked up once per process.
+        with self._cache_lock:
+            if table in self._schemas:
+                return self._schemas[table]
 
+        cursor = self.get_cursor()
+        select_stmt = ("SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+                       "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum")
+        cursor.execute( select_stmt, (table, ) )
+        columns = dict(cursor.fetchall())
+        select_stmt = ("SELECT array_agg(a.attname::text) FROM pg_index i "
+                       "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+                       "WHERE i.indrelid = %s::regclass AND i.indisunique AND NOT i.indisprimary "
+                       "GROUP BY i.indexrelid")
+        cursor.execute( select_stmt, (table, ) )
+        unique = [set(row[0]) for row in cursor.fetchall()]
         cursor.close()
 
-        return found_id
+        schema = {'columns': columns, 'unique': unique}
+        with self._cache_lock:
+            self._schemas[table] = schema
+        return schema
+
+    def _columns(self, table):
+        # the columns of the table and their types
+        return self._schema(table)['columns']
+
+    def _clean_value(self, value):
+        if isinstance(value, str):
+            return value.replace("\x00", "\uFFFD")
+        return value
+
+    def _insert_many(self, table, table_id, stmt_fields, rows, on_conflict=False):
+        # insert the rows, returning their new ids. Fields our database
+        # has no clue about are dropped. With on_conflict, rows that
+        # would break a unique key are skipped and their id is None.
+        # Does not commit.
+        columns = self._columns(table)
+        keep = [i for i, field in enumerate(stmt_fields) if field in columns]
+        for field in stmt_fields:
+            if field not in columns:
+                self._logger.debug("WARNING: _insert_many field %s not in table %s" % (field, table))
+        fields = [table_id] + [stmt_fields[i] for i in keep]
+        template = "(" + ", ".join(["%s"] * len(fields)) + ")"
+
+        ids = []
+        cursor = self.get_cursor()
+        for start in range(0, len(rows), BULK_ROWS):
+            chunk = rows[start:start + BULK_ROWS]
+            cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s)",
+                           ("%s_%s_seq" % (table, table_id), len(chunk)) )
+            chunk_ids = [row[0] for row in cursor.fetchall()]
+            values = b", ".join(cursor.mogrify(template, [found_id] + [self._clean_value(row[i]) for i in keep])
+                                for found_id, row in zip(chunk_ids, chunk))
+            insert_stmt = "INSERT INTO %s (%s) VALUES " % (table, ", ".join(fields))
+            if on_conflict:
+                cursor.execute( insert_stmt.encode() + values +
+                                (" ON CONFLICT DO NOTHING RETURNING %s" % table_id).encode() )
+                inserted = set(row[0] for row in cursor.fetchall())
+                chunk_ids = [found_id if found_id in inserted else None for found_id in chunk_ids]
+            else:
+                cursor.execute( insert_stmt.encode() + values )
+            ids.extend(chunk_ids)
+        cursor.close()
+
+        self._logger.debug("%s _insert_many(%s, %s) = [Insert] %d rows" % (self._name, table, table_id, len(ids)) )
+        return ids
+
+    def _select_insert_many(self, table, table_id, stmt_fields, rows):
+        # _select_insert for many rows at once: find the ids of those
+        # already in the table and insert the rest. Does not commit.
+        schema = self._schema(table)
+        columns = schema['columns']
+        keep = [i for i, field in enumerate(stmt_fields) if field in columns]
+        fields = [stmt_fields[i] for i in keep]
+        found = {}
+        for n, row in enumerate(rows):
+            found_id = self._cached_id(self._id_key(table, table_id, stmt_fields, row))
+            if found_id is not None:
+                found[n] = found_id
+
+        def select(lookup):
+            # match the rows against the table by joining it with
+            # their values, numbered so we know which row is which
+            if 0 == len(fields) or 0 == len(lookup):
+                return
+            template = "(%s, " + ", ".join(["%%s::%s" % columns[f] for f in fields]) + ")"
+            select_stmt = ("SELECT v.n, MIN(t.%s) FROM %s t JOIN (VALUES " % (table_id, table))
+            join_stmt = (") AS v(n, %s) ON " % ", ".join(fields) +
+                         " AND ".join(["t.%s = v.%s" % (f, f) for f in fields]) +
+                         " GROUP BY v.n")
+            cursor = self.get_cursor()
+            for start in range(0, len(lookup), BULK_ROWS):
+                values = b", ".join(cursor.mogrify(template, [n] + [self._clean_value(rows[n][i]) for i in keep])
+                                    for n in lookup[start:start + BULK_ROWS])
+                cursor.execute( select_stmt.encode() + values + join_stmt.encode() )
+                found.update(dict(cursor.fetchall()))
+            cursor.close()
+
+        select([n for n in range(len(rows)) if n not in found])
+
+        missing = [n for n in range(len(rows)) if n not in found]
+        if 0 < len(missing):
+            # as in _select_insert, a unique key settles races with
+            # other connections inserting the same rows
+            guarded = any(unique <= set(fields) for unique in schema['unique'])
+            cursor = self.get_cursor()
+            with self._savepoint(cursor):
+                ids = self._insert_many(table, table_id, stmt_fields, [rows[n] for n in missing], guarded)
+            cursor.close()
+            found.update((n, found_id) for n, found_id in zip(missing, ids) if found_id is not None)
+            select([n for n in missing if n not in found])
+
+        self._logger.debug("%s _select_insert_many(%s, %s) = [Found] %d [Insert] %d" %
+                           (self._name, table, table_id, len(rows) - len(missing), len(missing)) )
+        return [found[n] for n in range(len(rows))]
 
     ##########################################################
     def get_client_serial(self):
@@ -675,6 +1062,39 @@ class DatabaseV3():
 
         return {'submit_id': submit_id}
 
+    ##########################################################
+    def claim_submission(self, http_username, key):
+        """
+        Claim the Idempotency-Key of a submission for this transaction.
+        Returns the reply stored for it by an earlier request, or None if
+        it has yet to be stored. A concurrent request that claimed the
+        same key holds us here until its transaction ends.
+        """
+        cursor = self.get_cursor()
+        cursor.execute("INSERT INTO submit_reply (http_username, idempotency_key) VALUES (%s, %s) "
+                       "ON CONFLICT DO NOTHING", (http_username, key) )
+        reply = None
+        if 0 == cursor.rowcount:
+            # claimed before - e.g., by a request that failed - so
+            # lock it and see whether it was replied to
+            cursor.execute("SELECT reply FROM submit_reply WHERE http_username = %s AND idempotency_key = %s "
+                           "FOR UPDATE", (http_username, key) )
+            row = cursor.fetchone()
+            if row is not None and row[0] is not None:
+                reply = json.loads(row[0])
+        cursor.close()
+
+        self._logger.debug("%s claim_submission(%s) = %s" % (self._name, key, "[Stored]" if reply is not None else "[New]") )
+        return reply
+
+    def store_submission_reply(self, http_username, key, reply):
+        # committed along with the results it replies for
+        cursor = self.get_cursor()
+        cursor.execute("UPDATE submit_reply SET reply = %s, submitted = now() "
+                       "WHERE http_username = %s AND idempotency_key = %s",
+                       (json.dumps(reply), http_username, key) )
+        cursor.close()
+
     ##########################################################
     def _find_mpi_install_id(self, submit_id, metadata, entry):
         cursor = self.get_cursor()
@@ -1373,8 +1793,75 @@ class DatabaseV3():
         return {'required':fields, 'optional':optional}
 
     def insert_test_run(self, submit_id, metadata, entry):
+        rtn = self.insert_test_runs(submit_id, metadata, [entry])
+        if 'error_msg' in rtn.keys():
+            return rtn
+        return rtn['ids'][0]
+
+    def insert_test_runs(self, submit_id, metadata, entries, dedup=True):
+        """
+        Insert a batch of test runs. The dimension rows they refer to are
+        looked up, and inserted if need be, with a few queries per table,
+        the test runs are inserted with multi-row INSERTs and everything is
+        committed with the request's transaction. With dedup, test runs
+        that are already stored - e.g., by an earlier attempt at the same
+        submission - are looked up instead of inserted again; without it
+        the caller must make sure the submission is new. Returns
+        {'ids': [{'test_run_id': ...}, ...]} in the order of the entries,
+        or {'error_msg': ...} if any of them could not be inserted - in
+        which case none are.
+        """
+        prefix = self._name + " (test_run) "
+
+        dimensions = _Dimensions()
+        # test build info, by the test_build_id the client gave
+        test_builds = {}
+        rows = []
+        for entry in entries:
+            row = self._test_run_row(submit_id, metadata, entry, dimensions, test_builds)
+            if 'error_msg' in row.keys():
+                return row
+            rows.append(row)
+
+        self._logger.debug("%s --- Processing: %d test_run" % (prefix, len(rows)) )
+
+        dimensions.resolve(self)
+
+        # the rows with the same fields are inserted together
+        groups = {}
+        for n, row in enumerate(rows):
+            groups.setdefault(tuple(row['fields']), []).append(n)
+        test_run_ids = [None] * len(rows)
+        for fields, members in groups.items():
+            values = [[_dimension_value(v) for v in rows[n]['values']] for n in members]
+            if dedup:
+                # identical test runs of the batch share a row, as they
+                # did when each was inserted with _select_insert
+                distinct = collections.OrderedDict()
+                for row in values:
+                    distinct.setdefault(json.dumps(row, default=repr), row)
+                found = dict(zip(distinct.keys(),
+                                 self._select_insert_many("test_run", "test_run_id", list(fields),
+                                                          list(distinct.values()))))
+                ids = [found[json.dumps(row, default=repr)] for row in values]
+            else:
+                ids = self._insert_many("test_run", "test_run_id", list(fields), values)
+            for n, test_run_id in zip(members, ids):
+                test_run_ids[n] = test_run_id
+
+        self._found_ids([(self._id_key(*key), found_id) for key, found_id in dimensions.found])
+
+        self._logger.debug("%s --- Processing: test_run = %s" % (prefix, str(test_run_ids)) )
+
+        #
+        # Done
+        #
+        return {'ids': [{'test_run_id': test_run_id} for test_run_id in test_run_ids]}
+
+    def _test_run_row(self, submit_id, metadata, entry, dimensions, test_builds):
+        # the fields and values of the test_run row for this entry, the
+        # dimension ids it refers to being requested from dimensions
         prefix = self._name + " (test_run) "
-        test_run_id = -1
 
         # self._logger.debug( "************** Test Run   ****************" )
         # self._logger.debug( json.dumps( entry, \
@@ -1391,11 +1878,14 @@ class DatabaseV3():
         # Get test_build_id and info
         #
         self._logger.debug("%s --- Processing: test_build_id" % (prefix) )
-        test_build_id = self._find_test_build_id(submit_id, metadata, entry)
-        test_build_info = self._get_test_build_info(test_build_id)
+        key = self._find_value(metadata, entry, 'test_build_id')
+        if key not in test_builds:
+            test_build_id = self._find_test_build_id(submit_id, metadata, entry)
+            test_builds[key] = self._get_test_build_info(test_build_id)
+        test_build_info = test_builds[key]
         if test_build_info is None:
             return {"error_msg": "%s Not able to associate this test run with a test build phase" % (prefix)}
-        self._logger.debug("%s --- Processing: test_build_id = %s" % (prefix, str(test_build_id)) )
+        self._logger.debug("%s --- Processing: test_build_id = %s" % (prefix, str(test_build_info['test_build_id'])) )
 
         #
         # Process: latency_bandwidth
@@ -1420,7 +1910,7 @@ class DatabaseV3():
                     return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
                 values.append( value )
 
-            latency_bandwidth_id = self._select_insert("latency_bandwidth",
+            latency_bandwidth_id = dimensions.select_insert("latency_bandwidth",
                                                        "latency_bandwidth_id",
                                                        fields, values)
 
@@ -1429,7 +1919,7 @@ class DatabaseV3():
             fields = ["latency_bandwidth_id"]
             values = [latency_bandwidth_id]
 
-            performance_id = self._select_insert("performance",
+            performance_id = dimensions.select_insert("performance",
                                                  "performance_id",
                                                  fields, values)
 
@@ -1485,7 +1975,7 @@ class DatabaseV3():
                     return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
                 values.append( value )
 
-            test_run_command_id = self._select_insert("test_run_command",
+            test_run_command_id = dimensions.select_insert("test_run_command",
                                                       "test_run_command_id",
                                                       fields, values)
 
@@ -1508,7 +1998,7 @@ class DatabaseV3():
         values = [test_build_info['test_suite_id'],
                   value]
 
-        test_name_id = self._select_insert("test_names",
+        test_name_id = dimensions.select_insert("test_names",
                                            "test_name_id",
                                            fields, values)
 
@@ -1534,7 +2024,7 @@ class DatabaseV3():
                 values.append( value )
 
             if skip is False:
-                description_id = self._select_insert("description",
+                description_id = dimensions.select_insert("description",
                                                      "description_id",
                                                      fields, values)
 
@@ -1553,7 +2043,7 @@ class DatabaseV3():
                 return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
             values.append( value )
 
-        result_message_id = self._select_insert("result_message",
+        result_message_id = dimensions.select_insert("result_message",
                                                 "result_message_id",
                                                 fields, values)
 
@@ -1576,7 +2066,7 @@ class DatabaseV3():
                     return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
                 values.append( value )
 
-            environment_id = self._select_insert("environment",
+            environment_id = dimensions.select_insert("environment",
                                                  "environment_id",
                                                  fields, values)
 
@@ -1599,7 +2089,7 @@ class DatabaseV3():
                     return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
                 values.append( value )
 
-            clck_id = self._select_insert("cluster_checker",
+            clck_id = dimensions.select_insert("cluster_checker",
                                           "clck_id",
                                           fields, values)
 
@@ -1624,7 +2114,7 @@ class DatabaseV3():
                     return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
                 values.append( value )
 
-            bios_id = self._select_insert("bios",
+            bios_id = dimensions.select_insert("bios",
                                           "bios_id",
                                           fields, values)
 
@@ -1647,7 +2137,7 @@ class DatabaseV3():
                     return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
                 values.append( value )
 
-            firmware_id = self._select_insert("firmware",
+            firmware_id = dimensions.select_insert("firmware",
                                               "firmware_id",
                                               fields, values)
 
@@ -1673,7 +2163,7 @@ class DatabaseV3():
                     return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
                 values.append( value )
 
-            provision_id = self._select_insert("provision",
+            provision_id = dimensions.select_insert("provision",
                                                "provision_id",
                                                fields, values)
 
@@ -1699,7 +2189,7 @@ class DatabaseV3():
                     return {"error_msg": "%s Missing field: %s" % (prefix, field)} 
                 values.append( value )
 
-            harasser_id = self._select_insert("harasser",
+            harasser_id = dimensions.select_insert("harasser",
                                               "harasser_id",
                                               fields, values)
 
@@ -1803,13 +2293,4 @@ class DatabaseV3():
                     values.append( value )
                 fields.append( field )
 
-        test_run_id = self._select_insert("test_run",
-                                          "test_run_id",
-                                          fields, values)
-
-        self._logger.debug("%s --- Processing: test_run = %s" % (prefix, str(test_run_id)) )
-
-        #
-        # Done
-        #
-        return {'test_run_id':test_run_id}
+        return {'fields': fields, 'values': values}
@@ -19,6 +19,8 @@ import random
 import string
 import datetime
 import re
+import io
+import zlib
 import base64
 
 from subprocess import call
@@ -46,6 +48,50 @@ class _JSONEncoder(json.JSONEncoder):
 
 _json_encoder = _JSONEncoder()
 
+#
+# Clients may gzip the body of their requests. This needs to run ahead
+# of the json_in tool, which reads the body. The body is then read up
+# to its decompressed length, which is held to the same limit as the
+# size of any other request body.
+#
+def _gunzip_in():
+    request = cherrypy.serving.request
+    if request.headers.get('Content-Encoding', '').lower() != 'gzip':
+        return
+    limit = cherrypy.server.max_request_body_size
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with cherrypy.HTTPError.handle(zlib.error, 400, 'Invalid gzip request body'):
+        body = decompressor.decompress(request.body.fp.read(), limit + 1 if limit else 0)
+    if limit and len(body) > limit:
+        raise cherrypy.HTTPError(413, 'Request body too large once decompressed')
+    if not decompressor.eof:
+        raise cherrypy.HTTPError(400, 'Invalid gzip request body')
+    request.body.fp = io.BytesIO(body)
+    request.body.length = len(body)
+    request.headers['Content-Length'] = str(len(body))
+    del request.headers['Content-Encoding']
+
+cherrypy.tools.gunzip_in = cherrypy.Tool('before_request_body', _gunzip_in, priority=20)
+
+#
+# Each request runs in its own transaction, on a database connection
+# checked out of the pool for it. The transaction is committed if the
+# handler returns and rolled back if it raises.
+#
+def _db_transaction():
+    request = cherrypy.serving.request
+    handler = request.handler
+    if handler is None:
+        return
+
+    def _transaction_handler(*args, **kwargs):
+        with DatabaseV3.transaction():
+            return handler(*args, **kwargs)
+
+    request.handler = _transaction_handler
+
+cherrypy.tools.db_transaction = cherrypy.Tool('before_handler', _db_transaction, priority=90)
+
 def _json_handler(*args, **kwargs):
     # Adapted from cherrypy/lib/jsontools.py
     value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)
@@ -71,6 +117,8 @@ class _ServerResourceBase:
 
     exposed = True
 
+    _cp_config = {'tools.db_transaction.on': True}
+
     _db = None
 
     def __init__(self, conf):
@@ -157,6 +205,7 @@ class Root(_ServerResourceBase):
     #
     @cherrypy.tools.json_out()
     @cherrypy.tools.json_in()
+    @cherrypy.tools.gunzip_in()
     def POST(self, cmd, **kwargs):
         prefix = 'Root [POST /%s]' % str(cmd)
         self.logger.debug(prefix)
@@ -275,6 +324,7 @@ class Submit(_ServerResourceBase):
     #
     @cherrypy.tools.json_out()
     @cherrypy.tools.json_in()
+    @cherrypy.tools.gunzip_in()
     def POST(self, **kwargs):
         prefix = 'Submit [POST /submit/]'
         self.logger.info(prefix)
@@ -297,6 +347,22 @@ class Submit(_ServerResourceBase):
 
         data['metadata']['http_username'] = self._extract_http_username(cherrypy.request.headers['Authorization'])
         self.logger.info(prefix + " Append to metadata 'http_username' = '" + data['metadata']['http_username'] + "'")
+
+        #
+        # Return the stored reply if we already have this submission.
+        # The key is claimed in this request's transaction, so a retry
+        # sent while we are still at it waits for us to finish.
+        #
+        key = None
+        if 'Idempotency-Key' in cherrypy.request.headers:
+            key = cherrypy.request.headers['Idempotency-Key']
+            if 0 == len(key) or len(key) > 128:
+                self.logger.error(prefix + " Invalid 'Idempotency-Key' header")
+                raise cherrypy.HTTPError(400)
+            reply = self._db.claim_submission(data['metadata']['http_username'], key)
+            if reply is not None:
+                self.logger.info(prefix + " Already have submission '" + key + "'")
+                return reply
         
         #
         # Make sure we have all the metadata we need
@@ -339,37 +405,49 @@ class Submit(_ServerResourceBase):
                 return self._return_error(prefix, -1, "%s Failed [%s]" % (prefix, submit_info['error_msg']))
 
         #
-        # Submit each entry to the database
+        # Test runs come in large batches, so they are validated and
+        # then inserted all at once
         #
         ids = []
-        for entry in data['data']:
-            value = None
-
-            if phase is self._phase_mpi_install:
-                rtn = self._validate_mpi_install(submit_info['submit_id'], data['metadata'], entry)
-                if rtn is not None:
-                    return rtn
-                value = self._db.insert_mpi_install(submit_info['submit_id'], data['metadata'], entry)
-            elif phase is self._phase_test_build:
-                rtn = self._validate_test_build(submit_info['submit_id'], data['metadata'], entry)
-                if rtn is not None:
-                    return rtn
-                value = self._db.insert_test_build(submit_info['submit_id'], data['metadata'], entry)
-            elif phase is self._phase_test_run:
+        if phase is self._phase_test_run:
+            for entry in data['data']:
                 rtn = self._validate_test_run(submit_info['submit_id'], data['metadata'], entry)
                 if rtn is not None:
                     return rtn
-                value = self._db.insert_test_run(submit_info['submit_id'], data['metadata'], entry)
-            else:
-                self.logger.error( "Unkown phase...")
-
-            if value is None:
-                #ids.append( {'error':'failed to submit this run'} )
-                return self._return_error(prefix, -1, "%s Failed to submit an entry (unknown reason)" % (prefix))
-            elif 'error_msg' in value.keys():
+            # a submission made with an Idempotency-Key is known to be
+            # new, others may be a retry of one we already stored
+            value = self._db.insert_test_runs(submit_info['submit_id'], data['metadata'], data['data'],
+                                              dedup=key is None)
+            if 'error_msg' in value.keys():
                 return self._return_error(prefix, -2, value['error_msg'])
-            else:
-                ids.append( value )
+            ids = value['ids']
+        else:
+            #
+            # Submit each entry to the database
+            #
+            for entry in data['data']:
+                value = None
+
+                if phase is self._phase_mpi_install:
+                    rtn = self._validate_mpi_install(submit_info['submit_id'], data['metadata'], entry)
+                    if rtn is not None:
+                        return rtn
+                    value = self._db.insert_mpi_install(submit_info['submit_id'], data['metadata'], entry)
+                elif phase is self._phase_test_build:
+                    rtn = self._validate_test_build(submit_info['submit_id'], data['metadata'], entry)
+                    if rtn is not None:
+                        return rtn
+                    value = self._db.insert_test_build(submit_info['submit_id'], data['metadata'], entry)
+                else:
+                    self.logger.error( "Unkown phase...")
+
+                if value is None:
+                    #ids.append( {'error':'failed to submit this run'} )
+                    return self._return_error(prefix, -1, "%s Failed to submit an entry (unknown reason)" % (prefix))
+                elif 'error_msg' in value.keys():
+                    return self._return_error(prefix, -2, value['error_msg'])
+                else:
+                    ids.append( value )
 
         #
         # Return the ids for each of those submissions
@@ -387,6 +465,8 @@ class Submit(_ServerResourceBase):
                                        separators=(',', ': ') ) )
         self.logger.debug( "----------------------- Return Values JSON (End  ) ------------------ " )
 
+        if key is not None:
+            self._db.store_submission_reply(data['metadata']['http_username'], key, rtn)
 
         return rtn
 
@@ -424,6 +504,24 @@ class GenericQuery(_ServerResourceBase):
 
         return None
 
+    def _validate_search_value(self, prefix, key, value):
+        # a value, a list of values or a dict of search operators
+        if isinstance(value, dict):
+            if 0 == len(value):
+                return self._return_error(prefix, -1,
+                                          "%s Search key '%s' in 'search' has no operator" % (prefix, key))
+            for op in value.keys():
+                if op not in db_pgv3.SEARCH_OPERATORS:
+                    return self._return_error(prefix, -1,
+                                              "%s Search key '%s' in 'search' has an invalid operator '%s'. Valid operators are: %s" % (prefix, key, op, ", ".join(db_pgv3.SEARCH_OPERATORS)))
+            if "prefix" in value and not isinstance(value["prefix"], str):
+                return self._return_error(prefix, -1,
+                                          "%s Search key '%s' in 'search' must have a string 'prefix'" % (prefix, key))
+            if "in" in value and not isinstance(value["in"], list):
+                return self._return_error(prefix, -1,
+                                          "%s Search key '%s' in 'search' must have a list 'in'" % (prefix, key))
+        return None
+
     def _validate(self, data):
         return None
 
@@ -538,6 +636,9 @@ class Summary(GenericQuery):
             if key not in valid_keys:
                 return self._return_error(prefix, -1,
                                           "%s Search key '%s' in 'search' is not a valid key" % (prefix, key))
+            rtn = self._validate_search_value(prefix, key, search[key])
+            if rtn is not None:
+                return rtn
 
     def validate_options(self, options):
         prefix = "Summary validate_options"
@@ -624,6 +725,9 @@ class Detail(GenericQuery):
             if key not in valid_keys:
                 return self._return_error(prefix, -1,
                                           "%s Search key '%s' in 'search' is not a valid key" % (prefix, key))
+            rtn = self._validate_search_value(prefix, key, search[key])
+            if rtn is not None:
+                return rtn
 
     def validate_options(self, options):
         prefix = "Detail validate_options"
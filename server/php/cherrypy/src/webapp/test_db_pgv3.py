@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015-2019 Intel, Inc.  All rights reserved.
+# $COPYRIGHT$
+#
+# Additional copyrights may follow
+#
+# $HEADER$
+#
+
+import sys
+import types
+import logging
+
+import pytest
+
+try:
+   import psycopg2
+except ImportError:
+   # building the queries does not need the driver, so stand in for
+   # it with what db_pgv3 refers to when it is imported
+   psycopg2 = types.ModuleType("psycopg2")
+   psycopg2.pool = types.ModuleType("psycopg2.pool")
+   psycopg2.Error = Exception
+   psycopg2.IntegrityError = Exception
+   sys.modules["psycopg2"] = psycopg2
+   sys.modules["psycopg2.pool"] = psycopg2.pool
+
+from webapp import db_pgv3
+
+
+class _Cursor(object):
+   """Records the statements executed and returns the given rows, one
+   at a time with fetchone or a statement's worth with fetchall"""
+   def __init__(self, rows=None, results=None):
+      self.executed = []
+      self.rows = list(rows or [])
+      self.results = list(results or [])
+
+   def execute(self, stmt, params=None):
+      if isinstance(stmt, bytes):
+         stmt = stmt.decode()
+      self.executed.append((stmt, params))
+
+   def mogrify(self, template, params):
+      return (template % tuple(repr(v) for v in params)).encode()
+
+   def fetchone(self):
+      return self.rows.pop(0) if self.rows else None
+
+   def fetchall(self):
+      return self.results.pop(0)
+
+   def close(self):
+      pass
+
+
+def setup(cursor=None):
+   db = db_pgv3.DatabaseV3(logging.getLogger('mtt'), {})
+   if cursor is not None:
+      db.get_cursor = lambda: cursor
+   return db
+
+def test_searchPredicate():
+   db = setup()
+   assert db._search_predicate("t.a", 1) == ("t.a = %s", [1])
+   assert db._search_predicate("t.a", [1, 2]) == ("t.a IN %s", [(1, 2)])
+   assert db._search_predicate("t.a", {"in": []}) == ("FALSE", [])
+   assert db._search_predicate("t.a", {"from": 1, "to": 2}) == ("t.a BETWEEN %s AND %s", [1, 2])
+   assert db._search_predicate("t.a", {"from": 1}) == ("t.a >= %s", [1])
+   assert db._search_predicate("t.a", {"to": 2}) == ("t.a <= %s", [2])
+   # LIKE wildcards in the prefix are matched literally
+   assert db._search_predicate("t.a", {"prefix": "a_b%"}) == ("t.a LIKE %s", ["a\\_b\\%%"])
+   assert db._search_predicate("t.a", {"from": 1, "prefix": "x"}) == \
+      ("t.a >= %s AND t.a LIKE %s", [1, "x%"])
+
+def test_searchPredicateInvalid():
+   db = setup()
+   for value in [{"like": "x"}, {}, {"prefix": 1}, {"in": "x"}]:
+      with pytest.raises(ValueError):
+         db._search_predicate("t.a", value)
+
+def test_joinPath():
+   db = setup()
+   assert db._join_path("test_run", "compute_cluster") == ["compute_cluster"]
+   assert db._join_path("test_run", "interconnects") == ["test_run_command", "test_run_networks", "interconnects"]
+   assert db._join_path("test_run", "latency_bandwidth") == ["performance", "latency_bandwidth"]
+   assert db._join_path("test_build", "test_suites") == ["test_suites"]
+
+def test_detailQuery():
+   db = setup()
+   query = db._detail_query("test_run", ["platform_name", "test_result"],
+                            {"start_timestamp": {"from": "2019-01-01", "to": "2019-01-31"},
+                             "interconnect_name": "tcp"})
+   assert query["phase_name"] == "test_run"
+   assert dict(zip(query["columns"], query["names"])) == {"platform_name": "compute_cluster.platform_name",
+                                                           "test_result": "test_run.test_result"}
+   # only the tables needed are joined, each to one already joined
+   assert query["from"].split() == ("FROM test_run "
+      "INNER JOIN compute_cluster ON compute_cluster.compute_cluster_id = test_run.compute_cluster_id "
+      "INNER JOIN test_run_command ON test_run_command.test_run_command_id = test_run.test_run_command_id "
+      "INNER JOIN test_run_networks ON test_run_networks.test_run_network_id = test_run_command.test_run_network_id "
+      "INNER JOIN interconnects ON interconnects.interconnect_id = test_run_networks.interconnect_id").split()
+   assert sorted(query["params"]) == ["2019-01-01", "2019-01-31", "tcp"]
+   assert "test_run.start_timestamp BETWEEN %s AND %s" in query["where"]
+   assert "interconnects.interconnect_name = %s" in query["where"]
+
+def test_detailQueryFiltersPhase():
+   db = setup()
+   # test_run only columns are dropped when querying test builds
+   query = db._detail_query("test_build", ["test_name", "suite_name"], {"test_name": "ring"})
+   assert query["columns"] == ["suite_name"]
+   assert query["where"] == ""
+   assert query["params"] == []
+   assert db._detail_query("bogus", ["test_name"], {}) is None
+
+def test_summary():
+   cursor = _Cursor([("cluster1", 3, 4, 0, 1, 0)])
+   db = setup(cursor)
+   result = db._summary("test_run", ["platform_name"], {"platform_name": {"prefix": "clu"}})
+   stmt, params = cursor.executed[0]
+   # the counting is done by the database, one row per group
+   assert stmt.startswith("SELECT compute_cluster.platform_name, COUNT(*) FILTER (WHERE test_run.test_result = 0)")
+   assert "WHERE compute_cluster.platform_name LIKE %s" in stmt
+   assert stmt.rstrip().endswith("GROUP BY compute_cluster.platform_name")
+   assert params == ["clu%"]
+   assert result == [{"platform_name": "cluster1",
+                      "test_result_failed": 3,
+                      "test_result_passed": 4,
+                      "test_result_skipped": 0,
+                      "test_result_timed_out": 1,
+                      "test_result_unknown": 0}]
+
+def test_summaryNoColumns():
+   cursor = _Cursor([(1, 2, 3, 4, 5)])
+   db = setup(cursor)
+   result = db._summary("mpi_install", [], {})
+   stmt, params = cursor.executed[0]
+   # a single row counting every result, with nothing to join
+   assert stmt.split()[-2:] == ["FROM", "mpi_install"]
+   assert params == []
+   assert result[0]["test_result_unknown"] == 5
+
+def test_dimensionsResolve():
+   calls = []
+   class Database(object):
+      def _select_insert_many(self, table, table_id, fields, rows):
+         calls.append((table, rows))
+         return [100 * len(calls) + n for n in range(len(rows))]
+   dimensions = db_pgv3._Dimensions()
+   lb = dimensions.select_insert("latency_bandwidth", "latency_bandwidth_id", ["message_size"], [8])
+   perf = dimensions.select_insert("performance", "performance_id", ["latency_bandwidth_id"], [lb])
+   # the same row is only looked up once
+   assert dimensions.select_insert("latency_bandwidth", "latency_bandwidth_id", ["message_size"], [8]) is lb
+   other = dimensions.select_insert("latency_bandwidth", "latency_bandwidth_id", ["message_size"], [16])
+   dimensions.resolve(Database())
+   # latency_bandwidth is resolved before the performance rows referring to it
+   assert [table for table, rows in calls] == ["latency_bandwidth", "performance"]
+   assert sorted(calls[0][1]) == [[8], [16]]
+   assert calls[1][1] == [[lb.id]]
+   assert perf.id == 200
+   assert sorted([lb.id, other.id]) == [100, 101]
+   assert len(dimensions.found) == 3
+
+def test_dimensionsResolveCircular():
+   dimensions = db_pgv3._Dimensions()
+   a = db_pgv3._DimensionId()
+   dimensions.select_insert("performance", "performance_id", ["latency_bandwidth_id"], [a])
+   with pytest.raises(ValueError):
+      dimensions.resolve(object())
+
+def test_selectInsertMany():
+   # the first row is in the table, the second has to be inserted
+   cursor = _Cursor(results=[[(0, 5)], [(7,)], [(7,)]])
+   db = setup(cursor)
+   db._schema = lambda table: {'columns': {'latency_bandwidth_id': 'integer', 'message_size': 'integer'},
+                               'unique': [set(['message_size'])]}
+   ids = db._select_insert_many("latency_bandwidth", "latency_bandwidth_id", ["message_size", "bogus"],
+                                [[1008, "x"], [1016, "y"]])
+   assert ids == [5, 7]
+   stmts = [stmt for stmt, params in cursor.executed]
+   assert stmts[0] == ("SELECT v.n, MIN(t.latency_bandwidth_id) FROM latency_bandwidth t "
+                       "JOIN (VALUES (0, 1008::integer), (1, 1016::integer)) AS v(n, message_size) "
+                       "ON t.message_size = v.message_size GROUP BY v.n")
+   assert stmts[1] == "SAVEPOINT select_insert"
+   assert cursor.executed[2][1] == ("latency_bandwidth_latency_bandwidth_id_seq", 1)
+   # only the missing row is inserted, skipping it if it was raced in
+   assert stmts[3] == ("INSERT INTO latency_bandwidth (latency_bandwidth_id, message_size) VALUES "
+                       "(7, 1016) ON CONFLICT DO NOTHING RETURNING latency_bandwidth_id")
+   assert stmts[4] == "RELEASE SAVEPOINT select_insert"
+   assert len(stmts) == 5
+
+def test_insertTestRuns():
+   calls = []
+   db = setup()
+   def test_run_row(submit_id, metadata, entry, dimensions, test_builds):
+      dim = dimensions.select_insert("test_names", "test_name_id", ["test_name"], [entry[0]])
+      fields = ["test_name_id", "test_result"] + (["duration"] if 2 < len(entry) else [])
+      return {'fields': fields, 'values': [dim] + list(entry[1:])}
+   def select_insert_many(table, table_id, fields, rows):
+      calls.append(("select", table, fields, rows))
+      return [len(fields) * 10 + n for n in range(len(rows))]
+   def insert_many(table, table_id, fields, rows):
+      calls.append(("insert", table, fields, rows))
+      return [len(fields) * 10 + n for n in range(len(rows))]
+   db._test_run_row = test_run_row
+   db._select_insert_many = select_insert_many
+   db._insert_many = insert_many
+   db._found_ids = lambda found: None
+
+   entries = [("ring", 1), ("hello", 0), ("ring", 1), ("ring", 1, 5)]
+   result = db.insert_test_runs(1, {}, entries)
+   # the test names are looked up once, then the runs grouped by fields
+   assert calls[0] == ("select", "test_names", ["test_name"], [["ring"], ["hello"]])
+   assert sorted(calls[1:]) == [("select", "test_run", ["test_name_id", "test_result"], [[10, 1], [11, 0]]),
+                                ("select", "test_run", ["test_name_id", "test_result", "duration"], [[10, 1, 5]])]
+   # identical test runs share a row
+   assert result == {'ids': [{'test_run_id': 20}, {'test_run_id': 21},
+                             {'test_run_id': 20}, {'test_run_id': 30}]}
+
+   del calls[:]
+   result = db.insert_test_runs(1, {}, entries, dedup=False)
+   assert ("insert", "test_run", ["test_name_id", "test_result"], [[10, 1], [11, 0], [10, 1]]) in calls
+   assert result == {'ids': [{'test_run_id': 20}, {'test_run_id': 21},
+                             {'test_run_id': 22}, {'test_run_id': 30}]}
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015-2019 Intel, Inc.  All rights reserved.
+# $COPYRIGHT$
+#
+# Additional copyrights may follow
+#
+# $HEADER$
+#
+
+import io
+import sys
+import json
+import gzip
+import base64
+import logging
+
+import pytest
+
+cherrypy = pytest.importorskip("cherrypy")
+pytest.importorskip("configobj")
+pytest.importorskip("psycopg2")
+
+from webapp import dispatchers
+
+
+class _Database(object):
+   """Records what a submission stores in place of the database"""
+   def __init__(self):
+      self.test_runs = []
+      self.replies = {}
+
+   def get_fields_for_submit(self):
+      return {'required': ['hostname']}
+
+   def get_fields_for_test_run(self):
+      return {'required': ['test_name']}
+
+   def get_submit_id(self, metadata):
+      return {'submit_id': 7}
+
+   def insert_test_runs(self, submit_id, metadata, entries, dedup=True):
+      self.test_runs.extend(entries)
+      return {'ids': list(range(1, len(entries) + 1))}
+
+   def claim_submission(self, http_username, key):
+      return self.replies.setdefault((http_username, key), None)
+
+   def store_submission_reply(self, http_username, key, reply):
+      self.replies[(http_username, key)] = json.loads(json.dumps(reply))
+
+   def disconnect(self):
+      pass
+
+
+class _Submit(dispatchers.Submit):
+   # there is no connection pool to run the request in a transaction of
+   _cp_config = {'tools.db_transaction.on': False}
+
+   def __init__(self):
+      self.logger = logging.getLogger('mtt')
+      self._db = _Database()
+
+
+def _post(app, body, headers):
+   environ = {'REQUEST_METHOD': 'POST',
+              'SCRIPT_NAME': '',
+              'PATH_INFO': '/',
+              'QUERY_STRING': '',
+              'SERVER_NAME': 'localhost',
+              'HTTP_HOST': 'localhost',
+              'SERVER_PORT': '80',
+              'SERVER_PROTOCOL': 'HTTP/1.1',
+              'CONTENT_LENGTH': str(len(body)),
+              'wsgi.version': (1, 0),
+              'wsgi.url_scheme': 'http',
+              'wsgi.input': io.BytesIO(body),
+              'wsgi.errors': sys.stderr,
+              'wsgi.multithread': False,
+              'wsgi.multiprocess': False,
+              'wsgi.run_once': True}
+   for k,v in headers.items():
+      key = k.upper().replace('-', '_')
+      environ[key if key == 'CONTENT_TYPE' else 'HTTP_' + key] = v
+   status = []
+   output = b''.join(app(environ, lambda s, h, exc_info=None: status.append(s)))
+   return status[0], output
+
+
+def setup():
+   submit = _Submit()
+   conf = {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}}
+   return submit, cherrypy.Application(submit, '', conf)
+
+def submission(n):
+   return {'metadata': {'client_serial': 1,
+                        'hostname': 'node1',
+                        'http_username': 'mtt',
+                        'local_username': 'mtt',
+                        'mtt_client_version': '4.0',
+                        'phase': 'Test Run',
+                        'platform_name': 'cluster',
+                        'trial': 0},
+           'data': [{'test_name': 'ring_%d' % i, 'result_stdout': 'x' * 1000} for i in range(n)]}
+
+def headers(gzipped):
+   hdrs = {'Content-Type': 'application/json',
+           'Authorization': 'Basic ' + base64.b64encode(b'mtt:secret').decode()}
+   if gzipped:
+      hdrs['Content-Encoding'] = 'gzip'
+   return hdrs
+
+def test_gzippedSubmit():
+   submit, app = setup()
+   data = submission(100)
+   body = gzip.compress(json.dumps(data).encode())
+   # the body must be read to its decompressed length
+   assert len(body) < len(json.dumps(data))
+   status, output = _post(app, body, headers(True))
+   assert status.startswith('200')
+   assert json.loads(output.decode())['status'] == 0
+   assert submit._db.test_runs == data['data']
+
+def test_gzippedSubmitInvalid():
+   submit, app = setup()
+   body = gzip.compress(json.dumps(submission(1)).encode())
+   status, output = _post(app, body[:-8], headers(True))
+   assert status.startswith('400')
+   status, output = _post(app, b'not gzip', headers(True))
+   assert status.startswith('400')
+   assert submit._db.test_runs == []
+
+def test_gzippedSubmitTooLarge():
+   submit, app = setup()
+   body = gzip.compress(json.dumps(submission(100)).encode())
+   limit = cherrypy.server.max_request_body_size
+   cherrypy.server.max_request_body_size = 10000
+   try:
+      status, output = _post(app, body, headers(True))
+   finally:
+      cherrypy.server.max_request_body_size = limit
+   assert status.startswith('413')
+   assert submit._db.test_runs == []
+
+def test_retriedSubmit():
+   submit, app = setup()
+   data = submission(3)
+   hdrs = headers(False)
+   hdrs['Idempotency-Key'] = 'abc123'
+   status, first = _post(app, json.dumps(data).encode(), hdrs)
+   assert status.startswith('200')
+   # the retry gets the same reply without storing the results again
+   status, second = _post(app, json.dumps(data).encode(), hdrs)
+   assert status.startswith('200')
+   assert json.loads(second.decode()) == json.loads(first.decode())
+   assert submit._db.test_runs == data['data']
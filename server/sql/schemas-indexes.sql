@@ -1,11 +1,19 @@
 --
 -- A list of additional indexes to be applied to the database
 --
+-- NOTE:
+--  The /summary and /detail searches filter on start_timestamp, alone
+--  and with compute_cluster_id, test_suite_id or test_result. Indexes
+--  are not inherited by partitions, so those of the mpi_install,
+--  test_build and test_run partition tables are created on each
+--  partition by support/create-partition-indexes.pl.
+--
 
 --
 -- Compute Cluster Table
 --
--- NONE: compute_cluster
+DROP INDEX IF EXISTS idx_compute_cluster_platform_name;
+CREATE INDEX idx_compute_cluster_platform_name ON compute_cluster (platform_name);
 
 --
 -- Submit Table
@@ -38,7 +46,8 @@ CREATE INDEX idx_submit_http_username on submit (http_username);
 --
 -- Test Suites Table
 --
--- NONE: test_suites
+DROP INDEX IF EXISTS idx_test_suites_suite_name;
+CREATE INDEX idx_test_suites_suite_name ON test_suites (suite_name);
 
 --
 -- Test Names Table
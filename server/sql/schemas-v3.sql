@@ -665,6 +665,27 @@ CREATE TABLE test_run (
 
 ) INHERITS(results_fields);
 
+--
+-- Submission Reply Table
+-- NOTE:
+--  The reply to each submission that came with an Idempotency-Key, so
+--  that a submission the client retries is only stored once. The row is
+--  written in the same transaction as the results it replies for.
+--
+DROP TABLE IF EXISTS submit_reply CASCADE;
+CREATE TABLE submit_reply (
+    http_username       varchar(16)  NOT NULL,
+    idempotency_key     varchar(128) NOT NULL,
+    -- JSON reply, NULL until the submission has been stored
+    reply               text,
+    submitted           timestamp without time zone NOT NULL DEFAULT now(),
+
+    UNIQUE (
+            http_username,
+            idempotency_key
+    )
+);
+
 
 -- ****************************************** --
 -- Temporary Conversion tables
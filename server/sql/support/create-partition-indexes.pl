@@ -18,16 +18,32 @@ my $child_table_base;
 my $idx_column;
 my $sig;
 
-my @mpi_install_idx_columns = ("test_result");
+my $idx_name;
+
+#
+# Columns searched by the reporter (/summary and /detail) along with
+# start_timestamp. Multi-column indexes are listed as "col1, col2"; their
+# names abbreviate start_timestamp to keep within the identifier limit.
+#
+my @search_idx_columns = ("start_timestamp",
+                          "compute_cluster_id, start_timestamp",
+                          "test_result, start_timestamp");
+
+my @mpi_install_idx_columns = ("test_result",
+                               @search_idx_columns);
 
 my @test_build_idx_columns = ("test_result",
-                              "test_suite_id");
+                              "test_suite_id",
+                              "test_suite_id, start_timestamp",
+                              @search_idx_columns);
 
 my @test_run_idx_columns = ("test_result",
                             "test_suite_id",
                             "test_name_id",
                             "performance_id",
-                            "test_run_command_id");
+                            "test_run_command_id",
+                            "test_suite_id, start_timestamp",
+                            @search_idx_columns);
 
 my @month_array = ( "01", "02", "03", "04", "05", "06",
                     "07", "08", "09", "10", "11", "12");
@@ -78,8 +94,10 @@ foreach $idx_column (@mpi_install_idx_columns) {
     for($cur_wk = 1; $cur_wk <= 5; ++$cur_wk) {
       $sig = $child_table_base."y" . $year . "_m" . $month . "_wk" . $cur_wk;
 
-      print ("DROP   INDEX idx_".$sig."_".$idx_column.";\n");
-      print ("CREATE INDEX idx_".$sig."_".$idx_column." ON ".$sig." (".$idx_column.");\n");
+      ($idx_name = $idx_column) =~ s/,\s*/_/g;
+      $idx_name =~ s/start_timestamp/ts/;
+      print ("DROP   INDEX IF EXISTS idx_".$sig."_".$idx_name.";\n");
+      print ("CREATE INDEX idx_".$sig."_".$idx_name." ON ".$sig." (".$idx_column.");\n");
     }
   }
 }
@@ -104,8 +122,10 @@ foreach $idx_column (@test_build_idx_columns) {
     for($cur_wk = 1; $cur_wk <= 5; ++$cur_wk) {
       $sig = $child_table_base."y" . $year . "_m" . $month . "_wk" . $cur_wk;
 
-      print ("DROP   INDEX idx_".$sig."_".$idx_column.";\n");
-      print ("CREATE INDEX idx_".$sig."_".$idx_column." ON ".$sig." (".$idx_column.");\n");
+      ($idx_name = $idx_column) =~ s/,\s*/_/g;
+      $idx_name =~ s/start_timestamp/ts/;
+      print ("DROP   INDEX IF EXISTS idx_".$sig."_".$idx_name.";\n");
+      print ("CREATE INDEX idx_".$sig."_".$idx_name." ON ".$sig." (".$idx_column.");\n");
     }
   }
 }
@@ -130,8 +150,10 @@ foreach $idx_column (@test_run_idx_columns) {
     for($cur_wk = 1; $cur_wk <= 5; ++$cur_wk) {
       $sig = $child_table_base."y" . $year . "_m" . $month . "_wk" . $cur_wk;
 
-      print ("DROP   INDEX idx_".$sig."_".$idx_column.";\n");
-      print ("CREATE INDEX idx_".$sig."_".$idx_column." ON ".$sig." (".$idx_column.");\n");
+      ($idx_name = $idx_column) =~ s/,\s*/_/g;
+      $idx_name =~ s/start_timestamp/ts/;
+      print ("DROP   INDEX IF EXISTS idx_".$sig."_".$idx_name.";\n");
+      print ("CREATE INDEX idx_".$sig."_".$idx_name." ON ".$sig." (".$idx_column.");\n");
     }
   }
 }
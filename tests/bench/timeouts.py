@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2015-2019 Intel, Inc.  All rights reserved.
+# $COPYRIGHT$
+#
+# Additional copyrights may follow
+#
+# $HEADER$
+#
+# Compare the per-command cost of arming and cancelling a timeout with
+# one thread per command (as ExecuteCmd used to do) against the shared
+# TimeoutScheduler.
+#
+#   MTT_HOME=/path/to/mtt python3 timeouts.py [ncommands]
+#
+
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+
+sys.path.append(os.path.join(os.environ['MTT_HOME'], "pylib", "Utilities"))
+from TimeoutScheduler import TimeoutScheduler
+
+
+class KillProcessThread(object):
+    """The previous implementation: a thread and a condition per command"""
+    def __init__(self, seconds, pid):
+        self.seconds = seconds
+        self.pid = pid
+        self.cond = threading.Condition()
+        self.cancelled = False
+        self.thread = threading.Thread(target=self._wait)
+
+    def run(self):
+        self.thread.start()
+
+    def _wait(self):
+        with self.cond:
+            self.cond.wait(self.seconds)
+            if not self.cancelled:
+                os.kill(self.pid, signal.SIGTERM)
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify()
+        self.thread.join()
+
+
+def thread_per_command(pid):
+    timeout = KillProcessThread(3600, pid)
+    timeout.run()
+    timeout.cancel()
+
+
+def shared_scheduler(scheduler, pid):
+    timeout = scheduler.kill_after(3600, pid)
+    scheduler.cancel(timeout)
+
+
+def bench(name, func, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    elapsed = time.perf_counter() - start
+    print("%-22s %8d timeouts  %8.2f usec/command" % (name, n, elapsed * 1e6 / n))
+    return elapsed
+
+
+def bench_commands(name, arm, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        p = subprocess.Popen(["true"])
+        arm(p.pid)
+        p.wait()
+    elapsed = time.perf_counter() - start
+    print("%-22s %8d commands  %8.2f usec/command" % (name, n, elapsed * 1e6 / n))
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    scheduler = TimeoutScheduler()
+    pid = os.getpid()
+
+    print("Arming and cancelling a timeout:")
+    old = bench("thread per command", lambda: thread_per_command(pid), n)
+    new = bench("shared scheduler", lambda: shared_scheduler(scheduler, pid), n)
+    print("speedup: %.1fx" % (old / new))
+
+    ncmds = max(1, n // 10)
+    print("\nRunning 'true' with a timeout:")
+    old = bench_commands("thread per command", thread_per_command, ncmds)
+    new = bench_commands("shared scheduler", lambda pid: shared_scheduler(scheduler, pid), ncmds)
+    print("speedup: %.1fx" % (old / new))
+
+    # a timeout that fires still escalates SIGTERM -> SIGKILL
+    p = subprocess.Popen(["sh", "-c", "trap '' TERM; sleep 30"])
+    start = time.perf_counter()
+    timeout = scheduler.kill_after(0.1, p.pid, grace=0.2)
+    p.wait()
+    scheduler.cancel(timeout)
+    print("\nSIGTERM-ignoring child killed after %.2f secs (status %d)" % (time.perf_counter() - start, p.returncode))
+
+
+if __name__ == "__main__":
+    main()